@@ -1,8 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import threading
+
+import aiohttp
+import aiostream
 import pytest
+from pytest_httpserver import HTTPServer
+from werkzeug import Response
 
+from vdirsyncer import exceptions
 from vdirsyncer.storage.dav import _BAD_XML_CHARS
+from vdirsyncer.storage.dav import CardDAVStorage
+from vdirsyncer.storage.dav import DAVSession
+from vdirsyncer.storage.dav import InvalidXMLResponse
+from vdirsyncer.storage.dav import _iter_xml_elements
 from vdirsyncer.storage.dav import _merge_xml
 from vdirsyncer.storage.dav import _normalize_href
 from vdirsyncer.storage.dav import _parse_xml
@@ -49,6 +62,49 @@ def test_xml_specialchars(char):
         assert x.text == "yes\nhello"
 
 
+class _StreamedResponse:
+    """Just enough of :py:class:`aiohttp.ClientResponse` to feed a body in
+    chunks."""
+
+    def __init__(self, *chunks):
+        self.content = self
+        self._chunks = chunks
+
+    async def iter_chunked(self, n):
+        for chunk in self._chunks:
+            yield chunk
+
+
+@pytest.mark.asyncio
+async def test_iter_xml_elements():
+    body = (
+        b'<?xml version="1.0" encoding="UTF-8" ?><multistatus xmlns="DAV:">'
+        b"<response><href>/a</href></response>"
+        b"<response><href>/b\x01</href></response>"
+        b"<sync-token>foo</sync-token></multistatus>"
+    )
+    # Split the body at awkward places.
+    r = _StreamedResponse(*(body[i : i + 7] for i in range(0, len(body), 7)))
+    elements = await aiostream.stream.list(
+        _iter_xml_elements(r, ("{DAV:}response", "{DAV:}sync-token"))
+    )
+    assert [e.tag for e in elements] == [
+        "{DAV:}response",
+        "{DAV:}response",
+        "{DAV:}sync-token",
+    ]
+    assert [e.findtext("{DAV:}href") for e in elements[:2]] == ["/a", "/b"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("body", [b"", b"Hello world", b"<multistatus>"])
+async def test_iter_xml_elements_invalid(body):
+    with pytest.raises(InvalidXMLResponse):
+        await aiostream.stream.list(
+            _iter_xml_elements(_StreamedResponse(body), ("{DAV:}response",))
+        )
+
+
 @pytest.mark.parametrize(
     "href",
     [
@@ -57,3 +113,318 @@ def test_xml_specialchars(char):
 )
 def test_normalize_href(href):
     assert href == _normalize_href("https://example.com", href)
+
+
+@pytest.fixture
+def httpserver():
+    # pytest-httpserver's own fixture is session-scoped, and the system tests
+    # need it to speak TLS.
+    server = HTTPServer()
+    server.start()
+    yield server
+    server.clear()
+    if server.is_running():
+        server.stop()
+
+
+def _sync_collection_response(token, *responses):
+    body = "".join(
+        f"<response><href>{href}</href>{rest}</response>" for href, rest in responses
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8" ?>'
+        f'<multistatus xmlns="DAV:">{body}<sync-token>{token}</sync-token>'
+        "</multistatus>"
+    )
+
+
+def _item_props(etag):
+    return (
+        "<propstat><prop>"
+        f"<getetag>{etag}</getetag><getcontenttype>text/vcard</getcontenttype>"
+        "</prop><status>HTTP/1.1 200 OK</status></propstat>"
+    )
+
+
+@pytest.mark.asyncio
+async def test_list_changes(httpserver, aio_connector):
+    httpserver.expect_ordered_request("/coll/", method="REPORT").respond_with_data(
+        _sync_collection_response(
+            "token2",
+            ("/coll/a.vcf", _item_props('"1"')),
+            ("/coll/b.vcf", "<status>HTTP/1.1 404 Not Found</status>"),
+            ("/coll/", "<status>HTTP/1.1 507 Insufficient Storage</status>"),
+        ),
+        status=207,
+    )
+    httpserver.expect_ordered_request("/coll/", method="REPORT").respond_with_data(
+        _sync_collection_response("token3", ("/coll/c.vcf", _item_props('"2"'))),
+        status=207,
+    )
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    changes = await aiostream.stream.list(s.list_changes("token1"))
+    assert changes == [
+        ("/coll/a.vcf", '"1"'),
+        ("/coll/b.vcf", None),
+        ("/coll/c.vcf", '"2"'),
+    ]
+
+    requests = [request.get_data() for request, _ in httpserver.log]
+    assert b"<sync-token>token1</sync-token>" in requests[0]
+    assert b"<sync-token>token2</sync-token>" in requests[1]
+
+
+@pytest.mark.asyncio
+async def test_list_changes_invalid_token(httpserver, aio_connector):
+    httpserver.expect_request("/coll/", method="REPORT").respond_with_data(
+        "", status=403
+    )
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    with pytest.raises(exceptions.InvalidSyncToken):
+        await aiostream.stream.list(s.list_changes("token1"))
+
+
+@pytest.mark.asyncio
+async def test_get_sync_token(httpserver, aio_connector):
+    httpserver.expect_request("/coll/", method="PROPFIND").respond_with_data(
+        '<?xml version="1.0" encoding="UTF-8" ?>'
+        '<multistatus xmlns="DAV:"><response><href>/coll/</href>'
+        "<propstat><prop><sync-token> token1 </sync-token></prop>"
+        "<status>HTTP/1.1 200 OK</status></propstat></response></multistatus>",
+        status=207,
+    )
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    assert await s.get_sync_token() == "token1"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    ("props", "ctag"),
+    [
+        (
+            (
+                '<getctag xmlns="http://calendarserver.org/ns/">ctag1</getctag>'
+                "<sync-token>token1</sync-token>"
+            ),
+            "ctag1",
+        ),
+        ("<sync-token>token1</sync-token>", "token1"),
+        ("", None),
+    ],
+)
+async def test_get_ctag(httpserver, aio_connector, props, ctag):
+    httpserver.expect_request("/coll/", method="PROPFIND").respond_with_data(
+        '<?xml version="1.0" encoding="UTF-8" ?>'
+        '<multistatus xmlns="DAV:"><response><href>/coll/</href>'
+        f"<propstat><prop>{props}</prop>"
+        "<status>HTTP/1.1 200 OK</status></propstat></response></multistatus>",
+        status=207,
+    )
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    assert await s.get_ctag() == ctag
+
+
+def _multiget_handler(requests):
+    def handler(request):
+        root = _parse_xml(request.get_data())
+        hrefs = [href.text for href in root.iter("{DAV:}href")]
+        requests.append(hrefs)
+        body = "".join(
+            f"<response><href>{href}</href><propstat><prop>"
+            f'<getetag>"{href}"</getetag>'
+            '<address-data xmlns="urn:ietf:params:xml:ns:carddav">'
+            f"BEGIN:VCARD\nUID:{href}\nEND:VCARD</address-data>"
+            "</prop><status>HTTP/1.1 200 OK</status></propstat></response>"
+            for href in hrefs
+            if not href.endswith("missing.vcf")
+        )
+        return Response(
+            f'<?xml version="1.0" encoding="UTF-8" ?>'
+            f'<multistatus xmlns="DAV:">{body}</multistatus>',
+            status=207,
+        )
+
+    return handler
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", [1, 3])
+async def test_get_multi_batches(httpserver, aio_connector, concurrency):
+    requests = []
+    httpserver.expect_request("/coll/", method="REPORT").respond_with_handler(
+        _multiget_handler(requests)
+    )
+
+    s = CardDAVStorage(
+        url=httpserver.url_for("/coll/"),
+        connector=aio_connector,
+        multiget_batch_size=2,
+        multiget_concurrency=concurrency,
+    )
+    hrefs = [f"/coll/{i}.vcf" for i in range(5)]
+    rv = await aiostream.stream.list(s.get_multi(hrefs + hrefs[:2]))
+
+    assert sorted(href for href, item, etag in rv) == hrefs
+    for href, item, etag in rv:
+        assert item.uid == href
+        assert etag == f'"{href}"'
+    assert sorted(len(batch) for batch in requests) == [1, 2, 2]
+
+
+@pytest.mark.asyncio
+async def test_get_multi_missing(httpserver, aio_connector):
+    httpserver.expect_request("/coll/", method="REPORT").respond_with_handler(
+        _multiget_handler([])
+    )
+
+    s = CardDAVStorage(
+        url=httpserver.url_for("/coll/"),
+        connector=aio_connector,
+        multiget_batch_size=2,
+    )
+    hrefs = ["/coll/0.vcf", "/coll/1.vcf", "/coll/missing.vcf"]
+    with pytest.raises(exceptions.NotFoundError):
+        await aiostream.stream.list(s.get_multi(hrefs))
+
+
+@pytest.mark.asyncio
+async def test_get_fingerprints(httpserver, aio_connector):
+    requests = []
+
+    def handler(request):
+        root = _parse_xml(request.get_data())
+        requests.append(root)
+        body = "".join(
+            f"<response><href>{href.text}</href><propstat><prop>"
+            f'<getetag>"{href.text}"</getetag>'
+            f'<checksum xmlns="http://example.com/ns/">sum-{href.text}</checksum>'
+            "</prop><status>HTTP/1.1 200 OK</status></propstat></response>"
+            for href in root.iter("{DAV:}href")
+            if not href.text.endswith("missing.vcf")
+        )
+        return Response(
+            f'<?xml version="1.0" encoding="UTF-8" ?>'
+            f'<multistatus xmlns="DAV:">{body}</multistatus>',
+            status=207,
+        )
+
+    httpserver.expect_request("/coll/", method="REPORT").respond_with_handler(handler)
+
+    s = CardDAVStorage(
+        url=httpserver.url_for("/coll/"),
+        connector=aio_connector,
+        fingerprint_property="{http://example.com/ns/}checksum",
+    )
+    hrefs = ["/coll/0.vcf", "/coll/missing.vcf"]
+    rv = await aiostream.stream.list(s.get_fingerprints(hrefs))
+
+    assert rv == [("/coll/0.vcf", "sum-/coll/0.vcf")]
+    (root,) = requests
+    assert root.tag == "{urn:ietf:params:xml:ns:carddav}addressbook-multiget"
+    assert root.find("{DAV:}prop/{http://example.com/ns/}checksum") is not None
+    assert root.find("{DAV:}prop/{urn:ietf:params:xml:ns:carddav}address-data") is None
+
+
+@pytest.mark.asyncio
+async def test_get_fingerprints_disabled(aio_connector):
+    s = CardDAVStorage(url="http://example.com/", connector=aio_connector)
+    assert not await aiostream.stream.list(s.get_fingerprints(["/0.vcf"]))
+
+
+@pytest.mark.parametrize("value", [0, -1, True, "10"])
+def test_invalid_multiget_batch_size(aio_connector, value):
+    with pytest.raises(exceptions.UserError):
+        CardDAVStorage(
+            url="http://example.com/",
+            connector=aio_connector,
+            multiget_batch_size=value,
+        )
+
+
+@pytest.mark.asyncio
+async def test_list_is_streamed(httpserver, aio_connector):
+    first_item_seen = threading.Event()
+    streamed = []
+
+    def body():
+        yield (
+            '<?xml version="1.0" encoding="UTF-8" ?><multistatus xmlns="DAV:">'
+            f"<response><href>/coll/a.vcf</href>{_item_props('a')}</response>"
+        )
+        # The rest of the listing is only sent once the first item arrived.
+        streamed.append(first_item_seen.wait(timeout=10))
+        yield (
+            f"<response><href>/coll/b.vcf</href>{_item_props('b')}</response>"
+            "</multistatus>"
+        )
+
+    httpserver.expect_request("/coll/", method="PROPFIND").respond_with_handler(
+        lambda request: Response(body(), status=207)
+    )
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    rv = []
+    async for href, etag in s.list():
+        first_item_seen.set()
+        rv.append((href, etag))
+    assert rv == [("/coll/a.vcf", "a"), ("/coll/b.vcf", "b")]
+    assert streamed == [True]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    ("body", "status"), [("", 404), ("", 410), ("<multistatus", 207)]
+)
+async def test_tokens_unsupported(httpserver, aio_connector, body, status):
+    httpserver.expect_request("/coll/").respond_with_data(body, status=status)
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    assert await s.get_sync_token() is None
+    assert await s.get_ctag() is None
+    with pytest.raises(exceptions.InvalidSyncToken):
+        await aiostream.stream.list(s.list_changes("token1"))
+
+
+@pytest.mark.asyncio
+async def test_get_collection_tokens(httpserver, aio_connector):
+    httpserver.expect_request("/coll/", method="PROPFIND").respond_with_data(
+        '<?xml version="1.0" encoding="UTF-8" ?>'
+        '<multistatus xmlns="DAV:"><response><href>/coll/</href>'
+        '<propstat><prop><getctag xmlns="http://calendarserver.org/ns/">ctag1'
+        "</getctag><sync-token>token1</sync-token></prop>"
+        "<status>HTTP/1.1 200 OK</status></propstat></response></multistatus>",
+        status=207,
+    )
+
+    s = CardDAVStorage(url=httpserver.url_for("/coll/"), connector=aio_connector)
+    assert await s.get_collection_tokens() == ("ctag1", "token1")
+    assert len(httpserver.log) == 1
+
+
+@pytest.mark.asyncio
+async def test_limit_listings():
+    async with aiohttp.TCPConnector(limit_per_host=4) as connector:
+        sessions = [
+            DAVSession(f"http://example.com/{i}/", connector=connector)
+            for i in range(3)
+        ]
+        other_host = DAVSession("http://example.org/", connector=connector)
+
+        async with contextlib.AsyncExitStack() as stack:
+            for session in sessions[:2]:
+                await stack.enter_async_context(session.limit_listings())
+
+            # Half of the connections to a host are left for other requests.
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    stack.enter_async_context(sessions[2].limit_listings()), 0.01
+                )
+            async with other_host.limit_listings():
+                pass
+
+        async with sessions[2].limit_listings():
+            pass
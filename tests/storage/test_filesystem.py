@@ -1,16 +1,37 @@
 from __future__ import annotations
 
-import subprocess
+import asyncio
+import threading
+import time
 
 import aiostream
 import pytest
 
+from vdirsyncer import exceptions
 from vdirsyncer.storage.filesystem import FilesystemStorage
 from vdirsyncer.vobject import Item
+from vdirsyncer.watch import DirectoryWatcher
 
 from . import StorageTests
 
 
+@pytest.fixture
+def hook_calls(monkeypatch):
+    """Record the hooks that are called, instead of running them."""
+    calls = []
+
+    class Process:
+        async def wait(self):
+            return 0
+
+    async def create_subprocess_exec(*args):
+        calls.append(args)
+        return Process()
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", create_subprocess_exec)
+    return calls
+
+
 class TestFilesystemStorage(StorageTests):
     storage_class = FilesystemStorage
 
@@ -85,6 +106,153 @@ class TestFilesystemStorage(StorageTests):
         assert len(tmpdir.listdir()) == 2
         assert len(await aiostream.stream.list(storage.list())) == 1
 
+    @pytest.mark.asyncio
+    async def test_list_skips_non_files(self, tmpdir):
+        s = self.storage_class(str(tmpdir), ".txt")
+        href, etag = await s.upload(Item("UID:a"))
+        tmpdir.mkdir("dir.txt")
+        tmpdir.join("broken.txt").mksymlinkto(tmpdir.join("nonexistent"))
+        tmpdir.join("link.txt").mksymlinkto(tmpdir.join(href))
+
+        assert dict(await aiostream.stream.list(s.list())) == {
+            href: etag,
+            "link.txt": etag,
+        }
+
+    @pytest.mark.asyncio
+    async def test_get_multi_concurrency(self, tmpdir, monkeypatch):
+        s = self.storage_class(str(tmpdir), ".txt", io_concurrency=2)
+        hrefs = [(await s.upload(Item(f"UID:{i}")))[0] for i in range(5)]
+
+        running = 0
+        max_running = 0
+        lock = threading.Lock()
+        get_blocking = s._get_blocking
+
+        def get_blocking_mock(href):
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            try:
+                time.sleep(0.01)
+                return get_blocking(href)
+            finally:
+                with lock:
+                    running -= 1
+
+        monkeypatch.setattr(s, "_get_blocking", get_blocking_mock)
+        items = await aiostream.stream.list(s.get_multi(hrefs + hrefs))
+        assert sorted(href for href, _, _ in items) == sorted(hrefs)
+        assert max_running == 2
+
+        with pytest.raises(exceptions.NotFoundError):
+            await aiostream.stream.list(s.get_multi([*hrefs, "nonexistent.txt"]))
+
+    @pytest.mark.parametrize(
+        "name", ["io_concurrency", "hook_concurrency", "post_hook_batch_size"]
+    )
+    @pytest.mark.parametrize("value", [0, "4", True])
+    def test_invalid_concurrency(self, tmpdir, name, value):
+        with pytest.raises(exceptions.UserError):
+            self.storage_class(str(tmpdir), ".txt", **{name: value})
+
+    @pytest.mark.asyncio
+    async def test_at_once_publishes_at_end(self, tmpdir, hook_calls):
+        s = self.storage_class(str(tmpdir), ".txt", post_hook="foo")
+        old_href, old_etag = await s.upload(Item("UID:old"))
+        hook_calls.clear()
+
+        async with s.at_once():
+            href, etag = await s.upload(Item("UID:new"))
+            new_old_etag = await s.update(old_href, Item("UID:old\nX:Y"), old_etag)
+            assert not tmpdir.join(href).exists()
+            assert not hook_calls
+            with pytest.raises(exceptions.AlreadyExistingError):
+                await s.upload(Item("UID:new"))
+
+        assert sorted(hook_calls) == sorted(
+            [("foo", str(tmpdir.join(href))), ("foo", str(tmpdir.join(old_href)))]
+        )
+        assert dict(await aiostream.stream.list(s.list())) == {
+            href: etag,
+            old_href: new_old_etag,
+        }
+        item, _ = await s.get(old_href)
+        assert item.raw == "UID:old\nX:Y"
+        assert len(tmpdir.listdir()) == 2
+
+    @pytest.mark.asyncio
+    async def test_at_once_publishes_after_error(self, tmpdir):
+        s = self.storage_class(str(tmpdir), ".txt")
+        with pytest.raises(ZeroDivisionError):
+            async with s.at_once():
+                href, etag = await s.upload(Item("UID:new"))
+                1 / 0  # noqa: B018
+
+        assert dict(await aiostream.stream.list(s.list())) == {href: etag}
+
+    @pytest.mark.asyncio
+    async def test_at_once_publish_conflict(self, tmpdir, hook_calls):
+        s = self.storage_class(str(tmpdir), ".txt", post_hook="foo")
+        async with s.at_once():
+            href, _ = await s.upload(Item("UID:a"))
+            other_href, other_etag = await s.upload(Item("UID:b"))
+            tmpdir.join(href).write("UID:external")
+
+        assert s.pop_publish_conflicts() == [href]
+        assert s.pop_publish_conflicts() == []
+        assert tmpdir.join(href).read() == "UID:external"
+        assert hook_calls == [("foo", str(tmpdir.join(other_href)))]
+        assert dict(await aiostream.stream.list(s.list()))[other_href] == other_etag
+        assert len(tmpdir.listdir()) == 2
+
+    @pytest.mark.asyncio
+    async def test_at_once_cancelled_while_publishing(
+        self, tmpdir, hook_calls, monkeypatch
+    ):
+        s = self.storage_class(str(tmpdir), ".txt", post_hook="foo")
+        started = threading.Event()
+        proceed = threading.Event()
+        publish_staged = s._publish_staged
+
+        def slow_publish_staged(fpaths=None):
+            if fpaths is None:
+                started.set()
+                proceed.wait()
+            publish_staged(fpaths)
+
+        monkeypatch.setattr(s, "_publish_staged", slow_publish_staged)
+
+        async def run():
+            async with s.at_once():
+                await s.upload(Item("UID:a"))
+
+        task = asyncio.ensure_future(run())
+        await asyncio.to_thread(started.wait)
+        task.cancel()
+        await asyncio.sleep(0.01)
+        proceed.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # The file was published, and the post_hook called for it.
+        (fpath,) = tmpdir.listdir()
+        assert hook_calls == [("foo", str(fpath))]
+
+    @pytest.mark.asyncio
+    async def test_at_once_access_staged_item(self, tmpdir):
+        s = self.storage_class(str(tmpdir), ".txt")
+        async with s.at_once():
+            href, etag = await s.upload(Item("UID:new"))
+            item, actual_etag = await s.get(href)
+            assert item.raw == "UID:new"
+            assert actual_etag == etag
+            etag = await s.update(href, Item("UID:new\nX:Y"), etag)
+            await s.delete(href, etag)
+
+        assert not tmpdir.listdir()
+
     @pytest.mark.asyncio
     async def test_too_long_uid(self, tmpdir):
         storage = self.storage_class(str(tmpdir), ".txt")
@@ -94,30 +262,72 @@ class TestFilesystemStorage(StorageTests):
         assert item.uid not in href
 
     @pytest.mark.asyncio
-    async def test_post_hook_inactive(self, tmpdir, monkeypatch):
-        def check_call_mock(*args, **kwargs):
-            raise AssertionError
-
-        monkeypatch.setattr(subprocess, "call", check_call_mock)
-
+    async def test_post_hook_inactive(self, tmpdir, hook_calls):
         s = self.storage_class(str(tmpdir), ".txt", post_hook=None)
         await s.upload(Item("UID:a/b/c"))
+        assert not hook_calls
 
     @pytest.mark.asyncio
-    async def test_post_hook_active(self, tmpdir, monkeypatch):
-        calls = []
+    async def test_post_hook_active(self, tmpdir, hook_calls):
         exe = "foo"
+        s = self.storage_class(str(tmpdir), ".txt", post_hook=exe)
+        href, _ = await s.upload(Item("UID:a/b/c"))
+        assert hook_calls == [(exe, str(tmpdir.join(href)))]
 
-        def check_call_mock(call, *args, **kwargs):
-            calls.append(True)
-            assert len(call) == 2
-            assert call[0] == exe
+    @pytest.mark.asyncio
+    async def test_post_hook_batches(self, tmpdir, hook_calls):
+        s = self.storage_class(
+            str(tmpdir), ".txt", post_hook="foo", post_hook_batch_size=2
+        )
+        async with s.at_once():
+            for i in range(5):
+                await s.upload(Item(f"UID:{i}"))
+        assert sorted(len(call) - 1 for call in hook_calls) == [1, 2, 2]
+        assert {path for call in hook_calls for path in call[1:]} == {
+            str(f) for f in tmpdir.listdir()
+        }
 
-        monkeypatch.setattr(subprocess, "call", check_call_mock)
+        # Outside of `at_once`, the hook is called right away.
+        hook_calls.clear()
+        await s.upload(Item("UID:5"))
+        assert len(hook_calls) == 1
 
-        s = self.storage_class(str(tmpdir), ".txt", post_hook=exe)
-        await s.upload(Item("UID:a/b/c"))
-        assert calls
+    @pytest.mark.asyncio
+    async def test_pre_deletion_hook(self, tmpdir, hook_calls):
+        s = self.storage_class(str(tmpdir), ".txt", pre_deletion_hook="foo")
+        href, etag = await s.upload(Item("UID:a"))
+        await s.delete(href, etag)
+        assert hook_calls == [("foo", str(tmpdir.join(href)))]
+        assert not tmpdir.listdir()
+
+    @pytest.mark.asyncio
+    async def test_hook_not_found(self, tmpdir):
+        s = self.storage_class(
+            str(tmpdir), ".txt", post_hook=str(tmpdir.join("nonexistent"))
+        )
+        await s.upload(Item("UID:a"))
+
+    @pytest.mark.asyncio
+    async def test_hook_concurrency(self, tmpdir, monkeypatch):
+        running = 0
+        max_running = 0
+
+        class Process:
+            async def wait(self):
+                nonlocal running
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        async def create_subprocess_exec(*args):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            return Process()
+
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", create_subprocess_exec)
+        s = self.storage_class(str(tmpdir), ".txt", post_hook="foo", hook_concurrency=2)
+        await asyncio.gather(*(s.upload(Item(f"UID:{i}")) for i in range(6)))
+        assert max_running == 2
 
     @pytest.mark.asyncio
     async def test_ignore_git_dirs(self, tmpdir):
@@ -130,3 +340,32 @@ class TestFilesystemStorage(StorageTests):
             c["collection"] async for c in self.storage_class.discover(str(tmpdir))
         }
         assert actual == expected
+
+    @pytest.mark.asyncio
+    async def test_list_changes(self, tmpdir):
+        s = self.storage_class(str(tmpdir), ".txt")
+        assert await s.get_sync_token() is None
+
+        watcher = DirectoryWatcher(poll_interval=0.01, use_inotify=False)
+        try:
+            s.attach_watcher(watcher)
+            removed_href, removed_etag = await s.upload(Item("UID:removed"))
+            await s.upload(Item("UID:unchanged"))
+            await asyncio.sleep(0.05)
+            token = await s.get_sync_token()
+
+            href, etag = await s.upload(Item("UID:new"))
+            await s.delete(removed_href, removed_etag)
+            tmpdir.join("ignored.tmp").write("UID:ignored")
+            expected = {href: etag, removed_href: None}
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                changes = {h: e async for h, e in s.list_changes(token)}
+                if changes == expected:
+                    break
+            assert changes == expected
+
+            with pytest.raises(exceptions.InvalidSyncToken):
+                await aiostream.stream.list(s.list_changes("other:0"))
+        finally:
+            watcher.close()
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import os
+import sys
+
 import aiohttp
+import aiostream
 import pytest
 from aioresponses import CallbackResult
 from aioresponses import aioresponses
 
+import vdirsyncer.storage.http
 from tests import normalize_item
 from vdirsyncer.exceptions import UserError
 from vdirsyncer.http import BasicAuthMethod
@@ -12,7 +17,9 @@ from vdirsyncer.http import DigestAuthMethod
 from vdirsyncer.http import UsageLimitReached
 from vdirsyncer.http import request
 from vdirsyncer.storage.http import HttpStorage
+from vdirsyncer.storage.http import _split_file
 from vdirsyncer.storage.http import prepare_auth
+from vdirsyncer.vobject import split_collection
 
 
 @pytest.mark.asyncio
@@ -161,3 +168,220 @@ async def test_403_without_usage_limits_domain(aio_connector):
             m.get(url, status=403, repeat=True)
             with pytest.raises(aiohttp.ClientResponseError):
                 await request("GET", url, session)
+
+
+class FakeServer:
+    """Serve ``body`` to :py:class:`HttpStorage`, with an ``ETag``."""
+
+    def __init__(self):
+        self.body = b""
+        self.requests = []
+        self.send_etag = True
+
+    async def request(self, method, url, headers, **kwargs):
+        self.requests.append(headers)
+        etag = f'"{hash(self.body)}"'
+        if headers.get("If-None-Match") == etag:
+            return FakeResponse(304, {}, b"")
+        return FakeResponse(200, {"ETag": etag} if self.send_etag else {}, self.body)
+
+
+class FakeResponse:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.content = self
+        self._body = body
+
+    async def iter_chunked(self, size):
+        for i in range(0, len(self._body), 8):
+            yield self._body[i : i + 8]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    rv = FakeServer()
+    monkeypatch.setattr(vdirsyncer.storage.http, "request", rv.request)
+    return rv
+
+
+@pytest.mark.asyncio
+async def test_list_cache(aio_connector, tmpdir, server):
+    server.body = (
+        b"BEGIN:VCALENDAR\nBEGIN:VEVENT\nSUMMARY:Foo\nEND:VEVENT\nEND:VCALENDAR"
+    )
+    requests = server.requests
+
+    def storage(**kwargs):
+        s = HttpStorage(url="http://127.0.0.1/", connector=aio_connector, **kwargs)
+        s.set_list_cache(str(tmpdir.join("cache")))
+        return s
+
+    listed = await aiostream.stream.list(storage().list())
+    ((href, etag),) = listed
+    assert "If-None-Match" not in requests[-1]
+
+    # The collection isn't downloaded again if it didn't change.
+    s = storage()
+    assert await aiostream.stream.list(s.list()) == listed
+    assert "If-None-Match" in requests[-1]
+
+    # Until an item is actually needed.
+    item, actual_etag = await s.get(href)
+    assert actual_etag == etag
+    assert "SUMMARY:Foo" in item.raw
+    assert "If-None-Match" not in requests[-1]
+
+    # Other settings result in other items.
+    await aiostream.stream.list(storage(filter_hook="cat").list())
+    assert "If-None-Match" not in requests[-1]
+
+
+@pytest.mark.parametrize(
+    "collection",
+    [
+        "",
+        (
+            "BEGIN:VCALENDAR\r\n"
+            "BEGIN:VEVENT\r\nUID:a\r\nEND:VEVENT\r\n"
+            "BEGIN:VEVENT\r\nUID:b\r\nEND:VEVENT\r\n"
+            "BEGIN:VEVENT\r\nUID:a\r\nRECURRENCE-ID:1\r\nEND:VEVENT\r\n"
+            "BEGIN:VTIMEZONE\r\nTZID:x\r\nEND:VTIMEZONE\r\n"
+            "END:VCALENDAR\r\n"
+        ),
+        # Can't be indexed, so it's split in memory.
+        (
+            "BEGIN:VEVENT\r\nUID:a\r\nEND:VEVENT\r\n"
+            "BEGIN:VEVENT\r\nUID:b\r\nEND:VEVENT\r\n"
+        ),
+    ],
+)
+def test_split_file(tmpdir, collection):
+    f = tmpdir.join("collection.ics")
+    f.write_binary(collection.encode("utf-8"))
+    with open(str(f), "rb") as fp:
+        assert list(_split_file(fp)) == list(split_collection(collection))
+
+
+ITEM_HOOK = """\
+import sys
+
+item = sys.stdin.read()
+if "SKIP" not in item:
+    sys.stdout.write(item.replace("SUMMARY:", "SUMMARY:Filtered "))
+"""
+
+STREAM_HOOK = """\
+import sys
+
+for item in sys.stdin.buffer.read().split(b"\\0")[:-1]:
+    if b"SKIP" in item:
+        item = b""
+    sys.stdout.buffer.write(item.replace(b"SUMMARY:", b"SUMMARY:Filtered ") + b"\\0")
+"""
+
+
+def make_hook(tmpdir, code):
+    hook = tmpdir.join("hook")
+    hook.write(f"#!{sys.executable}\n{code}")
+    hook.chmod(0o755)
+    return str(hook)
+
+
+@pytest.mark.parametrize(
+    ("mode", "code"), [("item", ITEM_HOOK), ("stream", STREAM_HOOK)]
+)
+@pytest.mark.asyncio
+async def test_filter_hook(aio_connector, tmpdir, server, mode, code):
+    server.body = "\r\n".join(
+        [
+            "BEGIN:VCALENDAR",
+            *(
+                f"BEGIN:VEVENT\r\nUID:{i}\r\nSUMMARY:{summary}\r\nEND:VEVENT"
+                for i, summary in enumerate(["Foo", "SKIP", "Bär"])
+            ),
+            "END:VCALENDAR",
+        ]
+    ).encode("utf-8")
+    s = HttpStorage(
+        url="http://127.0.0.1/",
+        connector=aio_connector,
+        filter_hook=make_hook(tmpdir, code),
+        filter_hook_mode=mode,
+    )
+    items = [item async for _, item, _ in s.get_multi([h async for h, _ in s.list()])]
+    assert sorted(item.parsed.subcomponents[0]["SUMMARY"] for item in items) == [
+        "Filtered Bär",
+        "Filtered Foo",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_list_cache_invalidation(aio_connector, tmpdir, server):
+    server.body = b"BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nEND:VEVENT\r\nEND:VCALENDAR"
+    requests = server.requests
+    cache_path = tmpdir.join("cache")
+    hook = make_hook(tmpdir, ITEM_HOOK)
+
+    async def list_collection():
+        s = HttpStorage(
+            url="http://127.0.0.1/", connector=aio_connector, filter_hook=hook
+        )
+        s.set_list_cache(str(cache_path))
+        return await aiostream.stream.list(s.list())
+
+    await list_collection()
+    await list_collection()
+    assert "If-None-Match" in requests[-1]
+
+    # Changing the filter_hook changes the items.
+    st = os.stat(hook)
+    os.utime(hook, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    await list_collection()
+    assert "If-None-Match" not in requests[-1]
+    await list_collection()
+    assert "If-None-Match" in requests[-1]
+
+    # Without validators, the old ones must not be used anymore.
+    server.send_etag = False
+    server.body += b"\r\n"
+    await list_collection()
+    assert not cache_path.exists()
+    await list_collection()
+    assert "If-None-Match" not in requests[-1]
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        # Returns too few items.
+        "import sys; sys.stdin.read()",
+        # Doesn't answer in time.
+        "import time; time.sleep(10)",
+    ],
+)
+@pytest.mark.asyncio
+async def test_filter_hook_stream_errors(aio_connector, tmpdir, server, code):
+    server.body = b"BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nEND:VEVENT\r\nEND:VCALENDAR"
+    s = HttpStorage(
+        url="http://127.0.0.1/",
+        connector=aio_connector,
+        filter_hook=make_hook(tmpdir, code),
+        filter_hook_mode="stream",
+        filter_hook_timeout=0.5,
+    )
+    with pytest.raises(UserError):
+        await aiostream.stream.list(s.list())
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"filter_hook_mode": "batch"},
+        {"filter_hook_timeout": 0},
+        {"filter_hook_timeout": "1"},
+    ],
+)
+def test_invalid_filter_hook_options(aio_connector, kwargs):
+    with pytest.raises(UserError):
+        HttpStorage(url="http://127.0.0.1/", connector=aio_connector, **kwargs)
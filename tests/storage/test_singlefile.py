@@ -1,8 +1,17 @@
 from __future__ import annotations
 
+import os
+
+import aiostream
 import pytest
 
+from tests import BARE_EVENT_TEMPLATE
+from tests import EVENT_TEMPLATE
+from tests import EVENT_WITH_TIMEZONE_TEMPLATE
+from vdirsyncer import exceptions
+from vdirsyncer.storage import singlefile
 from vdirsyncer.storage.singlefile import SingleFileStorage
+from vdirsyncer.vobject import Item
 
 from . import StorageTests
 
@@ -11,12 +20,192 @@ class TestSingleFileStorage(StorageTests):
     storage_class = SingleFileStorage
     supports_metadata = False
 
-    @pytest.fixture
-    def get_storage_args(self, tmpdir):
+    @pytest.fixture(params=[False, True], ids=["", "persistent_index"])
+    def get_storage_args(self, request, tmpdir):
         async def inner(collection="test"):
-            rv = {"path": str(tmpdir.join("%s.txt")), "collection": collection}
+            rv = {
+                "path": str(tmpdir.join("%s.txt")),
+                "collection": collection,
+                "persistent_index": request.param,
+            }
             if collection is not None:
                 rv = await self.storage_class.create_collection(**rv)
             return rv
 
         return inner
+
+    async def _assert_file_contains(self, s):
+        """Check that the file contains what ``s`` thinks it does.
+
+        Only the items' own components are compared, since the items in the
+        file share the properties of the wrapper and the timezones.
+        """
+
+        def components(item):
+            return [
+                list(c.dump_lines())
+                for c in item.parsed.subcomponents
+                if c.name != "VTIMEZONE"
+            ]
+
+        await s._load()
+        expected = {
+            href: components(item) async for href, item, _ in s.get_multi(s._items)
+        }
+        fresh = self.storage_class(s.path)
+        hrefs = [href async for href, _ in fresh.list()]
+        actual = {
+            href: components(item) async for href, item, _ in fresh.get_multi(hrefs)
+        }
+        assert actual == expected
+        # The index of the file is still correct.
+        assert fresh._spans == s._spans
+
+    @pytest.mark.asyncio
+    async def test_incremental_writes(self, tmpdir):
+        path = str(tmpdir.join("cal.ics"))
+        tmpdir.join("cal.ics").write("")
+        s = self.storage_class(path)
+
+        a_href, a_etag = await s.upload(Item(EVENT_TEMPLATE.format(r=1, uid="a")))
+        await self._assert_file_contains(s)
+        inode = os.stat(path).st_ino
+
+        b_href, b_etag = await s.upload(
+            Item(EVENT_WITH_TIMEZONE_TEMPLATE.format(r=2, uid="b"))
+        )
+        await self._assert_file_contains(s)
+        # The file is replaced instead of changed in place.
+        assert os.stat(path).st_ino != inode
+        c_href, c_etag = await s.upload(
+            Item(EVENT_WITH_TIMEZONE_TEMPLATE.format(r=3, uid="c"))
+        )
+        await self._assert_file_contains(s)
+        # The timezone is only there once.
+        assert tmpdir.join("cal.ics").read().count("BEGIN:VTIMEZONE") == 1
+
+        a_etag = await s.update(
+            a_href, Item(EVENT_TEMPLATE.format(r=4, uid="a")), a_etag
+        )
+        await self._assert_file_contains(s)
+        await s.delete(b_href, b_etag)
+        await self._assert_file_contains(s)
+
+        async with s.at_once():
+            await s.delete(a_href, a_etag)
+            await s.update(c_href, Item(EVENT_TEMPLATE.format(r=5, uid="c")), c_etag)
+            await s.upload(Item(EVENT_TEMPLATE.format(r=6, uid="d")))
+        await self._assert_file_contains(s)
+        assert {href async for href, _ in s.list()} == {c_href, "d"}
+
+    @pytest.mark.asyncio
+    async def test_no_reparse_when_unchanged(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join("cal.ics"))
+        tmpdir.join("cal.ics").write("")
+        s = self.storage_class(path)
+        await s.upload(Item(EVENT_TEMPLATE.format(r=0, uid="0")))
+        await aiostream.stream.list(s.list())
+
+        lists = 0
+        orig_list = s.list
+
+        async def list():
+            nonlocal lists
+            lists += 1
+            async for x in orig_list():
+                yield x
+
+        monkeypatch.setattr(s, "list", list)
+        for i in range(1, 5):
+            await s.upload(Item(EVENT_TEMPLATE.format(r=i, uid=i)))
+        assert lists == 0
+        await self._assert_file_contains(s)
+
+        # Changes by other programs are still noticed.
+        tmpdir.join("cal.ics").write("", mode="a")
+        os.utime(path, ns=(0, 0))
+        await s.upload(Item(EVENT_TEMPLATE.format(r=5, uid=5)))
+        assert lists == 1
+
+    @pytest.mark.asyncio
+    async def test_new_wrapper_props_rewrite(self, tmpdir):
+        path = str(tmpdir.join("cal.ics"))
+        tmpdir.join("cal.ics").write("")
+        s = self.storage_class(path)
+        await s.upload(Item(EVENT_TEMPLATE.format(r=0, uid="0")))
+        await s.upload(
+            Item(
+                "BEGIN:VCALENDAR\r\nX-NEW:yes\r\n"
+                + BARE_EVENT_TEMPLATE.format(r=1, uid="1")
+                + "\r\nEND:VCALENDAR"
+            )
+        )
+        assert "X-NEW:yes" in tmpdir.join("cal.ics").read()
+        await self._assert_file_contains(s)
+
+    @pytest.mark.asyncio
+    async def test_modified_by_other_program(self, tmpdir):
+        path = str(tmpdir.join("cal.ics"))
+        tmpdir.join("cal.ics").write("")
+        s = self.storage_class(path)
+        async with s.at_once():
+            await s.upload(Item(EVENT_TEMPLATE.format(r=0, uid="0")))
+        with pytest.raises(exceptions.PreconditionFailed):
+            async with s.at_once():
+                await s.upload(Item(EVENT_TEMPLATE.format(r=1, uid="1")))
+                tmpdir.join("cal.ics").write("\r\n", mode="a")
+                os.utime(path, ns=(0, 0))
+
+    @pytest.mark.asyncio
+    async def test_persistent_index(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join("cal.ics"))
+        tmpdir.join("cal.ics").write("")
+        s = self.storage_class(path, persistent_index=True)
+        for i in range(3):
+            await s.upload(Item(EVENT_WITH_TIMEZONE_TEMPLATE.format(r=i, uid=i)))
+        await s.delete(*(await s.upload(Item(EVENT_TEMPLATE.format(r=3, uid=3)))))
+        assert tmpdir.join(".cal.ics.vdirsyncer-index").check()
+        expected = await aiostream.stream.list(
+            self.storage_class(path).get_multi("012")
+        )
+
+        def index_collection(*args):
+            raise AssertionError("The file was parsed.")
+
+        with monkeypatch.context() as m:
+            m.setattr(singlefile, "index_collection", index_collection)
+            fresh = self.storage_class(path, persistent_index=True)
+            assert await aiostream.stream.list(fresh.list()) == [
+                (href, etag) for href, _, etag in expected
+            ]
+            # Items are only read when they're needed.
+            assert all(item is None for item, _ in fresh._items.values())
+            actual = await aiostream.stream.list(fresh.get_multi("012"))
+            assert [(h, i.raw, e) for h, i, e in actual] == [
+                (h, i.raw, e) for h, i, e in expected
+            ]
+            await fresh.upload(Item(EVENT_TEMPLATE.format(r=4, uid=4)))
+            again = self.storage_class(path, persistent_index=True)
+            listed = await aiostream.stream.list(fresh.list())
+            assert await aiostream.stream.list(again.list()) == listed
+        await self._assert_file_contains(fresh)
+
+        # Changes by other programs are noticed.
+        tmpdir.join("cal.ics").write(EVENT_TEMPLATE.format(r=5, uid=5))
+        fresh = self.storage_class(path, persistent_index=True)
+        assert [href async for href, _ in fresh.list()] == ["5"]
+
+    @pytest.mark.asyncio
+    async def test_persistent_index_invalid(self, tmpdir):
+        path = str(tmpdir.join("cal.ics"))
+        tmpdir.join("cal.ics").write("")
+        s = self.storage_class(path, persistent_index=True)
+        href, etag = await s.upload(Item(EVENT_TEMPLATE.format(r=0, uid=0)))
+
+        tmpdir.join(".cal.ics.vdirsyncer-index").write("{")
+        fresh = self.storage_class(path, persistent_index=True)
+        assert await aiostream.stream.list(fresh.list()) == [(href, etag)]
+        # It was written again.
+        fresh = self.storage_class(path, persistent_index=True)
+        assert await aiostream.stream.list(fresh.list()) == [(href, etag)]
+        assert fresh._items[href][0] is None
@@ -281,3 +281,32 @@ def test_implicit_create_only(read_config):
     assert not errors
     pair = c.pairs["my_pair"]
     assert pair.implicit == "create"
+
+
+@pytest.mark.parametrize("value", ["0", "-3", "true", '"4"'])
+def test_invalid_max_workers(read_config, value):
+    with pytest.raises(exceptions.UserError) as excinfo:
+        read_config(
+            f"""
+            [general]
+            status_path = "/tmp/status/"
+
+            [pair my_pair]
+            a = "my_a"
+            b = "my_b"
+            collections = null
+            max_workers = {value}
+
+            [storage my_a]
+            type = "filesystem"
+            path = "{{base}}/path_a/"
+            fileext = ".txt"
+
+            [storage my_b]
+            type = "filesystem"
+            path = "{{base}}/path_b/"
+            fileext = ".txt"
+            """
+        )
+
+    assert "`max_workers` parameter must be" in str(excinfo.value)
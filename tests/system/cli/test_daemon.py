@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import asyncio
+from textwrap import dedent
+
+import pytest
+
+from vdirsyncer.cli import AppContext
+from vdirsyncer.cli.config import load_config
+from vdirsyncer.cli.daemon import Daemon
+from vdirsyncer.cli.daemon import next_delay
+
+
+@pytest.mark.parametrize(
+    ("failures", "rand", "expected"),
+    [
+        (0, 0.5, 60),
+        (0, 0.0, 54),
+        (0, 1.0, 66),
+        (2, 0.5, 240),
+        (10, 0.5, 600),
+    ],
+)
+def test_next_delay(failures, rand, expected):
+    delay = next_delay(60, failures, jitter=0.1, max_backoff=600, rand=lambda: rand)
+    assert delay == pytest.approx(expected)
+
+
+def test_next_delay_backoff_below_interval():
+    assert next_delay(60, 3, max_backoff=10) == 60
+
+
+PAIR = """
+[pair {0}]
+a = "{0}_a"
+b = "{0}_b"
+collections = null
+sync_interval = 0.01
+
+[storage {0}_a]
+type = "filesystem"
+path = "{1}/{0}_a/"
+fileext = ".txt"
+
+[storage {0}_b]
+type = "filesystem"
+path = "{1}/{0}_b/"
+fileext = ".txt"
+"""
+
+
+async def _wait_for(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out.")
+
+
+def test_daemon(tmpdir, runner):
+    one = dedent(PAIR).format("one", str(tmpdir))
+    two = dedent(PAIR).format("two", str(tmpdir))
+    for name in ("one_a", "one_b", "two_a", "two_b"):
+        tmpdir.mkdir(name)
+    runner.write_with_general(one + two)
+    result = runner.invoke(["discover"])
+    assert not result.exception
+    runner.write_with_general(one)
+
+    ctx = AppContext()
+    ctx.config_path = str(runner.cfg)
+    ctx.config = load_config(ctx.config_path)
+    d = Daemon(ctx, (), interval=3600, jitter=0)
+
+    async def main():
+        task = asyncio.ensure_future(d.run())
+        try:
+            tmpdir.join("one_a/haha.txt").write("UID:haha")
+            tmpdir.join("two_a/hoho.txt").write("UID:hoho")
+            await _wait_for(lambda: tmpdir.join("one_b/haha.txt").exists())
+
+            # A reload picks up the new pair.
+            runner.write_with_general(one + two)
+            d.reload()
+            await _wait_for(lambda: tmpdir.join("two_b/hoho.txt").exists())
+        finally:
+            d.stop()
+            await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+    assert set(ctx.config.pairs) == {"one", "two"}
+
+
+def test_daemon_pair_removed(tmpdir, runner):
+    one = dedent(PAIR).format("one", str(tmpdir))
+    two = dedent(PAIR).format("two", str(tmpdir))
+    for name in ("one_a", "one_b", "two_a", "two_b"):
+        tmpdir.mkdir(name)
+    runner.write_with_general(one + two)
+    result = runner.invoke(["discover"])
+    assert not result.exception
+
+    ctx = AppContext()
+    ctx.config_path = str(runner.cfg)
+    ctx.config = load_config(ctx.config_path)
+    d = Daemon(ctx, ("two",), interval=3600, jitter=0)
+    reloads = []
+    reload_config = d._reload_config
+
+    def count_reloads():
+        reloads.append(None)
+        reload_config()
+
+    d._reload_config = count_reloads
+
+    async def main():
+        task = asyncio.ensure_future(d.run())
+        try:
+            tmpdir.join("two_a/hoho.txt").write("UID:hoho")
+            await _wait_for(lambda: tmpdir.join("two_b/hoho.txt").exists())
+
+            # The daemon keeps running without any pair to sync, and waits
+            # for the next reload.
+            runner.write_with_general(one)
+            d.reload()
+            await _wait_for(lambda: "two" not in ctx.config.pairs)
+            await asyncio.sleep(0.1)
+            assert not task.done()
+            assert len(reloads) == 1
+        finally:
+            d.stop()
+            await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+
+
+def test_daemon_watch(tmpdir, runner):
+    one = dedent(PAIR).format("one", str(tmpdir))
+    one = one.replace("sync_interval = 0.01", "sync_interval = 3600")
+    for name in ("one_a", "one_b"):
+        tmpdir.mkdir(name)
+    runner.write_with_general(one)
+    result = runner.invoke(["discover"])
+    assert not result.exception
+
+    ctx = AppContext()
+    ctx.config_path = str(runner.cfg)
+    ctx.config = load_config(ctx.config_path)
+    d = Daemon(ctx, (), interval=3600, jitter=0, watch=True)
+    d.WATCH_DELAY = 0.01
+
+    async def main():
+        task = asyncio.ensure_future(d.run())
+        try:
+            # Wait for the first sync to attach the watcher.
+            await _wait_for(lambda: d._triggers and d._watcher._dirs)
+            tmpdir.join("one_a/haha.txt").write("UID:haha")
+            await _wait_for(lambda: tmpdir.join("one_b/haha.txt").exists())
+            tmpdir.join("one_b/hoho.txt").write("UID:hoho")
+            await _wait_for(lambda: tmpdir.join("one_a/hoho.txt").exists())
+        finally:
+            d.stop()
+            await asyncio.wait_for(task, 5)
+
+    asyncio.run(main())
+
+
+def test_daemon_unknown_pair(runner):
+    runner.write_with_general("")
+    result = runner.invoke(["daemon", "foo"])
+    assert result.exception
+    assert "pair foo does not exist." in result.output.lower()
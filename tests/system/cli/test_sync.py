@@ -577,3 +577,145 @@ def test_fetch_only_necessary_params(tmpdir, runner):
     r = runner.invoke(["sync", "bambar"])
     assert not r.exception
     assert fetched()
+
+
+def test_dry_run(tmpdir, runner):
+    runner.write_with_general(
+        dedent(
+            """
+    [pair my_pair]
+    a = "my_a"
+    b = "my_b"
+    collections = null
+
+    [storage my_a]
+    type = "filesystem"
+    path = "{0}/path_a/"
+    fileext = ".txt"
+
+    [storage my_b]
+    type = "filesystem"
+    path = "{0}/path_b/"
+    fileext = ".txt"
+    """
+        ).format(str(tmpdir))
+    )
+
+    tmpdir.mkdir("path_a")
+    tmpdir.mkdir("path_b")
+    tmpdir.join("path_a/haha.txt").write("UID:haha")
+    tmpdir.join("path_b/hoho.txt").write("UID:hoho")
+
+    result = runner.invoke(["discover"])
+    assert not result.exception
+
+    result = runner.invoke(["sync", "--dry-run"])
+    assert not result.exception
+    assert "my_b: 1 to upload, 0 to update, 0 to delete, ~8 bytes" in result.output
+    assert not tmpdir.join("path_b/haha.txt").exists()
+    assert not tmpdir.join("status/my_pair.items").exists()
+
+    result = runner.invoke(["sync", "--dry-run", "--plan"])
+    assert not result.exception
+    (plan,) = json.loads(result.stdout)
+    assert plan["pair"] == "my_pair"
+    assert plan["collection"] is None
+    assert plan["upload"] == {"a": 1, "b": 1}
+    assert plan["bytes"] == {"a": 8, "b": 8}
+    assert plan["conflict"] == 0
+
+    result = runner.invoke(["sync", "--plan"])
+    assert result.exception
+    assert "--plan requires --dry-run" in result.output
+
+    result = runner.invoke(["sync"])
+    assert not result.exception
+    assert tmpdir.join("path_b/haha.txt").exists()
+
+    # The status is read, but not written.
+    status = tmpdir.join("status/my_pair.items").read_binary()
+    tmpdir.join("path_a/haha.txt").remove()
+    result = runner.invoke(["sync", "--dry-run", "--plan"])
+    (plan,) = json.loads(result.stdout)
+    assert plan["delete"] == {"a": 0, "b": 1}
+    result = runner.invoke(["sync", "--dry-run", "--plan"])
+    (plan,) = json.loads(result.stdout)
+    assert plan["delete"] == {"a": 0, "b": 1}
+    assert tmpdir.join("status/my_pair.items").read_binary() == status
+
+
+def test_dry_run_item_cache(tmpdir, runner):
+    runner.cfg.write(
+        dedent(
+            """
+    [general]
+    status_path = "{0}/status/"
+    item_cache_size = 1
+
+    [pair my_pair]
+    a = "my_a"
+    b = "my_b"
+    collections = null
+
+    [storage my_a]
+    type = "filesystem"
+    path = "{0}/path_a/"
+    fileext = ".txt"
+
+    [storage my_b]
+    type = "filesystem"
+    path = "{0}/path_b/"
+    fileext = ".txt"
+    """
+        ).format(str(tmpdir))
+    )
+    tmpdir.mkdir("path_a").join("haha.txt").write("UID:haha")
+    tmpdir.mkdir("path_b")
+    assert not runner.invoke(["discover"]).exception
+
+    result = runner.invoke(["sync", "--dry-run"])
+    assert not result.exception
+    assert not tmpdir.join("status/item_cache").exists()
+
+    result = runner.invoke(["sync"])
+    assert not result.exception
+    assert tmpdir.join("status/item_cache").exists()
+
+
+def test_failing_pair_doesnt_stop_others(tmpdir, runner):
+    runner.write_with_general(
+        dedent(
+            """
+    [pair broken]
+    a = "my_a"
+    b = "my_b"
+    collections = ["foo"]
+
+    [pair my_pair]
+    a = "my_a"
+    b = "my_b"
+    collections = null
+
+    [storage my_a]
+    type = "filesystem"
+    path = "{0}/path_a/"
+    fileext = ".txt"
+
+    [storage my_b]
+    type = "filesystem"
+    path = "{0}/path_b/"
+    fileext = ".txt"
+    """
+        ).format(str(tmpdir))
+    )
+
+    tmpdir.mkdir("path_a")
+    tmpdir.mkdir("path_b")
+    tmpdir.join("path_a/haha.txt").write("UID:haha")
+
+    result = runner.invoke(["discover", "my_pair"])
+    assert not result.exception
+
+    result = runner.invoke(["sync", "broken", "my_pair"])
+    assert result.exception
+    assert tmpdir.join("path_b/haha.txt").read() == "UID:haha"
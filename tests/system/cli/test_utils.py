@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
+
 import pytest
 
 from vdirsyncer import exceptions
+from vdirsyncer.cli.utils import CollectionLimiter
 from vdirsyncer.cli.utils import handle_cli_error
 from vdirsyncer.cli.utils import storage_instance_from_config
 from vdirsyncer.cli.utils import storage_names
@@ -29,3 +32,39 @@ async def test_storage_instance_from_config(monkeypatch, aio_connector):
     config = {"type": "lol", "foo": "bar", "baz": 1}
     storage = await storage_instance_from_config(config, connector=aio_connector)
     assert isinstance(storage, Dummy)
+
+
+@pytest.mark.asyncio
+async def test_collection_limiter():
+    limiter = CollectionLimiter(max_total=3, max_per_host=2)
+    running = []
+    started = []
+    peak = {"total": 0, "a": 0}
+
+    async def job(name, host):
+        started.append(name)
+        running.append(host)
+        peak["total"] = max(peak["total"], len(running))
+        peak["a"] = max(peak["a"], running.count("a"))
+        await asyncio.sleep(0.01)
+        running.remove(host)
+        return name
+
+    jobs = [(f"a{i}", "a") for i in range(4)] + [("b0", "b"), ("b1", "b")]
+    rv = await asyncio.gather(
+        *(
+            limiter.run({host}, lambda name=name, host=host: job(name, host))
+            for name, host in jobs
+        )
+    )
+
+    assert rv == [name for name, _host in jobs]
+    assert peak == {"total": 3, "a": 2}
+    # The jobs of host "b" didn't have to wait for all jobs of host "a".
+    assert started[:3] == ["a0", "a1", "b0"]
+
+
+@pytest.mark.parametrize("value", [0, -1, True, "4"])
+def test_collection_limiter_invalid(value):
+    with pytest.raises(exceptions.UserError):
+        CollectionLimiter.from_general({"sync_concurrency": value})
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import contextlib
+
+from vdirsyncer.sync.cache import ItemCache
+from vdirsyncer.vobject import Item
+
+
+def test_get_many(tmp_path):
+    path = str(tmp_path / "cache")
+    item = Item("UID:1")
+    with contextlib.closing(ItemCache(path, max_size=1024 * 1024)) as cache:
+        cache.put_many("foo", [("1.ics", "etag1", None, item)])
+
+    with contextlib.closing(ItemCache(path, max_size=1024 * 1024)) as cache:
+        assert not cache.get_many("bar", [("1.ics", "etag1", None)])
+        assert not cache.get_many("foo", [("1.ics", "etag2", None)])
+        ((href, (ident, hash, cached)),) = cache.get_many(
+            "foo", [("1.ics", "etag1", None)]
+        ).items()
+        assert (href, ident, hash) == ("1.ics", item.ident, item.hash)
+        assert cached.raw == item.raw
+
+
+def test_without_bodies(tmp_path):
+    item = Item("UID:1")
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024, store_bodies=False)
+    ) as cache:
+        cache.put_many("foo", [("1.ics", "etag1", None, item)])
+        assert cache.get_many("foo", [("1.ics", "etag1", None)]) == {
+            "1.ics": (item.ident, item.hash, None)
+        }
+
+
+def test_new_etag_replaces_entry(tmp_path):
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024)
+    ) as cache:
+        cache.put_many("foo", [("1.ics", "etag1", None, Item("UID:1"))])
+        cache.put_many("foo", [("1.ics", "etag2", None, Item("UID:1\nX:2"))])
+        assert not cache.get_many("foo", [("1.ics", "etag1", None)])
+        assert cache.get_many("foo", [("1.ics", "etag2", None)])
+
+
+def test_lru_eviction(tmp_path):
+    items = [
+        (f"{i}.ics", "etag", None, Item(f"UID:{i}\nX:{'x' * 100}")) for i in range(3)
+    ]
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024)
+    ) as cache:
+        for item in items:
+            cache.put_many("foo", [item])
+        # Make the first item the most recently used one.
+        assert cache.get_many("foo", [("0.ics", "etag", None)])
+
+        (size,) = cache._c.execute("SELECT MAX(size) FROM items").fetchone()
+        cache.max_size = 3 * size
+        cache.put_many("foo", [("3.ics", "etag", None, Item(f"UID:3\nX:{'x' * 100}"))])
+
+        hrefs = [href for href, _etag, _fingerprint, _item in items] + ["3.ics"]
+        cached = cache.get_many("foo", [(href, "etag", None) for href in hrefs])
+        assert set(cached) == {"0.ics", "3.ics"}
+
+
+def test_fingerprint(tmp_path):
+    item = Item("UID:1")
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024)
+    ) as cache:
+        cache.put_many("foo", [("1.ics", "etag1", "fp1", item)])
+        assert not cache.get_many("foo", [("1.ics", "etag2", "fp2")])
+        assert cache.get_many("foo", [("1.ics", "etag2", "fp1")])
+        # The new etag was remembered.
+        assert cache.get_many("foo", [("1.ics", "etag2", None)])
+        assert not cache.get_many("foo", [("1.ics", "etag1", None)])
+
+
+def test_store_bodies_per_call(tmp_path):
+    item = Item("UID:1")
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024)
+    ) as cache:
+        cache.put_many("foo", [("1.ics", "etag1", None, item)], store_bodies=False)
+        assert cache.get_many("foo", [("1.ics", "etag1", None)]) == {
+            "1.ics": (item.ident, item.hash, None)
+        }
+
+
+def test_discards_other_versions(tmp_path):
+    path = str(tmp_path / "cache")
+    with contextlib.closing(ItemCache(path, max_size=1024 * 1024)) as cache:
+        cache.put_many("foo", [("1.ics", "etag1", None, Item("UID:1"))])
+    ItemCache.SCHEMA_VERSION += 1
+    try:
+        with contextlib.closing(ItemCache(path, max_size=1024 * 1024)) as cache:
+            assert not cache.get_many("foo", [("1.ics", "etag1", None)])
+    finally:
+        ItemCache.SCHEMA_VERSION -= 1
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 import contextlib
+import sqlite3
 
 import hypothesis.strategies as st
+import pytest
 from hypothesis import assume
 from hypothesis import given
 
+from vdirsyncer.sync.exceptions import IdentAlreadyExists
+from vdirsyncer.sync.status import ItemMetadata
 from vdirsyncer.sync.status import SqliteStatus
 
 status_dict_strategy = st.dictionaries(
@@ -36,3 +40,177 @@ def test_legacy_status(status_dict):
             assert meta2_a.to_status() == meta_a
             assert meta2_b.to_status() == meta_b
             assert ident_a == ident_b == ident
+
+
+def test_insert_many():
+    with contextlib.closing(SqliteStatus()) as status:
+        with status.transaction():
+            status.insert_many_a(
+                (str(i), ItemMetadata(href=f"a{i}", hash=str(i), etag="x"))
+                for i in range(1000)
+            )
+            status.insert_many_b(
+                (str(i), ItemMetadata(href=f"b{i}", hash=str(i), etag="y"))
+                for i in range(600)
+            )
+            assert status.get_new_a("700").href == "a700"
+            assert status.get_new_b("700") is None
+
+            status.insert_many_b(
+                (str(i), ItemMetadata(href=f"b{i}", hash=str(i), etag="y"))
+                for i in range(600, 1000)
+            )
+
+        assert len(list(status.iter_old())) == 1000
+        assert status.get_a("700").href == "a700"
+        assert status.get_b("700").href == "b700"
+        assert status.get_b("700").etag == "y"
+
+
+def test_insert_many_ident_conflict():
+    with contextlib.closing(SqliteStatus()) as status, status.transaction():
+        status.insert_many_a([("1", ItemMetadata(href="a1", hash="1"))])
+
+        with pytest.raises(IdentAlreadyExists) as excinfo:
+            status.insert_many_a(
+                [
+                    ("2", ItemMetadata(href="a2", hash="2")),
+                    ("1", ItemMetadata(href="a1-2", hash="1")),
+                ]
+            )
+        assert excinfo.value.old_href == "a1"
+        assert excinfo.value.new_href == "a1-2"
+
+        with pytest.raises(IdentAlreadyExists) as excinfo:
+            status.insert_many_b(
+                [
+                    ("2", ItemMetadata(href="b2", hash="2")),
+                    ("2", ItemMetadata(href="b2-2", hash="2")),
+                ]
+            )
+        assert excinfo.value.old_href == "b2"
+        assert excinfo.value.new_href == "b2-2"
+
+        # The ident only exists on side A so far.
+        status.insert_many_b([("1", ItemMetadata(href="b1", hash="1"))])
+
+
+def _count_status_writes(status):
+    status._c.execute("CREATE TEMP TABLE writes (ident TEXT)")
+    for event, row in (("INSERT", "new"), ("DELETE", "old")):
+        status._c.execute(
+            f"CREATE TEMP TRIGGER count_{event} AFTER {event} ON main.status "
+            f"BEGIN INSERT INTO writes VALUES ({row}.ident); END"
+        )
+
+    def get():
+        return {r["ident"] for r in status._c.execute("SELECT ident FROM writes")}
+
+    return get
+
+
+def test_commit_only_writes_changed_rows():
+    def meta(i, side, etag="x"):
+        return ItemMetadata(href=f"{side}{i}", hash=str(i), etag=etag)
+
+    with contextlib.closing(SqliteStatus()) as status:
+        with status.transaction():
+            status.insert_many_a((str(i), meta(i, "a")) for i in range(100))
+            status.insert_many_b((str(i), meta(i, "b")) for i in range(100))
+
+        written = _count_status_writes(status)
+        with status.transaction():
+            status.insert_many_a(
+                (str(i), meta(i, "a", etag="y" if i == 5 else "x")) for i in range(99)
+            )
+            status.insert_many_b((str(i), meta(i, "b")) for i in range(99))
+
+        assert written() == {"5", "99"}
+        assert len(list(status.iter_old())) == 99
+        assert status.get_a("5").etag == "y"
+        assert status.get_a("6").etag == "x"
+
+
+def test_migrate_from_v1(tmpdir):
+    path = str(tmpdir.join("status"))
+    with contextlib.closing(sqlite3.connect(path)) as c:
+        c.executescript(
+            """
+            CREATE TABLE meta ( "version" INTEGER PRIMARY KEY );
+            INSERT INTO meta (version) VALUES (1);
+            CREATE TABLE status (
+                "ident" TEXT PRIMARY KEY NOT NULL,
+                "href_a" TEXT, "href_b" TEXT,
+                "hash_a" TEXT NOT NULL, "hash_b" TEXT NOT NULL,
+                "etag_a" TEXT, "etag_b" TEXT
+            );
+            CREATE UNIQUE INDEX by_href_a ON status(href_a);
+            CREATE UNIQUE INDEX by_href_b ON status(href_b);
+            CREATE TABLE new_status (
+                "ident" TEXT PRIMARY KEY NOT NULL,
+                "href_a" TEXT, "href_b" TEXT,
+                "hash_a" TEXT, "hash_b" TEXT,
+                "etag_a" TEXT, "etag_b" TEXT
+            );
+            INSERT INTO status VALUES ('1', 'a1', 'b1', 'h', 'h', 'ea', 'eb');
+            """
+        )
+
+    with contextlib.closing(SqliteStatus(path)) as status:
+        assert status.get_a("1").etag == "ea"
+        assert status.get_b("1").href == "b1"
+        status.set_sync_token_a("token")
+
+    with contextlib.closing(sqlite3.connect(path)) as c:
+        assert c.execute("SELECT version FROM meta").fetchall() == [(2,)]
+        tables = {r[0] for r in c.execute("SELECT name FROM sqlite_master")}
+        assert "new_status" not in tables
+        assert "collection_state" in tables
+
+    with contextlib.closing(SqliteStatus(path)) as status:
+        assert status.get_sync_token_a() == "token"
+        assert dict(status.to_legacy_status()) == {
+            "1": (
+                {"href": "a1", "hash": "h", "etag": "ea"},
+                {"href": "b1", "hash": "h", "etag": "eb"},
+            )
+        }
+
+
+def test_copy_from_doesnt_migrate(tmpdir):
+    path = str(tmpdir.join("status"))
+    with contextlib.closing(sqlite3.connect(path)) as c:
+        c.executescript(
+            """
+            CREATE TABLE meta ( "version" INTEGER PRIMARY KEY );
+            INSERT INTO meta (version) VALUES (1);
+            CREATE TABLE status (
+                "ident" TEXT PRIMARY KEY NOT NULL,
+                "href_a" TEXT, "href_b" TEXT,
+                "hash_a" TEXT NOT NULL, "hash_b" TEXT NOT NULL,
+                "etag_a" TEXT, "etag_b" TEXT
+            );
+            INSERT INTO status VALUES ('1', 'a1', 'b1', 'h', 'h', 'ea', 'eb');
+            """
+        )
+    before = tmpdir.join("status").read_binary()
+
+    with contextlib.closing(SqliteStatus(copy_from=path)) as status:
+        assert status.get_a("1").etag == "ea"
+        status.set_sync_token_a("token")
+
+    assert tmpdir.join("status").read_binary() == before
+
+
+def test_load_snapshot():
+    with contextlib.closing(SqliteStatus()) as status:
+        with status.transaction():
+            status.insert_ident_a("1", ItemMetadata(href="a1", hash="h1", etag="e"))
+            status.insert_ident_b("1", ItemMetadata(href="b1", hash="h1", etag="f"))
+
+        with status.transaction():
+            status.insert_ident_b("2", ItemMetadata(href="b2", hash="h2", etag="g"))
+            old, new = status.load_snapshot()
+            assert old == {"1": ("h1", "e", "h1", "f")}
+            assert new == {"2": (None, None, "h2", "g")}
+            status.insert_ident_a("2", ItemMetadata(href="a2", hash="h2", etag="h"))
@@ -14,9 +14,12 @@ from hypothesis.stateful import rule
 
 from tests import blow_up
 from tests import uid_strategy
+from vdirsyncer import exceptions
 from vdirsyncer.storage.memory import MemoryStorage
 from vdirsyncer.storage.memory import _random_string
+from vdirsyncer.sync import _StorageInfo
 from vdirsyncer.sync import sync as _sync
+from vdirsyncer.sync.cache import ItemCache
 from vdirsyncer.sync.exceptions import BothReadOnly
 from vdirsyncer.sync.exceptions import IdentConflict
 from vdirsyncer.sync.exceptions import PartialSync
@@ -623,6 +626,7 @@ class SyncMachine(RuleBasedStateMachine):
         partial_sync=st.one_of(
             (st.just("ignore"), st.just("revert"), st.just("error"))
         ),
+        max_workers=st.integers(min_value=1, max_value=3),
     )
     def sync(
         self,
@@ -633,6 +637,7 @@ class SyncMachine(RuleBasedStateMachine):
         conflict_resolution,
         with_error_callback,
         partial_sync,
+        max_workers,
     ):
         async def inner():
             assume(a is not b)
@@ -658,6 +663,7 @@ class SyncMachine(RuleBasedStateMachine):
                         conflict_resolution=conflict_resolution,
                         error_callback=error_callback,
                         partial_sync=partial_sync,
+                        max_workers=max_workers,
                     )
 
                 for e in errors:
@@ -696,9 +702,10 @@ class SyncMachine(RuleBasedStateMachine):
 TestSyncMachine = SyncMachine.TestCase
 
 
+@pytest.mark.parametrize("max_workers", [1, 4])
 @pytest.mark.parametrize("error_callback", [True, False])
 @pytest.mark.asyncio
-async def test_rollback(error_callback):
+async def test_rollback(error_callback, max_workers):
     a = MemoryStorage()
     b = MemoryStorage()
     status = {}
@@ -717,6 +724,7 @@ async def test_rollback(error_callback):
             status=status,
             conflict_resolution="a wins",
             error_callback=errors.append,
+            max_workers=max_workers,
         )
 
         assert len(errors) == 1
@@ -726,7 +734,73 @@ async def test_rollback(error_callback):
         assert status["1"]
     else:
         with pytest.raises(ActionIntentionallyFailed):
-            await sync(a, b, status=status, conflict_resolution="a wins")
+            await sync(
+                a,
+                b,
+                status=status,
+                conflict_resolution="a wins",
+                max_workers=max_workers,
+            )
+
+
+@pytest.mark.asyncio
+async def test_concurrent_actions():
+    a = MemoryStorage()
+    b = MemoryStorage()
+    status = {}
+
+    for i in range(10):
+        await a.upload(Item(f"UID:{i}"))
+
+    in_flight = 0
+    max_in_flight = 0
+    old_upload = b.upload
+
+    async def upload(item):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0)
+        try:
+            return await old_upload(item)
+        finally:
+            in_flight -= 1
+
+    b.upload = upload
+
+    await sync(a, b, status, max_workers=3)
+    assert max_in_flight == 3
+    assert items(a) == items(b)
+    assert len(status) == 10
+
+
+@pytest.mark.asyncio
+async def test_concurrent_actions_stop_after_error():
+    a = MemoryStorage()
+    b = MemoryStorage()
+    status = {}
+
+    for i in range(10):
+        await a.upload(Item(f"UID:{i}"))
+
+    started = []
+    old_upload = b.upload
+
+    async def upload(item):
+        started.append(item.ident)
+        await asyncio.sleep(0)
+        if item.ident == "0":
+            raise ActionIntentionallyFailed
+        return await old_upload(item)
+
+    b.upload = upload
+
+    with pytest.raises(ActionIntentionallyFailed):
+        await sync(a, b, status, max_workers=2)
+
+    # The second worker finished its item, but no further items were started.
+    assert len(started) < 10
+    assert len(b.items) == len(started) - 1
 
 
 @pytest.mark.asyncio
@@ -745,3 +819,396 @@ async def test_duplicate_hrefs():
     await sync(a, b, status)
     with pytest.raises(AssertionError):
         await sync(a, b, status)
+
+
+class SyncTokenStorage(MemoryStorage):
+    """A MemoryStorage that keeps a journal of changed hrefs, so it can list
+    changes incrementally."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.journal = []
+
+    async def get_sync_token(self):
+        return str(len(self.journal))
+
+    async def list_changes(self, sync_token):
+        for href in set(self.journal[int(sync_token) :]):
+            etag, _item = self.items.get(href, (None, None))
+            yield href, etag
+
+    async def upload(self, item):
+        href, etag = await super().upload(item)
+        self.journal.append(href)
+        return href, etag
+
+    async def update(self, href, item, etag):
+        etag = await super().update(href, item, etag)
+        self.journal.append(href)
+        return etag
+
+    async def delete(self, href, etag):
+        await super().delete(href, etag)
+        self.journal.append(href)
+
+
+@pytest.mark.asyncio
+async def test_sync_token():
+    a = SyncTokenStorage()
+    b = MemoryStorage()
+    href_a, etag_a = await a.upload(Item("UID:1"))
+    await a.upload(Item("UID:2"))
+
+    with contextlib.closing(SqliteStatus()) as status:
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1", "UID:2"}
+        assert status.get_sync_token_a() == "2"
+        assert status.get_sync_token_b() is None
+
+        a.list = blow_up
+        await a.update(href_a, Item("UID:1\nupdated"), etag_a)
+        await a.upload(Item("UID:3"))
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1\nupdated", "UID:2", "UID:3"}
+        assert status.get_sync_token_a() == "4"
+
+        ((href_b, etag_b),) = [
+            (href, etag) async for href, etag in b.list() if href == "2"
+        ]
+        await b.delete(href_b, etag_b)
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1\nupdated", "UID:3"}
+        assert status.get_sync_token_a() == "4"
+
+        # No changes since the last sync: nothing is fetched from A.
+        a.get_multi = blow_up
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1\nupdated", "UID:3"}
+
+
+@pytest.mark.asyncio
+async def test_invalid_sync_token():
+    a = SyncTokenStorage()
+    b = MemoryStorage()
+    await a.upload(Item("UID:1"))
+
+    with contextlib.closing(SqliteStatus()) as status:
+        await _sync(a, b, status)
+
+        async def list_changes(sync_token):
+            raise exceptions.InvalidSyncToken("expired")
+            yield
+
+        a.list_changes = list_changes
+        await a.upload(Item("UID:2"))
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1", "UID:2"}
+        assert status.get_sync_token_a() == "2"
+
+
+@pytest.mark.asyncio
+async def test_sync_token_kept_after_rollback():
+    a = SyncTokenStorage()
+    b = MemoryStorage()
+    await a.upload(Item("UID:1"))
+
+    with contextlib.closing(SqliteStatus()) as status:
+        await _sync(a, b, status)
+        assert status.get_sync_token_a() == "1"
+
+        await a.upload(Item("UID:2"))
+        old_upload = b.upload
+        b.upload = action_failure
+        errors = []
+        await _sync(a, b, status, error_callback=errors.append)
+        assert len(errors) == 1
+        assert status.get_sync_token_a() == "1"
+
+        # The failed item is picked up again, although the storage only lists
+        # changes since the old token.
+        b.upload = old_upload
+        a.list = blow_up
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1", "UID:2"}
+        assert status.get_sync_token_a() == "2"
+
+
+@pytest.mark.asyncio
+async def test_unpublished_item_dropped_from_status():
+    a = SyncTokenStorage()
+    b = MemoryStorage()
+    await a.upload(Item("UID:1"))
+    await a.upload(Item("UID:2"))
+
+    def pop_publish_conflicts():
+        # Like a filesystem storage, where another file was created at the
+        # path of this item before the end of `at_once`.
+        b.items.pop("1")
+        return ["1"]
+
+    b.pop_publish_conflicts = pop_publish_conflicts
+    with contextlib.closing(SqliteStatus()) as status:
+        await _sync(a, b, status)
+        assert status.get_a("1") is None
+        assert status.get_a("2") is not None
+        assert status.get_sync_token_a() is None
+
+        del b.pop_publish_conflicts
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1", "UID:2"}
+        assert status.get_sync_token_a() == "2"
+
+
+class CTagStorage(MemoryStorage):
+    """A MemoryStorage whose ctag changes with every write."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.writes = 0
+
+    async def get_ctag(self):
+        return str(self.writes)
+
+    async def upload(self, item):
+        self.writes += 1
+        return await super().upload(item)
+
+    async def update(self, href, item, etag):
+        self.writes += 1
+        return await super().update(href, item, etag)
+
+    async def delete(self, href, etag):
+        self.writes += 1
+        await super().delete(href, etag)
+
+
+@pytest.mark.asyncio
+async def test_ctag():
+    a = CTagStorage()
+    b = CTagStorage()
+    await a.upload(Item("UID:1"))
+
+    with contextlib.closing(SqliteStatus()) as status:
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1"}
+        # The ctag is obtained before the upload to B, so B is listed again
+        # during the next sync.
+        assert status.get_ctag_a() == "1"
+        assert status.get_ctag_b() == "0"
+        await _sync(a, b, status)
+        assert status.get_ctag_b() == "1"
+
+        # Neither storage is listed if nothing changed.
+        old_list_a, old_list_b = a.list, b.list
+        a.list = b.list = blow_up
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1"}
+
+        # Only the changed storage is listed.
+        b.list = old_list_b
+        await b.upload(Item("UID:2"))
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1", "UID:2"}
+        assert status.get_ctag_a() == "1"
+        assert status.get_ctag_b() == "2"
+
+        a.list = old_list_a
+        await _sync(a, b, status)
+        assert status.get_ctag_a() == "2"
+
+        b.list = blow_up
+        ((href, etag),) = [(href, etag) async for href, etag in a.list() if href == "1"]
+        await a.delete(href, etag)
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:2"}
+
+
+@pytest.mark.asyncio
+async def test_ctag_kept_after_rollback():
+    a = CTagStorage()
+    b = MemoryStorage()
+    await a.upload(Item("UID:1"))
+
+    with contextlib.closing(SqliteStatus()) as status:
+        await _sync(a, b, status)
+        await a.upload(Item("UID:2"))
+
+        old_upload = b.upload
+        b.upload = action_failure
+        errors = []
+        await _sync(a, b, status, error_callback=errors.append)
+        assert len(errors) == 1
+        assert status.get_ctag_a() == "1"
+
+        b.upload = old_upload
+        await _sync(a, b, status)
+        assert items(a) == items(b) == {"UID:1", "UID:2"}
+
+
+@pytest.mark.asyncio
+async def test_prefetch_while_listing(monkeypatch):
+    monkeypatch.setattr(_StorageInfo, "prefetch_batch_size", 2)
+    events = []
+
+    class JournalingStorage(MemoryStorage):
+        async def list(self):
+            async for href, etag in super().list():
+                events.append("list")
+                await asyncio.sleep(0)
+                yield href, etag
+
+        async def get_multi(self, hrefs):
+            events.append(("fetch", len(hrefs)))
+            async for rv in super().get_multi(hrefs):
+                yield rv
+
+    a = JournalingStorage()
+    b = MemoryStorage()
+    for i in range(5):
+        await a.upload(Item(f"UID:{i}"))
+
+    await sync(a, b, {})
+    assert items(b) == {f"UID:{i}" for i in range(5)}
+    assert sorted(e for e in events if e != "list") == [
+        ("fetch", 1),
+        ("fetch", 2),
+        ("fetch", 2),
+    ]
+    # The first batch is fetched before the listing is done.
+    assert events.index(("fetch", 2)) < len(events) - 1 - events[::-1].index("list")
+
+
+@pytest.mark.asyncio
+async def test_prepare_both_sides_concurrently():
+    listing = {"a": asyncio.Event(), "b": asyncio.Event()}
+
+    class WaitingStorage(MemoryStorage):
+        def __init__(self, side, other, **kwargs):
+            super().__init__(**kwargs)
+            self.side = side
+            self.other = other
+
+        async def list(self):
+            listing[self.side].set()
+            # Deadlocks if the other side isn't listed at the same time.
+            await asyncio.wait_for(listing[self.other].wait(), timeout=5)
+            async for rv in super().list():
+                yield rv
+
+    a = WaitingStorage("a", "b")
+    b = WaitingStorage("b", "a")
+    await a.upload(Item("UID:1"))
+    await sync(a, b, {})
+    assert items(b) == {"UID:1"}
+
+
+@pytest.mark.asyncio
+async def test_dry_run():
+    a = MemoryStorage()
+    b = MemoryStorage()
+    await a.upload(Item("UID:1"))
+    href_b, etag_b = await b.upload(Item("UID:2"))
+
+    status = {}
+    await sync(a, b, status)
+    await a.upload(Item("UID:3"))
+    await b.update(href_b, Item("UID:2\nupdated"), etag_b)
+    old_status = deepcopy(status)
+
+    a.upload = a.update = a.delete = blow_up
+    b.upload = b.update = b.delete = blow_up
+    with contextlib.closing(SqliteStatus()) as new_status:
+        new_status.load_legacy_status(status)
+        plan = await _sync(a, b, new_status, dry_run=True)
+        assert dict(new_status.to_legacy_status()) == old_status
+
+    assert plan == {
+        "upload": {"a": 0, "b": 1},
+        "update": {"a": 1, "b": 0},
+        "delete": {"a": 0, "b": 0},
+        "conflict": 0,
+        "bytes": {"a": len("UID:2\nupdated"), "b": len("UID:3")},
+    }
+
+
+@pytest.mark.asyncio
+async def test_item_cache_after_status_loss(tmp_path):
+    a = MemoryStorage(instance_name="a")
+    b = MemoryStorage(instance_name="b")
+    await a.upload(Item("UID:1"))
+    await b.upload(Item("UID:2"))
+
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024)
+    ) as cache:
+        await sync(a, b, {}, item_cache=cache)
+
+        # Every item was either downloaded or uploaded, so after losing the
+        # status nothing has to be downloaded again.
+        a.get = a.get_multi = b.get = b.get_multi = blow_up
+        status = {}
+        await sync(a, b, status, item_cache=cache)
+
+    assert set(status) == {"1", "2"}
+    assert items(a) == items(b) == {"UID:1", "UID:2"}
+
+
+@pytest.mark.asyncio
+async def test_item_cache_without_bodies(tmp_path):
+    a = MemoryStorage(instance_name="a")
+    b = MemoryStorage(instance_name="b")
+    await a.upload(Item("UID:1"))
+    await a.upload(Item("UID:2"))
+
+    with contextlib.closing(
+        ItemCache(str(tmp_path / "cache"), max_size=1024 * 1024, store_bodies=False)
+    ) as cache:
+        await sync(a, b, {}, item_cache=cache)
+        await b.delete("2", b.items["2"][0])
+
+        fetched = []
+        old_get_multi = a.get_multi
+
+        def get_multi(hrefs):
+            fetched.extend(hrefs)
+            return old_get_multi(hrefs)
+
+        a.get_multi = get_multi
+        b.get = b.get_multi = blow_up
+        await sync(a, b, {}, item_cache=cache)
+
+    # Only the item that is copied to b has to be downloaded.
+    assert fetched == ["2"]
+    assert items(b) == {"UID:1", "UID:2"}
+
+
+class FingerprintStorage(MemoryStorage):
+    async def get_fingerprints(self, hrefs):
+        for href in hrefs:
+            _etag, item = self.items[href]
+            yield href, item.hash
+
+
+@pytest.mark.parametrize("store_bodies", [True, False])
+@pytest.mark.asyncio
+async def test_item_cache_fingerprints(tmp_path, store_bodies):
+    a = FingerprintStorage(instance_name="a")
+    b = MemoryStorage(instance_name="b")
+    href, _etag = await a.upload(Item("UID:1"))
+    await a.upload(Item("UID:2"))
+
+    status = {}
+    with contextlib.closing(
+        ItemCache(
+            str(tmp_path / "cache"), max_size=1024 * 1024, store_bodies=store_bodies
+        )
+    ) as cache:
+        await sync(a, b, status, item_cache=cache)
+
+        # Only the etag changes.
+        a.items[href] = ("new etag", a.items[href][1])
+        a.get = a.get_multi = b.get = b.get_multi = blow_up
+        await sync(a, b, status, item_cache=cache)
+
+    assert status["1"][0]["etag"] == "new etag"
+    assert items(b) == {"UID:1", "UID:2"}
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from vdirsyncer.watch import DirectoryWatcher
+
+
+async def _wait_for(predicate):
+    for _ in range(500):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out.")
+
+
+@pytest_asyncio.fixture(params=[True, False], ids=["inotify", "polling"])
+async def watcher(request):
+    changed = []
+    w = DirectoryWatcher(
+        on_change=changed.append, poll_interval=0.01, use_inotify=request.param
+    )
+    w.changed_paths = changed
+    yield w
+    w.close()
+
+
+@pytest.mark.asyncio
+async def test_changes_since(watcher, tmpdir):
+    tmpdir.join("old.txt").write("old")
+    tmpdir.join("removed.txt").write("removed")
+    watcher.watch(str(tmpdir))
+    token = watcher.get_token(str(tmpdir))
+    assert watcher.changes_since(str(tmpdir), token) == set()
+
+    tmpdir.join("old.txt").write("changed old", mode="a")
+    tmpdir.join("new.txt").write("new")
+    tmpdir.join("removed.txt").remove()
+    await _wait_for(lambda: str(tmpdir) in watcher.changed_paths)
+    await _wait_for(lambda: len(watcher.changes_since(str(tmpdir), token)) == 3)
+    assert watcher.changes_since(str(tmpdir), token) == {
+        "old.txt",
+        "new.txt",
+        "removed.txt",
+    }
+
+    # Changes before a token are not reported for it.
+    token = watcher.get_token(str(tmpdir))
+    assert watcher.changes_since(str(tmpdir), token) == set()
+
+
+@pytest.mark.asyncio
+async def test_invalid_tokens(watcher, tmpdir):
+    assert watcher.get_token(str(tmpdir)) is None
+    watcher.watch(str(tmpdir))
+    token = watcher.get_token(str(tmpdir))
+
+    other = DirectoryWatcher(use_inotify=False)
+    try:
+        other.watch(str(tmpdir))
+        assert other.changes_since(str(tmpdir), token) is None
+    finally:
+        other.close()
+
+    assert watcher.changes_since(str(tmpdir), "garbage") is None
+    assert watcher.changes_since(str(tmpdir.join("unwatched")), token) is None
+
+
+@pytest.mark.asyncio
+async def test_overflow_invalidates_tokens(tmpdir):
+    watcher = DirectoryWatcher(use_inotify=False)
+    try:
+        watcher.watch(str(tmpdir))
+        token = watcher.get_token(str(tmpdir))
+        watcher._invalidate(str(tmpdir))
+        assert watcher.changes_since(str(tmpdir), token) is None
+        token = watcher.get_token(str(tmpdir))
+        assert watcher.changes_since(str(tmpdir), token) == set()
+    finally:
+        watcher.close()
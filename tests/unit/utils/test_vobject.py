@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 from textwrap import dedent
 
 import hypothesis.strategies as st
@@ -147,6 +148,57 @@ def test_split_contacts():
         assert vobject.join_collection(split).splitlines() == with_wrapper.splitlines()
 
 
+@pytest.mark.parametrize(
+    "collection",
+    [
+        _simple_joined,
+        "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nMETHOD:PUBLISH\r\n"
+        + BARE_EVENT_TEMPLATE.format(r=1, uid="a")
+        + "\r\nX-WR-CALNAME:Foo\r\n"
+        + BARE_EVENT_TEMPLATE.format(r=2, uid="b")
+        + "\r\nBEGIN:VTIMEZONE\r\nTZID:X\r\nEND:VTIMEZONE\r\n"
+        + BARE_EVENT_TEMPLATE.format(r=3, uid="a").replace(
+            "UID:a", "UID:a\r\nRECURRENCE-ID:19970714T170000Z"
+        )
+        + "\r\nBEGIN:VTODO\r\nSUMMARY:No UID\r\nEND:VTODO\r\nEND:VCALENDAR\r\n",
+    ],
+)
+def test_index_collection(collection):
+    data = collection.encode("utf-8")
+    index = vobject.index_collection(data)
+    assert [raw for raw, _ in index.items] == list(vobject.split_collection(collection))
+    assert data[index.footer_start :].startswith(b"END:")
+
+    for raw, spans in index.items:
+        components = [vobject._Component.parse(data[start:end]) for start, end in spans]
+        assert all(c.dump_lines() for c in components)
+        for c in components:
+            assert "\r\n".join(c.dump_lines()) in raw
+
+    # Items can be read again from their spans, also with a stored index.
+    stored = vobject.CollectionIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+    for raw, spans in index.items:
+        assert index.read_item(data, spans) == raw
+        assert stored.read_item(data, spans) == raw
+
+
+@pytest.mark.parametrize(
+    "collection",
+    [
+        "",
+        "\r\n".join(
+            "BEGIN:VADDRESSBOOK\r\n" + x + "\r\nEND:VADDRESSBOOK\r\n"
+            for x in _simple_split
+        ),
+        "\r\n".join(_simple_split),
+        "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nEND:VCALENDAR\r\n",
+        "BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\nFOO:BAR\r\n",
+    ],
+)
+def test_index_collection_unsupported(collection):
+    assert vobject.index_collection(collection.encode("utf-8")) is None
+
+
 def test_hash_item():
     a = EVENT_TEMPLATE.format(r=1, uid=1)
     b = "\n".join(line for line in a.splitlines() if "PRODID" not in line)
@@ -23,6 +23,7 @@ click_context_settings = {"help_option_names": ["-h", "--help"]}
 class AppContext:
     def __init__(self):
         self.config = None
+        self.config_path = None
         self.fetched_params = {}
         self.logger = None
 
@@ -65,6 +66,7 @@ def app(ctx, config: str):
     if not ctx.config:
         from .config import load_config
 
+        ctx.config_path = config
         ctx.config = load_config(config)
 
 
@@ -75,6 +77,10 @@ def collections_arg_callback(ctx, param, value):
     """
     # XXX: Ugly! pass_context should work everywhere.
     config = ctx.find_object(AppContext).config
+    return expand_collections(config, value)
+
+
+def expand_collections(config, value):
     rv = {}
     for pair_and_collection in value or config.pairs:
         pair, collection = pair_and_collection, None
@@ -102,9 +108,22 @@ collections_arg = click.argument(
         "to be deleted from both sides."
     ),
 )
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help=(
+        "List the storages and show what would be done, without changing "
+        "them or the sync status."
+    ),
+)
+@click.option(
+    "--plan",
+    is_flag=True,
+    help="Together with --dry-run, print the planned actions as JSON.",
+)
 @pass_context
 @catch_errors
-def sync(ctx, collections, force_delete):
+def sync(ctx, collections, force_delete, dry_run, plan):
     """
     Synchronize the given collections or pairs. If no arguments are given, all
     will be synchronized.
@@ -124,39 +143,166 @@ def sync(ctx, collections, force_delete):
     \b
     # Sync only "first_collection" from the pair "bob"
     vdirsyncer sync bob/first_collection
+
+    \b
+    # Show how many items would be copied, without doing so
+    vdirsyncer sync --dry-run --plan
     """
     from .tasks import prepare_pair
     from .tasks import sync_collection
+    from .utils import CollectionLimiter
+    from .utils import get_collection_hosts
 
-    async def main(collection_names):
+    if plan and not dry_run:
+        from vdirsyncer.exceptions import UserError
+
+        raise UserError("--plan requires --dry-run.")
+
+    async def main(collection_names, item_cache):
+        limiter = CollectionLimiter.from_general(ctx.config.general)
         async with aiohttp.TCPConnector(limit_per_host=16) as conn:
-            tasks = []
-            for pair_name, collections in collection_names:
-                async for collection, config in prepare_pair(
-                    pair_name=pair_name,
-                    collections=collections,
-                    config=ctx.config,
-                    connector=conn,
-                ):
-                    tasks.append(
-                        sync_collection(
-                            collection=collection,
-                            general=config,
-                            force_delete=force_delete,
-                            connector=conn,
-                        )
-                    )
 
-            # `return_exceptions=True` ensures that the event loop lives long enough for
-            # backoffs to be able to finish
-            gathered = await asyncio.gather(*tasks, return_exceptions=True)
+            async def sync_pair(pair_name, collections):
+                # Start syncing every collection as soon as it is found,
+                # while other pairs are still being resolved.
+                tasks = []
+                try:
+                    async for collection, config in prepare_pair(
+                        pair_name=pair_name,
+                        collections=collections,
+                        config=ctx.config,
+                        connector=conn,
+                    ):
+                        coro = limiter.run(
+                            get_collection_hosts(collection),
+                            functools.partial(
+                                sync_collection,
+                                collection=collection,
+                                general=config,
+                                force_delete=force_delete,
+                                connector=conn,
+                                dry_run=dry_run,
+                                item_cache=item_cache,
+                            ),
+                        )
+                        tasks.append(asyncio.ensure_future(coro))
+                finally:
+                    # `return_exceptions=True` ensures that the event loop lives
+                    # long enough for backoffs to be able to finish
+                    gathered = await asyncio.gather(*tasks, return_exceptions=True)
+                return gathered
+
+            per_pair = await asyncio.gather(
+                *(
+                    sync_pair(pair_name, collections)
+                    for pair_name, collections in collection_names
+                ),
+                return_exceptions=True,
+            )
+            gathered = []
+            for rv in per_pair:
+                if isinstance(rv, BaseException):
+                    gathered.append(rv)
+                else:
+                    gathered.extend(rv)
             # but now we need to manually check for and propogate a single failure after
             # allowing all tasks to finish in order to keep exit status non-zero
             failures = [e for e in gathered if isinstance(e, BaseException)]
             if failures:
                 raise failures[0]
+            return gathered
 
-    asyncio.run(main(collections))
+    from .utils import manage_item_cache
+
+    if dry_run:
+        # Using the item cache would write to it.
+        plans = asyncio.run(main(collections, None))
+    else:
+        with manage_item_cache(ctx.config.general) as item_cache:
+            plans = asyncio.run(main(collections, item_cache))
+    if plan:
+        click.echo(json.dumps(plans, indent=2))
+    elif dry_run:
+        from .utils import format_plan
+
+        for p in plans:
+            click.echo(format_plan(p))
+
+
+@app.command()
+@click.argument("collections", nargs=-1)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=1),
+    default=900,
+    show_default=True,
+    help="Seconds between two syncs of a pair without a `sync_interval`.",
+)
+@click.option(
+    "--jitter",
+    type=click.FloatRange(0, 1),
+    default=0.1,
+    show_default=True,
+    help="Vary each interval randomly by up to this fraction.",
+)
+@click.option(
+    "--max-backoff",
+    type=click.FloatRange(min=1),
+    default=3600,
+    show_default=True,
+    help=(
+        "After a failed sync, a pair's interval is doubled, up to this many seconds."
+    ),
+)
+@click.option(
+    "--force-delete/--no-force-delete",
+    help=(
+        "Do/Don't abort synchronization when all items are about "
+        "to be deleted from both sides."
+    ),
+)
+@click.option(
+    "--watch/--no-watch",
+    help=(
+        "Sync a collection soon after a file in its filesystem storage "
+        "changed, instead of waiting for the next interval."
+    ),
+)
+@pass_context
+@catch_errors
+def daemon(ctx, collections, interval, jitter, max_backoff, force_delete, watch):
+    """
+    Synchronize the given collections or pairs repeatedly, until stopped.
+
+    Each pair is synchronized every `--interval` seconds, or as often as its
+    `sync_interval` says. Connections, authentication and the sync status are
+    kept between syncs.
+
+    With `--watch`, changes to the directories of filesystem storages are
+    noticed right away (with inotify, or by polling them), and only the
+    changed files are looked at on that side.
+
+    Send SIGHUP to reload the configuration after the running syncs are done,
+    and SIGTERM to stop after them.
+
+    See the `sync` command for the arguments.
+    """
+    from .daemon import Daemon
+
+    # Fail early for unknown pairs.
+    for pair_name, _ in expand_collections(ctx.config, collections):
+        ctx.config.get_pair(pair_name)
+
+    d = Daemon(
+        ctx,
+        collections,
+        interval=interval,
+        jitter=jitter,
+        max_backoff=max_backoff,
+        force_delete=force_delete,
+        watch=watch,
+    )
+    asyncio.run(d.run())
 
 
 @app.command()
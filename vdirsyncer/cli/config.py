@@ -18,7 +18,15 @@ from vdirsyncer.vobject import Item
 from .fetchparams import expand_fetch_params
 from .utils import storage_class_from_config
 
-GENERAL_ALL = frozenset(["status_path"])
+GENERAL_ALL = frozenset(
+    [
+        "status_path",
+        "item_cache_size",
+        "item_cache_bodies",
+        "sync_concurrency",
+        "sync_concurrency_per_host",
+    ]
+)
 GENERAL_REQUIRED = frozenset(["status_path"])
 SECTION_NAME_CHARS = frozenset(chain(string.ascii_letters, string.digits, "_"))
 
@@ -96,6 +104,22 @@ def _validate_collections_param(collections):
             raise ValueError(f"`collections` parameter, position {i}: {e!s}")
 
 
+def _validate_max_workers_param(max_workers):
+    if isinstance(max_workers, bool) or not isinstance(max_workers, int):
+        raise ValueError("`max_workers` parameter must be an integer.")
+    if max_workers < 1:
+        raise ValueError("`max_workers` parameter must be at least 1.")
+
+
+def _validate_sync_interval_param(sync_interval):
+    if sync_interval is None:
+        return
+    if isinstance(sync_interval, bool) or not isinstance(sync_interval, (int, float)):
+        raise ValueError("`sync_interval` parameter must be a number or null.")
+    if sync_interval <= 0:
+        raise ValueError("`sync_interval` parameter must be positive.")
+
+
 def _validate_implicit_param(implicit):
     if implicit is None:
         return
@@ -242,6 +266,10 @@ class PairConfig:
 
         self._partial_sync: str | None = options.pop("partial_sync", None)
         self.metadata: str | tuple[()] = options.pop("metadata", ())
+        self.max_workers: int = options.pop("max_workers", 1)
+        _validate_max_workers_param(self.max_workers)
+        self.sync_interval: float | None = options.pop("sync_interval", None)
+        _validate_sync_interval_param(self.sync_interval)
 
         self.conflict_resolution = self._process_conflict_resolution_param(
             options.pop("conflict_resolution", None)
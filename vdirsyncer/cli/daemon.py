@@ -0,0 +1,305 @@
+"""
+The scheduler behind ``vdirsyncer daemon``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import random
+import signal
+
+import aiohttp
+
+from vdirsyncer import exceptions
+from vdirsyncer.watch import DirectoryWatcher
+
+from . import expand_collections
+from .config import load_config
+from .tasks import SyncResources
+from .tasks import prepare_pair
+from .tasks import sync_collection
+from .utils import CollectionLimiter
+from .utils import JobFailed
+from .utils import cli_logger
+from .utils import get_collection_hosts
+from .utils import handle_cli_error
+from .utils import manage_item_cache
+
+
+def next_delay(interval, failures, *, jitter=0.0, max_backoff=None, rand=random.random):
+    """Return how many seconds to wait before the next sync of a pair.
+
+    After ``failures`` failed syncs in a row, the interval is doubled that many
+    times, but it doesn't grow beyond ``max_backoff``. The result varies
+    randomly by up to ``jitter`` times itself, so that pairs with the same
+    interval don't keep syncing at the same time.
+    """
+    delay = interval * 2 ** min(failures, 32)
+    if max_backoff is not None:
+        delay = min(delay, max(max_backoff, interval))
+    return delay * (1 + jitter * (2 * rand() - 1))
+
+
+class Daemon:
+    """Synchronize pairs repeatedly, each on its own interval.
+
+    The connector, the storages and the statuses are kept open between
+    syncs. :py:meth:`reload` re-reads the configuration after the syncs that
+    are currently running finished.
+
+    :param app_ctx: The :py:class:`vdirsyncer.cli.AppContext`.
+    :param pair_args: The pairs and collections given on the command line.
+    :param interval: How many seconds to wait between two syncs of a pair
+        that doesn't set ``sync_interval``.
+    :param jitter: See :py:func:`next_delay`.
+    :param max_backoff: See :py:func:`next_delay`.
+    :param force_delete: See :py:func:`vdirsyncer.sync.sync`.
+    :param watch: Whether to watch the directories of filesystem storages,
+        and to sync collections as soon as they changed.
+    """
+
+    # How many seconds to wait for further changes after a watched collection
+    # changed, so that writing many files at once results in one sync.
+    WATCH_DELAY = 1.0
+
+    def __init__(
+        self,
+        app_ctx,
+        pair_args,
+        *,
+        interval,
+        jitter=0.1,
+        max_backoff=None,
+        force_delete=False,
+        watch=False,
+    ):
+        self.app_ctx = app_ctx
+        self.pair_args = pair_args
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.force_delete = force_delete
+        self.watch = watch
+
+        self._wake: asyncio.Event | None = None
+        self._stopping = False
+        self._watcher: DirectoryWatcher | None = None
+        # Set when a watched collection of a pair changed, {pair_name: Event}
+        self._triggers: dict[str, asyncio.Event] = {}
+        # The watched collections that changed, {pair_name: {collection_name}}
+        self._changed: dict[str, set] = {}
+
+    def reload(self) -> None:
+        cli_logger.info("Reloading the configuration...")
+        self._wake.set()
+
+    def stop(self) -> None:
+        cli_logger.info("Stopping...")
+        self._stopping = True
+        self._wake.set()
+
+    async def run(self) -> None:
+        self._wake = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        signals = []
+        for name, handler in (("SIGHUP", self.reload), ("SIGTERM", self.stop)):
+            sig = getattr(signal, name, None)
+            if sig is None:
+                continue
+            with contextlib.suppress(NotImplementedError, RuntimeError):
+                loop.add_signal_handler(sig, handler)
+                signals.append(sig)
+
+        try:
+            async with aiohttp.TCPConnector(limit_per_host=16) as conn:
+                while True:
+                    await self._run_config(conn)
+                    # If no pair is left to sync, e.g. because the
+                    # configuration has none, wait for a reload.
+                    await self._wake.wait()
+                    if self._stopping:
+                        return
+                    self._wake.clear()
+                    self._reload_config()
+        finally:
+            for sig in signals:
+                loop.remove_signal_handler(sig)
+
+    def _reload_config(self) -> None:
+        try:
+            config = load_config(self.app_ctx.config_path)
+        except exceptions.UserError:
+            handle_cli_error()
+            cli_logger.error("Keeping the old configuration.")
+        else:
+            self.app_ctx.config = config
+            # Passwords may have changed as well.
+            self.app_ctx.fetched_params.clear()
+
+    async def _run_config(self, connector) -> None:
+        """Sync the pairs of the current configuration until woken up."""
+        config = self.app_ctx.config
+        limiter = CollectionLimiter.from_general(config.general)
+        resources = SyncResources()
+        if self.watch:
+            self._watcher = resources.watcher = DirectoryWatcher(
+                on_change=functools.partial(self._collections_changed, resources)
+            )
+        try:
+            with manage_item_cache(config.general) as item_cache:
+                await asyncio.gather(
+                    *(
+                        self._pair_loop(
+                            pair_name,
+                            collections,
+                            connector=connector,
+                            limiter=limiter,
+                            resources=resources,
+                            item_cache=item_cache,
+                        )
+                        for pair_name, collections in expand_collections(
+                            config, self.pair_args
+                        )
+                    )
+                )
+        finally:
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+            self._triggers.clear()
+            self._changed.clear()
+            resources.close()
+
+    def _collections_changed(self, resources, path) -> None:
+        for pair_name, collection_name in resources.watched.get(path, ()):
+            self._changed.setdefault(pair_name, set()).add(collection_name)
+            trigger = self._triggers.get(pair_name)
+            if trigger is not None:
+                trigger.set()
+
+    async def _pair_loop(self, pair_name, collections, **kwargs) -> None:
+        config = self.app_ctx.config
+        try:
+            pair = config.get_pair(pair_name)
+        except (exceptions.UserError, exceptions.PairNotFound):
+            # E.g. the pair was removed from the configuration before a
+            # reload.
+            handle_cli_error()
+            return
+
+        loop = asyncio.get_running_loop()
+        self._triggers[pair_name] = asyncio.Event()
+        interval = pair.sync_interval or self.interval
+        failures = 0
+        while not self._wake.is_set():
+            if await self._try_sync_pair(pair_name, collections, **kwargs):
+                failures = 0
+            else:
+                failures += 1
+
+            delay = next_delay(
+                interval, failures, jitter=self.jitter, max_backoff=self.max_backoff
+            )
+            cli_logger.debug(f"Next sync of {pair_name} in {delay:.0f} seconds.")
+            deadline = loop.time() + delay
+            while True:
+                changed = await self._wait_for_changes(
+                    pair_name, deadline - loop.time()
+                )
+                if changed is None:
+                    break
+                await self._try_sync_pair(
+                    pair_name, collections, only=changed, **kwargs
+                )
+
+    async def _wait_for_changes(self, pair_name, timeout) -> set | None:
+        """Wait until watched collections of a pair changed.
+
+        :returns: The names of the collections that changed, or ``None`` if
+            ``timeout`` passed or the daemon was woken up first.
+        """
+        trigger = self._triggers[pair_name]
+        waiters = [
+            asyncio.ensure_future(self._wake.wait()),
+            asyncio.ensure_future(trigger.wait()),
+        ]
+        try:
+            await asyncio.wait(
+                waiters, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        if self._wake.is_set() or not trigger.is_set():
+            return None
+
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wake.wait(), self.WATCH_DELAY)
+        if self._wake.is_set():
+            return None
+        trigger.clear()
+        return self._changed.pop(pair_name, set())
+
+    async def _try_sync_pair(self, pair_name, collections, only=None, **kwargs) -> bool:
+        """Sync a pair, and return whether that succeeded."""
+        if only is None:
+            # Changes to watched collections until now are synced as well.
+            self._triggers[pair_name].clear()
+            self._changed.pop(pair_name, None)
+        try:
+            await self._sync_pair(pair_name, collections, only=only, **kwargs)
+        except JobFailed:
+            return False
+        except Exception:  # noqa: BLE001
+            # Keep running, e.g. if the server is unreachable during
+            # discovery.
+            handle_cli_error(pair_name)
+            return False
+        return True
+
+    async def _sync_pair(
+        self,
+        pair_name,
+        collections,
+        *,
+        connector,
+        limiter,
+        resources,
+        item_cache,
+        only=None,
+    ) -> None:
+        """Sync the collections of a pair.
+
+        :param only: If given, only sync the collections with these names.
+        """
+        tasks = []
+        try:
+            async for collection, general in prepare_pair(
+                pair_name=pair_name,
+                collections=collections,
+                config=self.app_ctx.config,
+                connector=connector,
+            ):
+                if only is not None and collection.name not in only:
+                    continue
+                coro = limiter.run(
+                    get_collection_hosts(collection),
+                    functools.partial(
+                        sync_collection,
+                        collection=collection,
+                        general=general,
+                        force_delete=self.force_delete,
+                        connector=connector,
+                        item_cache=item_cache,
+                        resources=resources,
+                    ),
+                )
+                tasks.append(asyncio.ensure_future(coro))
+        finally:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Errors were already reported by `sync_collection`.
+        if any(isinstance(rv, BaseException) for rv in results):
+            raise JobFailed
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import contextlib
 import json
+import os
 
 import aiohttp
 
@@ -14,6 +16,7 @@ from .discover import storage_instance_from_config
 from .utils import JobFailed
 from .utils import cli_logger
 from .utils import get_status_name
+from .utils import get_status_path
 from .utils import handle_cli_error
 from .utils import load_status
 from .utils import manage_sync_status
@@ -44,21 +47,117 @@ async def prepare_pair(pair_name, collections, config, *, connector):
         yield collection, config.general
 
 
+class SyncResources:
+    """Storages and statuses that are kept open between several syncs of the
+    same collections, see ``vdirsyncer daemon``.
+
+    This keeps open connections, authentication state and the status
+    databases around.
+
+    If :py:attr:`watcher` is set to a
+    :py:class:`vdirsyncer.watch.DirectoryWatcher`, the storages that support
+    it are attached to it.
+    """
+
+    def __init__(self):
+        self._storages = {}
+        self._statuses = {}
+        self._stack = contextlib.ExitStack()
+        self.watcher = None
+        # The collections whose storages are watched,
+        # {path: {(pair_name, collection_name)}}
+        self.watched = {}
+
+    async def get_storages(self, collection, *, connector):
+        status_name = get_status_name(collection.pair.name, collection.name)
+        if status_name not in self._storages:
+            a = await storage_instance_from_config(
+                collection.config_a, connector=connector
+            )
+            b = await storage_instance_from_config(
+                collection.config_b, connector=connector
+            )
+            self._storages[status_name] = a, b
+            if self.watcher is not None:
+                for storage in (a, b):
+                    if hasattr(storage, "attach_watcher"):
+                        storage.attach_watcher(self.watcher)
+                        self.watched.setdefault(
+                            os.path.abspath(storage.path), set()
+                        ).add((collection.pair.name, collection.name))
+        return self._storages[status_name]
+
+    def get_status(self, status_path, collection):
+        status_name = get_status_name(collection.pair.name, collection.name)
+        if status_name not in self._statuses:
+            self._statuses[status_name] = self._stack.enter_context(
+                manage_sync_status(status_path, collection.pair.name, collection.name)
+            )
+        return self._statuses[status_name]
+
+    def discard(self, collection):
+        """Forget the storages of a collection, e.g. after an error."""
+        status_name = get_status_name(collection.pair.name, collection.name)
+        self._storages.pop(status_name, None)
+
+    def close(self):
+        self._storages.clear()
+        self._statuses.clear()
+        self._stack.close()
+
+
+def _set_list_caches(status_path, collection, a, b):
+    """Let the storages that support it keep their listing next to the
+    status."""
+    for side, storage in (("a", a), ("b", b)):
+        if hasattr(storage, "set_list_cache"):
+            storage.set_list_cache(
+                get_status_path(
+                    status_path, collection.pair.name, collection.name, f"{side}.list"
+                )
+            )
+
+
 async def sync_collection(
     collection,
     general,
     force_delete,
     *,
     connector: aiohttp.TCPConnector,
+    dry_run=False,
+    item_cache=None,
+    resources: SyncResources | None = None,
 ):
+    """Synchronize a collection.
+
+    :param resources: Reuse the storages and the status from there instead
+        of opening them for this sync only.
+    :returns: With ``dry_run``, a summary of what would be done, see
+        :py:func:`vdirsyncer.sync.sync`.
+    """
     pair = collection.pair
     status_name = get_status_name(pair.name, collection.name)
 
     try:
         cli_logger.info(f"Syncing {status_name}")
 
-        a = await storage_instance_from_config(collection.config_a, connector=connector)
-        b = await storage_instance_from_config(collection.config_b, connector=connector)
+        if resources is not None:
+            a, b = await resources.get_storages(collection, connector=connector)
+            status_cm = contextlib.nullcontext(
+                resources.get_status(general["status_path"], collection)
+            )
+        else:
+            a = await storage_instance_from_config(
+                collection.config_a, connector=connector
+            )
+            b = await storage_instance_from_config(
+                collection.config_b, connector=connector
+            )
+            status_cm = manage_sync_status(
+                general["status_path"], pair.name, collection.name, read_only=dry_run
+            )
+        if not dry_run:
+            _set_list_caches(general["status_path"], collection, a, b)
 
         sync_failed = False
 
@@ -67,10 +166,8 @@ async def sync_collection(
             sync_failed = True
             handle_cli_error(status_name, e)
 
-        with manage_sync_status(
-            general["status_path"], pair.name, collection.name
-        ) as status:
-            await sync.sync(
+        with status_cm as status:
+            plan = await sync.sync(
                 a,
                 b,
                 status,
@@ -78,16 +175,32 @@ async def sync_collection(
                 force_delete=force_delete,
                 error_callback=error_callback,
                 partial_sync=pair.partial_sync,
+                max_workers=pair.max_workers,
+                dry_run=dry_run,
+                item_cache=item_cache,
             )
 
         if sync_failed:
             raise JobFailed
     except JobFailed:
+        if resources is not None:
+            resources.discard(collection)
         raise
     except BaseException:
+        if resources is not None:
+            resources.discard(collection)
         handle_cli_error(status_name)
         raise JobFailed
 
+    if dry_run:
+        return {
+            "pair": pair.name,
+            "collection": collection.name,
+            "storage_a": pair.name_a,
+            "storage_b": pair.name_b,
+            **plan,
+        }
+
 
 async def discover_collections(pair, **kwargs):
     rv = await collections_for_pair(pair=pair, **kwargs)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import errno
 import importlib
@@ -7,6 +8,7 @@ import json
 import os
 import sys
 from typing import Any
+from urllib.parse import urlparse
 
 import aiohttp
 import click
@@ -15,6 +17,7 @@ from vdirsyncer import BUGTRACKER_HOME
 from vdirsyncer import DOCS_HOME
 from vdirsyncer import exceptions
 from vdirsyncer.storage.base import Storage
+from vdirsyncer.sync.cache import ItemCache
 from vdirsyncer.sync.exceptions import IdentConflict
 from vdirsyncer.sync.exceptions import PartialSync
 from vdirsyncer.sync.exceptions import StorageEmpty
@@ -62,6 +65,71 @@ class JobFailed(RuntimeError):
     pass
 
 
+class CollectionLimiter:
+    """Limit how many collections are synchronized at the same time, in
+    total and per host.
+
+    Collections start in the order in which they are submitted. A collection
+    that waits for a busy host doesn't hold up collections on other hosts.
+    Must be created inside the event loop.
+
+    :param max_total: How many collections may run at once, ``None`` for no
+        limit.
+    :param max_per_host: How many collections of the same host may run at
+        once, ``None`` for no limit.
+    """
+
+    def __init__(self, max_total: int | None = None, max_per_host: int | None = None):
+        self._total = asyncio.Semaphore(max_total) if max_total else None
+        self._max_per_host = max_per_host
+        self._per_host: dict[str, asyncio.Semaphore] = {}
+
+    @classmethod
+    def from_general(cls, general: dict[str, Any]) -> CollectionLimiter:
+        limits = []
+        for key, default in (
+            ("sync_concurrency", 32),
+            ("sync_concurrency_per_host", 8),
+        ):
+            value = general.get(key, default)
+            if value is not None and (
+                isinstance(value, bool) or not isinstance(value, int) or value < 1
+            ):
+                raise exceptions.UserError(
+                    f"{key} must be a positive integer or null, got {value!r}."
+                )
+            limits.append(value)
+        return cls(*limits)
+
+    async def run(self, hosts, f):
+        """Wait for a free slot and return ``await f()``.
+
+        :param hosts: The hosts the collection talks to.
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            if self._max_per_host:
+                # Always acquire in the same order to avoid deadlocks.
+                for host in sorted(hosts):
+                    if host not in self._per_host:
+                        self._per_host[host] = asyncio.Semaphore(self._max_per_host)
+                    await stack.enter_async_context(self._per_host[host])
+            if self._total is not None:
+                await stack.enter_async_context(self._total)
+            return await f()
+
+
+def get_collection_hosts(collection) -> set[str]:
+    """Return the hosts of the storages of a collection that have a URL."""
+    hosts = set()
+    for config in (collection.config_a, collection.config_b):
+        url = config.get("url")
+        if isinstance(url, str):
+            host = urlparse(url).hostname
+            if host:
+                hosts.add(host.lower())
+    return hosts
+
+
 def handle_cli_error(status_name=None, e=None):
     """
     Print a useful error message for the current exception.
@@ -159,6 +227,22 @@ def get_status_name(pair: str, collection: str | None) -> str:
     return pair + "/" + collection
 
 
+def format_plan(plan: dict[str, Any]) -> str:
+    """Describe the result of a dry run of ``sync_collection``."""
+    lines = [get_status_name(plan["pair"], plan["collection"]) + ":"]
+    for side in "ab":
+        lines.append(
+            "  {storage}: {upload} to upload, {update} to update, {delete} to "
+            "delete, ~{bytes} bytes to write".format(
+                storage=plan["storage_" + side],
+                **{key: plan[key][side] for key in ("upload", "update", "delete")},
+                bytes=plan["bytes"][side],
+            )
+        )
+    lines.append(f"  {plan['conflict']} conflicts")
+    return "\n".join(lines)
+
+
 def get_status_path(
     base_path: str,
     pair: str,
@@ -209,7 +293,14 @@ def prepare_status_path(path: str) -> None:
 
 
 @contextlib.contextmanager
-def manage_sync_status(base_path: str, pair_name: str, collection_name: str):
+def manage_sync_status(
+    base_path: str, pair_name: str, collection_name: str, read_only: bool = False
+):
+    """Open the status of a collection.
+
+    :param read_only: Don't create or migrate the status file. The returned
+        status is then an in-memory copy of it.
+    """
     path = get_status_path(base_path, pair_name, collection_name, "items")
     status = None
     legacy_status = None
@@ -223,10 +314,17 @@ def manage_sync_status(base_path: str, pair_name: str, collection_name: str):
         pass
 
     if legacy_status is not None:
-        cli_logger.warning("Migrating legacy status to sqlite")
-        os.remove(path)
-        status = SqliteStatus(path)
+        if read_only:
+            status = SqliteStatus()
+        else:
+            cli_logger.warning("Migrating legacy status to sqlite")
+            os.remove(path)
+            status = SqliteStatus(path)
         status.load_legacy_status(legacy_status)
+    elif read_only:
+        status = (
+            SqliteStatus(copy_from=path) if os.path.exists(path) else SqliteStatus()
+        )
     else:
         prepare_status_path(path)
         status = SqliteStatus(path)
@@ -235,6 +333,35 @@ def manage_sync_status(base_path: str, pair_name: str, collection_name: str):
         yield status
 
 
+@contextlib.contextmanager
+def manage_item_cache(general: dict[str, Any]):
+    """Open the item cache configured in the general section, if any.
+
+    Yields ``None`` if the cache is disabled.
+    """
+    size = general.get("item_cache_size")
+    if size is None:
+        yield None
+        return
+
+    if isinstance(size, bool) or not isinstance(size, int) or size <= 0:
+        raise exceptions.UserError(
+            f"item_cache_size must be a positive number of MiB, got {size!r}."
+        )
+    store_bodies = general.get("item_cache_bodies", True)
+    if not isinstance(store_bodies, bool):
+        raise exceptions.UserError(
+            f"item_cache_bodies must be true or false, got {store_bodies!r}."
+        )
+
+    path = os.path.join(expand_path(general["status_path"]), "item_cache")
+    prepare_status_path(path)
+    with contextlib.closing(
+        ItemCache(path, max_size=size * 1024 * 1024, store_bodies=store_bodies)
+    ) as cache:
+        yield cache
+
+
 def save_status(
     base_path: str,
     pair: str,
@@ -67,6 +67,11 @@ class WrongEtagError(PreconditionFailed):
     """Wrong etag"""
 
 
+class InvalidSyncToken(Error):
+    """The storage rejected the sync token, the collection needs to be listed
+    in full."""
+
+
 class ReadOnlyError(Error):
     """Storage is read-only."""
 
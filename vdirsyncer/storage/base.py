@@ -74,6 +74,10 @@ class Storage(metaclass=StorageMeta):
     # support those methods.
     read_only = False
 
+    # A value of False means that reading items is about as cheap as reading
+    # them from a cache, so the item cache of the sync only stores their hash.
+    cache_bodies = True
+
     # The attribute values to show in the representation of the storage.
     _repr_attributes: tuple[str, ...] = ()
 
@@ -174,6 +178,69 @@ class Storage(metaclass=StorageMeta):
             item, etag = await self.get(href)
             yield href, item, etag
 
+    async def get_sync_token(self) -> str | None:
+        """Get a token describing the current state of the collection.
+
+        The token can be passed to :py:meth:`list_changes` during a later
+        synchronization.
+
+        :returns: An opaque string, or ``None`` if the storage doesn't support
+            listing changes incrementally.
+        """
+        return None
+
+    async def get_ctag(self) -> str | None:
+        """Get a token that changes whenever any item of the collection does.
+
+        If the token is the same as during the last synchronization, the
+        collection isn't listed at all.
+
+        :returns: An opaque string, or ``None`` if the storage can't tell
+            cheaply whether it changed.
+        """
+        return None
+
+    async def get_collection_tokens(self) -> tuple[str | None, str | None]:
+        """Get the results of :py:meth:`get_ctag` and :py:meth:`get_sync_token`
+        at once.
+
+        Storages that can obtain both with a single request should override
+        this.
+        """
+        return await self.get_ctag(), await self.get_sync_token()
+
+    async def list_changes(self, sync_token: str):
+        """List the items that changed since ``sync_token`` was obtained.
+
+        Only called if :py:meth:`get_sync_token` returns a token. Items may be
+        reported even though they didn't change.
+
+        :param sync_token: A token previously returned by
+            :py:meth:`get_sync_token`.
+        :raises: :exc:`vdirsyncer.exceptions.InvalidSyncToken` if the storage
+            doesn't accept the token (anymore).
+        :returns: iterable of (href, etag), where etag is ``None`` for items
+            that were removed.
+        """
+        if False:
+            yield  # Needs to be an async generator
+        raise NotImplementedError
+
+    async def get_fingerprints(self, hrefs: Iterable[str]):
+        """Get fingerprints of the content of items, without fetching them.
+
+        Unlike etags, a fingerprint must only change when the content of the
+        item does. The sync uses fingerprints to recognize items whose etag
+        changed without fetching them again, so this is only worth
+        implementing if it's cheaper than :py:meth:`get_multi`.
+
+        :param hrefs: list of hrefs
+        :returns: iterable of (href, fingerprint). Items may be omitted if
+            their fingerprint isn't known.
+        """
+        if False:
+            yield  # Needs to be an async generator
+
     async def has(self, href) -> bool:
         """Check if an item exists by its href."""
         try:
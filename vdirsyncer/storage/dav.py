@@ -1,14 +1,19 @@
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import datetime
+import itertools
 import logging
 import urllib.parse as urlparse
+import weakref
 import xml.etree.ElementTree as etree
 from abc import abstractmethod
 from functools import cached_property
+from inspect import Parameter
 from inspect import getfullargspec
 from inspect import signature
+from xml.sax.saxutils import escape
 
 import aiohttp
 import aiostream
@@ -38,10 +43,8 @@ async def _assert_multistatus_success(r):
     except InvalidXMLResponse:
         return
     for status in root.findall(".//{DAV:}status"):
-        parts = status.text.strip().split()
-        try:
-            st = int(parts[1])
-        except (ValueError, IndexError):
+        st = _parse_status_code(status)
+        if st is None:
             continue
         if st < 200 or st >= 400:
             raise Error(f"Server error: {st}")
@@ -79,9 +82,9 @@ _BAD_XML_CHARS = (
 )
 
 
-def _clean_body(content, bad_chars=_BAD_XML_CHARS):
+def _clean_body(content, bad_chars=_BAD_XML_CHARS, warn=True):
     new_content = content.translate(None, bad_chars)
-    if new_content != content:
+    if warn and new_content != content:
         dav_logger.warning(
             "Your server incorrectly returned ASCII control characters in its "
             "XML. Vdirsyncer ignores those, but this is a bug in your server."
@@ -89,13 +92,70 @@ def _clean_body(content, bad_chars=_BAD_XML_CHARS):
     return new_content
 
 
+def _invalid_xml(e):
+    return InvalidXMLResponse(
+        f"Invalid XML encountered: {e}\nDouble-check the URLs in your config."
+    )
+
+
 def _parse_xml(content):
     try:
         return etree.XML(_clean_body(content))
     except etree.ParseError as e:
-        raise InvalidXMLResponse(
-            f"Invalid XML encountered: {e}\nDouble-check the URLs in your config."
-        )
+        raise _invalid_xml(e)
+
+
+# How many bytes to feed into the XML parser at once.
+_XML_CHUNK_SIZE = 64 * 1024
+
+
+async def _iter_xml_elements(response, tags):
+    """Parse the body of ``response`` while it is being downloaded.
+
+    Each child of the root element whose tag is in ``tags`` is yielded as
+    soon as it is complete. It is removed from the tree at the same time, so
+    that the memory usage doesn't grow with the size of the response.
+    """
+    parser = etree.XMLPullParser(events=("start", "end"))
+    parents = []
+    warn = True
+
+    def read_events():
+        rv = []
+        try:
+            for event, element in parser.read_events():
+                if event == "start":
+                    parents.append(element)
+                    continue
+                parents.pop()
+                if len(parents) == 1 and element.tag in tags:
+                    parents[0].remove(element)
+                    rv.append(element)
+        except etree.ParseError as e:
+            raise _invalid_xml(e)
+        return rv
+
+    async for chunk in response.content.iter_chunked(_XML_CHUNK_SIZE):
+        clean_chunk = _clean_body(chunk, warn=warn)
+        warn = warn and clean_chunk == chunk
+        parser.feed(clean_chunk)
+        for element in read_events():
+            yield element
+
+    try:
+        parser.close()
+    except etree.ParseError as e:
+        raise _invalid_xml(e)
+    for element in read_events():
+        yield element
+
+
+def _parse_status_code(status):
+    """Get the status code from a ``DAV:status`` element, or ``None``."""
+    try:
+        return int(status.text.strip().split()[1])
+    except (AttributeError, ValueError, IndexError):
+        return None
 
 
 def _merge_xml(items):
@@ -107,6 +167,25 @@ def _merge_xml(items):
     return rv
 
 
+def _with_parameters(f, **defaults):
+    """Return the signature of ``f`` with additional optional parameters.
+
+    The parameters are inserted before any keyword-only parameters, so that
+    they show up as regular arguments in error messages about the config.
+    """
+    sig = signature(f)
+    params = list(sig.parameters.values())
+    i = next(
+        (i for i, p in enumerate(params) if p.kind == Parameter.KEYWORD_ONLY),
+        len(params),
+    )
+    params[i:i] = [
+        Parameter(name, Parameter.POSITIONAL_OR_KEYWORD, default=default)
+        for name, default in defaults.items()
+    ]
+    return sig.replace(parameters=params)
+
+
 def _fuzzy_matches_mimetype(strict, weak):
     # different servers give different getcontenttypes:
     # "text/vcard", "text/x-vcard", "text/x-vcard; charset=utf-8",
@@ -347,6 +426,11 @@ class CardDiscover(Discover):
     _well_known_uri = "/.well-known/carddav"
 
 
+# Limits how many listings are read from each host at the same time,
+# {connector: {host: Semaphore}}
+_listing_semaphores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
 class DAVSession:
     """A helper class to connect to DAV servers."""
 
@@ -395,6 +479,27 @@ class DAVSession:
     def parsed_url(self):
         return urlparse.urlparse(self.url)
 
+    @contextlib.asynccontextmanager
+    async def limit_listings(self):
+        """Limit how many listings of the server are read at the same time.
+
+        A listing is parsed while it is downloaded, so its connection stays
+        in use while the sync fetches the items that were found so far. At
+        most half of the connector's connections to a host are used for
+        listings, so that enough of them are left for fetching the items.
+        """
+        limit = self.connector.limit_per_host or self.connector.limit
+        if not limit:
+            yield
+            return
+
+        semaphores = _listing_semaphores.setdefault(self.connector, {})
+        host = self.parsed_url.netloc
+        if host not in semaphores:
+            semaphores[host] = asyncio.Semaphore(max(limit // 2, 1))
+        async with semaphores[host]:
+            yield
+
     async def request(self, method, path, **kwargs):
         url = self.url
         if path:
@@ -458,19 +563,62 @@ class DAVStorage(Storage):
         "displayname": ("displayname", "DAV:"),
     }
 
-    def __init__(self, *, connector, **kwargs):
+    # How many items to fetch with a single multiget REPORT, and how many of
+    # those requests to run at the same time.
+    multiget_batch_size = 100
+    multiget_concurrency = 4
+
+    # The multiget REPORT used by `get_fingerprints`, in Clark notation.
+    multiget_report: str
+
+    def __init__(
+        self,
+        *,
+        connector,
+        multiget_batch_size=None,
+        multiget_concurrency=None,
+        fingerprint_property=None,
+        **kwargs,
+    ):
         # defined for _repr_attributes
         self.username = kwargs.get("username")
         self.url = kwargs.get("url")
         self.connector = connector
 
+        for name, value in (
+            ("multiget_batch_size", multiget_batch_size),
+            ("multiget_concurrency", multiget_concurrency),
+        ):
+            if value is None:
+                continue
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise exceptions.UserError(
+                    f"{name} must be a positive integer, got {value!r}."
+                )
+            setattr(self, name, value)
+
+        if fingerprint_property is not None and not (
+            isinstance(fingerprint_property, str)
+            and fingerprint_property.startswith("{")
+        ):
+            raise exceptions.UserError(
+                "fingerprint_property must be in Clark notation, like "
+                f"'{{http://example.com/ns/}}checksum', got {fingerprint_property!r}."
+            )
+        self.fingerprint_property = fingerprint_property
+
         self.session, kwargs = self.session_class.init_and_remaining_args(
             connector=connector,
             **kwargs,
         )
         super().__init__(**kwargs)
 
-    __init__.__signature__ = signature(session_class.__init__)  # type: ignore
+    __init__.__signature__ = _with_parameters(  # type: ignore
+        session_class.__init__,
+        multiget_batch_size=multiget_batch_size,
+        multiget_concurrency=multiget_concurrency,
+        fingerprint_property=None,
+    )
     # See  https://github.com/python/mypy/issues/5958
 
     @classmethod
@@ -509,51 +657,105 @@ class DAVStorage(Storage):
         return item, etag
 
     async def get_multi(self, hrefs):
-        hrefs = set(hrefs)
-        href_xml = []
+        hrefs = list(utils.uniq(hrefs))
         for href in hrefs:
             if href != self._normalize_href(href):
                 raise exceptions.NotFoundError(href)
-            href_xml.append(f"<href>{href}</href>")
-        if href_xml:
-            data = self.get_multi_template.format(hrefs="\n".join(href_xml)).encode(
-                "utf-8"
-            )
-            response = await self.session.request(
-                "REPORT", "", data=data, headers=self.session.get_default_headers()
-            )
-            root = _parse_xml(
-                await response.content.read()
-            )  # etree only can handle bytes
-            rv = []
-            hrefs_left = set(hrefs)
-            for href, etag, prop in self._parse_prop_responses(root):
-                raw = prop.find(self.get_multi_data_query)
-                if raw is None:
-                    dav_logger.warning(f"Skipping {href}, the item content is missing.")
-                    continue
 
-                raw = raw.text or ""
+        size = self.multiget_batch_size
+        batches = (hrefs[i : i + size] for i in range(0, len(hrefs), size))
+
+        # Keep up to `multiget_concurrency` requests in flight, and yield the
+        # items of each batch as soon as it is done, so that only a few
+        # responses are kept in memory at the same time.
+        running = set()
+        try:
+            while True:
+                free = self.multiget_concurrency - len(running)
+                for batch in itertools.islice(batches, free):
+                    running.add(asyncio.ensure_future(self._get_multi_batch(batch)))
+                if not running:
+                    break
+
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    for href, item, etag in task.result():
+                        yield href, item, etag
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def _get_multi_batch(self, hrefs):
+        """Fetch ``hrefs`` with a single multiget REPORT.
+
+        :returns: list of (href, item, etag)
+        """
+        href_xml = [f"<href>{href}</href>" for href in hrefs]
+        data = self.get_multi_template.format(hrefs="\n".join(href_xml)).encode("utf-8")
+        response = await self.session.request(
+            "REPORT", "", data=data, headers=self.session.get_default_headers()
+        )
+        rv = []
+        hrefs_left = set(hrefs)
+        async for href, etag, prop in self._parse_prop_responses(response):
+            raw = prop.find(self.get_multi_data_query)
+            if raw is None:
+                dav_logger.warning(f"Skipping {href}, the item content is missing.")
+                continue
+
+            raw = raw.text or ""
 
-                if isinstance(raw, bytes):
-                    raw = raw.decode(response.encoding)
-                if isinstance(etag, bytes):
-                    etag = etag.decode(response.encoding)
+            if isinstance(raw, bytes):
+                raw = raw.decode(response.encoding)
+            if isinstance(etag, bytes):
+                etag = etag.decode(response.encoding)
 
-                try:
-                    hrefs_left.remove(href)
-                except KeyError:
-                    if href in hrefs:
-                        dav_logger.warning(f"Server sent item twice: {href}")
-                    else:
-                        dav_logger.warning(f"Server sent unsolicited item: {href}")
+            try:
+                hrefs_left.remove(href)
+            except KeyError:
+                if href in hrefs:
+                    dav_logger.warning(f"Server sent item twice: {href}")
                 else:
-                    rv.append((href, Item(raw), etag))
-            for href in hrefs_left:
-                raise exceptions.NotFoundError(href)
+                    dav_logger.warning(f"Server sent unsolicited item: {href}")
+            else:
+                rv.append((href, Item(raw), etag))
+        for href in hrefs_left:
+            raise exceptions.NotFoundError(href)
+
+        return rv
 
-            for href, item, etag in rv:
-                yield href, item, etag
+    async def get_fingerprints(self, hrefs):
+        if self.fingerprint_property is None:
+            return
+
+        ns, tag = self.multiget_report[1:].split("}")
+        prop = etree.tostring(
+            etree.Element(self.fingerprint_property), encoding="unicode"
+        )
+        hrefs = list(utils.uniq(hrefs))
+        size = self.multiget_batch_size
+        for i in range(0, len(hrefs), size):
+            href_xml = "\n".join(
+                f"<href>{escape(href)}</href>" for href in hrefs[i : i + size]
+            )
+            data = f"""<?xml version="1.0" encoding="utf-8" ?>
+                <C:{tag} xmlns="DAV:" xmlns:C="{ns}">
+                    <prop>
+                        <getetag/>
+                        {prop}
+                    </prop>
+                    {href_xml}
+                </C:{tag}>""".encode()
+            response = await self.session.request(
+                "REPORT", "", data=data, headers=self.session.get_default_headers()
+            )
+            async for href, _etag, props in self._parse_prop_responses(response):
+                fingerprint = getattr(props.find(self.fingerprint_property), "text", "")
+                if fingerprint and fingerprint.strip():
+                    yield href, fingerprint.strip()
 
     async def _put(self, href, item, etag):
         headers = self.session.get_default_headers()
@@ -607,10 +809,10 @@ class DAVStorage(Storage):
 
         await self.session.request("DELETE", href, headers=headers)
 
-    def _parse_prop_responses(self, root, handled_hrefs=None):
+    async def _parse_prop_responses(self, r, handled_hrefs=None):
         if handled_hrefs is None:
             handled_hrefs = set()
-        for response in root.iter("{DAV:}response"):
+        async for response in _iter_xml_elements(r, ("{DAV:}response",)):
             href = response.find("{DAV:}href")
             if href is None:
                 dav_logger.error("Skipping response, href is missing.")
@@ -627,31 +829,40 @@ class DAVStorage(Storage):
                 dav_logger.warning(f"Skipping identical href: {href!r}")
                 continue
 
-            props = response.findall("{DAV:}propstat/{DAV:}prop")
-            if props is None or not props:
-                dav_logger.debug(f"Skipping {href!r}, properties are missing.")
+            rv = self._parse_item_props(href, response)
+            if rv is None:
                 continue
-            else:
-                props = _merge_xml(props)
 
-            if props.find("{DAV:}resourcetype/{DAV:}collection") is not None:
-                dav_logger.debug(f"Skipping {href!r}, is collection.")
-                continue
+            handled_hrefs.add(href)
+            yield rv
 
-            etag = getattr(props.find("{DAV:}getetag"), "text", "")
-            if not etag:
-                dav_logger.debug(f"Skipping {href!r}, etag property is missing.")
-                continue
+    def _parse_item_props(self, href, response):
+        """Return ``(href, etag, props)`` if ``response`` describes an item,
+        ``None`` otherwise."""
+        props = response.findall("{DAV:}propstat/{DAV:}prop")
+        if props is None or not props:
+            dav_logger.debug(f"Skipping {href!r}, properties are missing.")
+            return None
+        else:
+            props = _merge_xml(props)
 
-            contenttype = getattr(props.find("{DAV:}getcontenttype"), "text", None)
-            if not self._is_item_mimetype(contenttype):
-                dav_logger.debug(
-                    f"Skipping {href!r}, {contenttype!r} != {self.item_mimetype!r}."
-                )
-                continue
+        if props.find("{DAV:}resourcetype/{DAV:}collection") is not None:
+            dav_logger.debug(f"Skipping {href!r}, is collection.")
+            return None
 
-            handled_hrefs.add(href)
-            yield href, etag, props
+        etag = getattr(props.find("{DAV:}getetag"), "text", "")
+        if not etag:
+            dav_logger.debug(f"Skipping {href!r}, etag property is missing.")
+            return None
+
+        contenttype = getattr(props.find("{DAV:}getcontenttype"), "text", None)
+        if not self._is_item_mimetype(contenttype):
+            dav_logger.debug(
+                f"Skipping {href!r}, {contenttype!r} != {self.item_mimetype!r}."
+            )
+            return None
+
+        return href, etag, props
 
     async def list(self):
         headers = self.session.get_default_headers()
@@ -669,17 +880,139 @@ class DAVStorage(Storage):
 
         # We use a PROPFIND request instead of addressbook-query due to issues
         # with Zimbra. See https://github.com/pimutils/vdirsyncer/issues/83
+        async with self.session.limit_listings():
+            response = await self.session.request(
+                "PROPFIND",
+                "",
+                data=data,
+                headers=headers,
+            )
+            rv = self._parse_prop_responses(response)
+            async for href, etag, _prop in rv:
+                yield href, etag
+
+    async def _get_collection_props(self, *xpaths):
+        """Fetch properties of the collection itself with a Depth:0 PROPFIND.
+
+        :returns: A dict mapping each xpath to the property's text, or
+            ``None`` if the server didn't return it.
+        """
+        headers = self.session.get_default_headers()
+        headers["Depth"] = "0"
+
+        props = "".join(
+            etree.tostring(etree.Element(xpath), encoding="unicode") for xpath in xpaths
+        )
+        data = f"""<?xml version="1.0" encoding="utf-8" ?>
+            <propfind xmlns="DAV:">
+                <prop>
+                    {props}
+                </prop>
+            </propfind>
+            """.encode()
+
         response = await self.session.request(
             "PROPFIND",
             "",
             data=data,
             headers=headers,
         )
+
         root = _parse_xml(await response.content.read())
+        rv = {}
+        for xpath in xpaths:
+            text = getattr(root.find(".//" + xpath), "text", None)
+            rv[xpath] = text.strip() if text and text.strip() else None
+        return rv
 
-        rv = self._parse_prop_responses(root)
-        for href, etag, _prop in rv:
-            yield href, etag
+    async def get_collection_tokens(self) -> tuple[str | None, str | None]:
+        # https://github.com/apple/ccs-calendarserver/blob/master/doc/Extensions/caldav-ctag.txt
+        try:
+            props = await self._get_collection_props(
+                "{http://calendarserver.org/ns/}getctag", "{DAV:}sync-token"
+            )
+        except (
+            aiohttp.ClientResponseError,
+            exceptions.NotFoundError,
+            InvalidXMLResponse,
+        ) as e:
+            dav_logger.debug(f"Server doesn't provide a ctag or sync-token: {e}")
+            return None, None
+        sync_token = props["{DAV:}sync-token"]
+        # Servers that don't implement getctag usually provide a sync-token,
+        # which changes under the same conditions.
+        ctag = props["{http://calendarserver.org/ns/}getctag"] or sync_token
+        return ctag, sync_token
+
+    async def get_sync_token(self) -> str | None:
+        return (await self.get_collection_tokens())[1]
+
+    async def get_ctag(self) -> str | None:
+        return (await self.get_collection_tokens())[0]
+
+    async def list_changes(self, sync_token):
+        # https://tools.ietf.org/html/rfc6578
+        data = """<?xml version="1.0" encoding="utf-8" ?>
+            <sync-collection xmlns="DAV:">
+                <sync-token>{sync_token}</sync-token>
+                <sync-level>1</sync-level>
+                <prop>
+                    <getcontenttype/>
+                    <getetag/>
+                </prop>
+            </sync-collection>"""
+
+        collection_href = self._normalize_href(self.session.url).rstrip("/")
+
+        while True:
+            xml = data.format(sync_token=escape(sync_token)).encode("utf-8")
+            try:
+                r = await self.session.request(
+                    "REPORT",
+                    "",
+                    data=xml,
+                    headers=self.session.get_default_headers(),
+                )
+            except (aiohttp.ClientResponseError, exceptions.PreconditionFailed) as e:
+                # Servers respond with 403 or 409 if the token is invalid, and
+                # with a variety of status codes if they don't support the
+                # report at all.
+                raise exceptions.InvalidSyncToken(str(e))
+
+            truncated = False
+            new_token = None
+            try:
+                async for response in _iter_xml_elements(
+                    r, ("{DAV:}response", "{DAV:}sync-token")
+                ):
+                    if response.tag == "{DAV:}sync-token":
+                        new_token = response.text
+                        continue
+
+                    href = response.find("{DAV:}href")
+                    if href is None:
+                        dav_logger.error("Skipping response, href is missing.")
+                        continue
+                    href = self._normalize_href(href.text)
+
+                    status = _parse_status_code(response.find("{DAV:}status"))
+                    if href.rstrip("/") == collection_href:
+                        # The server may truncate the result, and then expects
+                        # us to continue with the sync-token it returned.
+                        truncated = status == 507
+                    elif status == 404:
+                        yield href, None
+                    elif status is None:
+                        rv = self._parse_item_props(href, response)
+                        if rv is not None:
+                            yield rv[0], rv[1]
+            except InvalidXMLResponse as e:
+                # The server doesn't seem to support the report after all.
+                raise exceptions.InvalidSyncToken(str(e))
+
+            if not truncated or not new_token or new_token == sync_token:
+                break
+            sync_token = new_token
 
     async def get_meta(self, key) -> str | None:
         try:
@@ -776,6 +1109,7 @@ class CalDAVStorage(DAVStorage):
         </C:calendar-multiget>"""
 
     get_multi_data_query = "{urn:ietf:params:xml:ns:caldav}calendar-data"
+    multiget_report = "{urn:ietf:params:xml:ns:caldav}calendar-multiget"
 
     _property_table = dict(DAVStorage._property_table)
     _property_table.update(
@@ -836,6 +1170,16 @@ class CalDAVStorage(DAVStorage):
                     ("VTODO", "VEVENT"), start, end
                 )
 
+    async def get_collection_tokens(self):
+        if self.start_date is not None:
+            # The time range may move while the collection doesn't change,
+            # and a sync-collection report can't be filtered.
+            return None, None
+        ctag, sync_token = await super().get_collection_tokens()
+        if self.item_types:
+            sync_token = None
+        return ctag, sync_token
+
     async def list(self):
         caldavfilters = list(
             self._get_list_filters(self.item_types, self.start_date, self.end_date)
@@ -874,16 +1218,16 @@ class CalDAVStorage(DAVStorage):
 
         for caldavfilter in caldavfilters:
             xml = data.format(caldavfilter=caldavfilter).encode("utf-8")
-            response = await self.session.request(
-                "REPORT",
-                "",
-                data=xml,
-                headers=headers,
-            )
-            root = _parse_xml(await response.content.read())
-            rv = self._parse_prop_responses(root, handled_hrefs)
-            for href, etag, _prop in rv:
-                yield href, etag
+            async with self.session.limit_listings():
+                response = await self.session.request(
+                    "REPORT",
+                    "",
+                    data=xml,
+                    headers=headers,
+                )
+                rv = self._parse_prop_responses(response, handled_hrefs)
+                async for href, etag, _prop in rv:
+                    yield href, etag
 
 
 class CardDAVStorage(DAVStorage):
@@ -910,6 +1254,7 @@ class CardDAVStorage(DAVStorage):
             </C:addressbook-multiget>"""
 
     get_multi_data_query = "{urn:ietf:params:xml:ns:carddav}address-data"
+    multiget_report = "{urn:ietf:params:xml:ns:carddav}addressbook-multiget"
 
     _property_table = dict(DAVStorage._property_table)
     _property_table.update(
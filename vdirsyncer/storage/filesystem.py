@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import errno
 import logging
 import os
-import subprocess
+import stat
+import tempfile
+import threading
 
 from vdirsyncer import exceptions
 from vdirsyncer.utils import atomic_write
@@ -12,6 +15,8 @@ from vdirsyncer.utils import checkdir
 from vdirsyncer.utils import expand_path
 from vdirsyncer.utils import generate_href
 from vdirsyncer.utils import get_etag_from_file
+from vdirsyncer.utils import get_etag_from_stat
+from vdirsyncer.utils import uniq
 from vdirsyncer.vobject import Item
 
 from .base import Storage
@@ -23,6 +28,19 @@ logger = logging.getLogger(__name__)
 class FilesystemStorage(Storage):
     storage_name = "filesystem"
     _repr_attributes = ("path",)
+    # The etag of a file is made up of its mtime and inode, so the item cache
+    # of the sync recognizes unchanged files by their hash alone, and reading
+    # the few files that are actually needed is cheap.
+    cache_bodies = False
+
+    # How many files to read or write at the same time. File I/O runs in
+    # threads, so that it doesn't block the network requests of other
+    # storages.
+    io_concurrency = 8
+    # How many hooks to run at the same time, and how many paths to pass to a
+    # single call of the post_hook.
+    hook_concurrency = 4
+    post_hook_batch_size = 1
 
     def __init__(
         self,
@@ -32,9 +50,37 @@ class FilesystemStorage(Storage):
         post_hook=None,
         pre_deletion_hook=None,
         fileignoreext=".tmp",
+        io_concurrency=None,
+        hook_concurrency=None,
+        post_hook_batch_size=None,
         **kwargs,
     ):
         super().__init__(**kwargs)
+        for name, value in (
+            ("io_concurrency", io_concurrency),
+            ("hook_concurrency", hook_concurrency),
+            ("post_hook_batch_size", post_hook_batch_size),
+        ):
+            if value is None:
+                continue
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise exceptions.UserError(
+                    f"{name} must be a positive integer, got {value!r}."
+                )
+            setattr(self, name, value)
+        # Created on first use, within the event loop.
+        self._io_semaphore = None
+        self._hook_semaphore = None
+        # Guards the following three, which are used from the I/O threads.
+        self._lock = threading.Lock()
+        # Files written within `at_once`, which aren't at their destination
+        # yet, {destination: (temporary path, overwrite)}
+        self._staged = None
+        # Paths the post_hook still has to be called with.
+        self._post_hook_paths = []
+        # Hrefs of new files that couldn't be published, because another
+        # file was created at their destination in the meantime.
+        self._publish_conflicts = []
         path = expand_path(path)
         checkdir(path, create=False)
         self.path = path
@@ -43,6 +89,7 @@ class FilesystemStorage(Storage):
         self.fileignoreext = fileignoreext
         self.post_hook = post_hook
         self.pre_deletion_hook = pre_deletion_hook
+        self._watcher = None
 
     @classmethod
     async def discover(cls, path, **kwargs):
@@ -88,21 +135,101 @@ class FilesystemStorage(Storage):
     def _get_href(self, ident):
         return generate_href(ident) + self.fileext
 
+    @staticmethod
+    def _get_file_etag(fpath):
+        """Return the etag of a regular file, or ``None`` if there's none."""
+        try:
+            st = os.stat(fpath)
+        except FileNotFoundError:
+            return None
+        return get_etag_from_stat(st) if stat.S_ISREG(st.st_mode) else None
+
+    def _is_item_filename(self, fname):
+        return fname.endswith(self.fileext) and not fname.endswith(self.fileignoreext)
+
     async def list(self):
-        for fname in os.listdir(self.path):
-            fpath = os.path.join(self.path, fname)
-            if (
-                os.path.isfile(fpath)
-                and fname.endswith(self.fileext)
-                and (not fname.endswith(self.fileignoreext))
-            ):
-                yield fname, get_etag_from_file(fpath)
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                # Filter by name first, so that other files don't cost a stat.
+                if not self._is_item_filename(entry.name):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed (or a broken symlink)
+                if stat.S_ISREG(st.st_mode):
+                    yield entry.name, get_etag_from_stat(st)
+
+    def attach_watcher(self, watcher):
+        """Record changes to the directory with a
+        :py:class:`vdirsyncer.watch.DirectoryWatcher`, so that it can be
+        listed incrementally."""
+        watcher.watch(self.path)
+        self._watcher = watcher
+
+    async def get_sync_token(self) -> str | None:
+        if self._watcher is None:
+            return None
+        return self._watcher.get_token(self.path)
+
+    async def list_changes(self, sync_token):
+        changes = None
+        if self._watcher is not None:
+            changes = self._watcher.changes_since(self.path, sync_token)
+        if changes is None:
+            raise exceptions.InvalidSyncToken(sync_token)
+
+        for fname in changes:
+            if not self._is_item_filename(fname):
+                continue
+            yield fname, self._get_file_etag(os.path.join(self.path, fname))
+
+    async def _run_io(self, f, *args):
+        """Run the blocking function ``f`` in a thread."""
+        if self._io_semaphore is None:
+            self._io_semaphore = asyncio.Semaphore(self.io_concurrency)
+        async with self._io_semaphore:
+            return await asyncio.to_thread(f, *args)
 
     async def get(self, href) -> tuple[Item, str]:
+        try:
+            return await self._run_io(self._get_blocking, href)
+        finally:
+            # The item may have been published just now.
+            await self._run_post_hooks()
+
+    async def get_multi(self, hrefs):
+        # Read up to `io_concurrency` files at the same time, and yield them
+        # in the order they are done.
+        hrefs = iter(uniq(hrefs))
+        running = {}
+        try:
+            while True:
+                for href in hrefs:
+                    running[asyncio.ensure_future(self.get(href))] = href
+                    if len(running) >= self.io_concurrency:
+                        break
+                if not running:
+                    break
+
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    href = running.pop(task)
+                    item, etag = task.result()
+                    yield href, item, etag
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    def _get_blocking(self, href):
         fpath = self._get_filepath(href)
+        self._publish_staged([fpath])
         try:
             with open(fpath, "rb") as f:
-                return (Item(f.read().decode(self.encoding)), get_etag_from_file(fpath))
+                return (Item(f.read().decode(self.encoding)), get_etag_from_file(f))
         except OSError as e:
             if e.errno == errno.ENOENT:
                 raise exceptions.NotFoundError(href)
@@ -110,31 +237,35 @@ class FilesystemStorage(Storage):
                 raise
 
     async def upload(self, item):
+        try:
+            return await self._run_io(self._upload_blocking, item)
+        finally:
+            await self._run_post_hooks()
+
+    def _upload_blocking(self, item):
         if not isinstance(item.raw, str):
             raise TypeError("item.raw must be a unicode string.")
 
         try:
             href = self._get_href(item.ident)
-            fpath, etag = self._upload_impl(item, href)
+            etag = self._upload_impl(item, href)
         except OSError as e:
             if e.errno in (errno.ENAMETOOLONG, errno.ENOENT):  # Unix  # Windows
                 logger.debug("UID as filename rejected, trying with random one.")
                 # random href instead of UID-based
                 href = self._get_href(None)
-                fpath, etag = self._upload_impl(item, href)
+                etag = self._upload_impl(item, href)
             else:
                 raise
 
-        if self.post_hook:
-            self._run_post_hook(fpath)
         return href, etag
 
     def _upload_impl(self, item, href):
         fpath = self._get_filepath(href)
         try:
-            with atomic_write(fpath, mode="wb", overwrite=False) as f:
-                f.write(item.raw.encode(self.encoding))
-                return fpath, get_etag_from_file(f)
+            return self._write_file(
+                fpath, item.raw.encode(self.encoding), overwrite=False
+            )
         except OSError as e:
             if e.errno == errno.EEXIST:
                 raise exceptions.AlreadyExistingError(existing_href=href)
@@ -142,51 +273,235 @@ class FilesystemStorage(Storage):
                 raise
 
     async def update(self, href, item, etag):
+        try:
+            return await self._run_io(self._update_blocking, href, item, etag)
+        finally:
+            await self._run_post_hooks()
+
+    def _update_blocking(self, href, item, etag):
         fpath = self._get_filepath(href)
-        if not os.path.exists(fpath):
+        self._publish_staged([fpath])
+        try:
+            actual_etag = get_etag_from_file(fpath)
+        except FileNotFoundError:
             raise exceptions.NotFoundError(item.uid)
-        actual_etag = get_etag_from_file(fpath)
         if etag != actual_etag:
             raise exceptions.WrongEtagError(etag, actual_etag)
 
         if not isinstance(item.raw, str):
             raise TypeError("item.raw must be a unicode string.")
 
-        with atomic_write(fpath, mode="wb", overwrite=True) as f:
-            f.write(item.raw.encode(self.encoding))
-            etag = get_etag_from_file(f)
-
-        if self.post_hook:
-            self._run_post_hook(fpath)
-        return etag
+        return self._write_file(fpath, item.raw.encode(self.encoding), overwrite=True)
 
     async def delete(self, href, etag):
+        try:
+            if not self.pre_deletion_hook:
+                await self._run_io(self._delete_blocking, href, etag)
+                return
+
+            fpath = await self._run_io(self._check_etag, href, etag)
+            await self._run_hook("pre_deletion_hook", self.pre_deletion_hook, [fpath])
+            await self._run_io(os.remove, fpath)
+        finally:
+            await self._run_post_hooks()
+
+    def _check_etag(self, href, etag):
+        """Check that the file of ``href`` has the given etag, and return its
+        path."""
         fpath = self._get_filepath(href)
-        if not os.path.isfile(fpath):
+        self._publish_staged([fpath])
+        actual_etag = self._get_file_etag(fpath)
+        if actual_etag is None:
             raise exceptions.NotFoundError(href)
-        actual_etag = get_etag_from_file(fpath)
         if etag != actual_etag:
             raise exceptions.WrongEtagError(etag, actual_etag)
-        if self.pre_deletion_hook:
-            self._run_pre_deletion_hook(fpath)
+        return fpath
+
+    def _delete_blocking(self, href, etag):
+        os.remove(self._check_etag(href, etag))
+
+    def _write_file(self, fpath, data, overwrite):
+        """Write a file atomically, queue the post_hook for it, and return the
+        file's etag.
+
+        Within :py:meth:`at_once`, the file is written to a temporary file and
+        synced to disk, and only moved to ``fpath`` when the block ends.
+        """
+        with self._lock:
+            staged = self._staged is not None
+        if not staged:
+            with atomic_write(fpath, mode="wb", overwrite=overwrite) as f:
+                f.write(data)
+                etag = get_etag_from_file(f)
+            self._queue_post_hook([fpath])
+            return etag
+
+        fd, src = tempfile.mkstemp(
+            prefix=os.path.basename(fpath), dir=os.path.dirname(fpath)
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                _fdatasync(f.fileno())
+                # Renaming or linking the file doesn't change its inode or
+                # mtime, so this is the etag it will have.
+                etag = get_etag_from_stat(os.fstat(f.fileno()))
+
+            with self._lock:
+                if self._staged is None:
+                    # `at_once` ended in the meantime.
+                    _publish_file(src, fpath, overwrite)
+                    staged = False
+                elif not overwrite and (
+                    fpath in self._staged or os.path.lexists(fpath)
+                ):
+                    raise FileExistsError(errno.EEXIST, "File exists", fpath)
+                else:
+                    old = self._staged.get(fpath)
+                    self._staged[fpath] = src, overwrite
+                    if old is not None:
+                        os.unlink(old[0])
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(src)
+            raise
 
-        os.remove(fpath)
+        if not staged:
+            self._queue_post_hook([fpath])
+        return etag
 
-    def _run_post_hook(self, fpath):
-        logger.info(f"Calling post_hook={self.post_hook} with argument={fpath}")
-        try:
-            subprocess.call([self.post_hook, fpath])
-        except OSError as e:
-            logger.warning(f"Error executing external hook: {e!s}")
+    def _publish_staged(self, fpaths=None):
+        """Move files written within :py:meth:`at_once` to their destination.
+
+        :param fpaths: Only publish these files, if they are staged. By
+            default, all of them are published, and writing ends.
+        """
+        with self._lock:
+            if self._staged is None:
+                return
+            if fpaths is None:
+                batch, self._staged = self._staged, None
+            else:
+                batch = {
+                    fpath: self._staged.pop(fpath)
+                    for fpath in fpaths
+                    if fpath in self._staged
+                }
+            if not batch:
+                return
+
+            published = []
+            error = None
+            for fpath, (src, overwrite) in batch.items():
+                try:
+                    _publish_file(src, fpath, overwrite)
+                except OSError as e:
+                    with contextlib.suppress(OSError):
+                        os.unlink(src)
+                    if e.errno == errno.EEXIST:
+                        # Only this item is lost, the others can still be
+                        # published.
+                        href = os.path.basename(fpath)
+                        logger.debug(f"Couldn't publish {href}, it exists already.")
+                        self._publish_conflicts.append(href)
+                    else:
+                        error = error or e
+                else:
+                    published.append(fpath)
+            # The content of the files is synced already, this makes their
+            # names durable.
+            _fsync_dir(self.path)
+
+        self._queue_post_hook(published)
+        if error is not None:
+            raise error
+
+    @contextlib.asynccontextmanager
+    async def at_once(self):
+        """Write files in batches.
+
+        Instead of writing every file separately, the files are synced to
+        disk in parallel, and then moved to their destination at the same time
+        with only one sync of the directory.
+        """
+        with self._lock:
+            nested = self._staged is not None
+            if not nested:
+                self._staged = {}
+        if nested:
+            yield
+            return
 
-    def _run_pre_deletion_hook(self, fpath):
-        logger.info(
-            f"Calling pre_deletion_hook={self.pre_deletion_hook} with argument={fpath}"
-        )
         try:
-            subprocess.call([self.pre_deletion_hook, fpath])
-        except OSError as e:
-            logger.warning(f"Error executing external hook: {e!s}")
+            yield
+        finally:
+            # Even after errors, since the sync status already contains the
+            # files that were written successfully.
+            publish = asyncio.ensure_future(self._run_io(self._publish_staged))
+            cancelled = False
+            while not publish.done():
+                # The post_hook has to be called for the files that are
+                # published, so wait for them even if cancelled.
+                try:
+                    await asyncio.wait([publish])
+                except asyncio.CancelledError:
+                    cancelled = True
+            try:
+                publish.result()
+            finally:
+                await self._run_post_hooks()
+            if cancelled:
+                raise asyncio.CancelledError
+
+    def pop_publish_conflicts(self):
+        """Return and forget the hrefs of new files that :py:meth:`at_once`
+        couldn't publish, because another file was created at their path in
+        the meantime.
+
+        Their uploads succeeded, but the storage doesn't contain them.
+        """
+        with self._lock:
+            rv, self._publish_conflicts = self._publish_conflicts, []
+        return rv
+
+    def _queue_post_hook(self, fpaths):
+        if self.post_hook:
+            with self._lock:
+                self._post_hook_paths.extend(fpaths)
+
+    async def _run_post_hooks(self):
+        """Call the post_hook with the queued paths.
+
+        Within :py:meth:`at_once`, the paths are passed to the hook in batches
+        of ``post_hook_batch_size``, and incomplete batches are kept until
+        the block ends.
+        """
+        size = self.post_hook_batch_size
+        with self._lock:
+            n = len(self._post_hook_paths)
+            if self._staged is not None:
+                n -= n % size
+            fpaths = self._post_hook_paths[:n]
+            del self._post_hook_paths[:n]
+
+        await asyncio.gather(
+            *(
+                self._run_hook("post_hook", self.post_hook, fpaths[i : i + size])
+                for i in range(0, len(fpaths), size)
+            )
+        )
+
+    async def _run_hook(self, name, hook, fpaths):
+        if self._hook_semaphore is None:
+            self._hook_semaphore = asyncio.Semaphore(self.hook_concurrency)
+        async with self._hook_semaphore:
+            logger.info(f"Calling {name}={hook} with argument={' '.join(fpaths)}")
+            try:
+                process = await asyncio.create_subprocess_exec(hook, *fpaths)
+                await process.wait()
+            except OSError as e:
+                logger.warning(f"Error executing external hook: {e!s}")
 
     async def get_meta(self, key):
         fpath = os.path.join(self.path, key)
@@ -209,3 +524,27 @@ class FilesystemStorage(Storage):
         else:
             with atomic_write(fpath, mode="wb", overwrite=True) as f:
                 f.write(value.encode(self.encoding))
+
+
+def _fdatasync(fd):
+    # Not available on macOS
+    getattr(os, "fdatasync", os.fsync)(fd)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # Directories can't be opened on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _publish_file(src, dest, overwrite):
+    if overwrite:
+        os.replace(src, dest)
+    else:
+        os.link(src, dest)
+        os.unlink(src)
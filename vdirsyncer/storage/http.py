@@ -1,7 +1,13 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import json
 import logging
-import subprocess
+import mmap
+import os
+import shutil
+import tempfile
 import urllib.parse as urlparse
 
 import aiohttp
@@ -12,19 +18,54 @@ from vdirsyncer.http import prepare_auth
 from vdirsyncer.http import prepare_client_cert
 from vdirsyncer.http import prepare_verify
 from vdirsyncer.http import request
+from vdirsyncer.utils import atomic_write
 from vdirsyncer.vobject import Item
+from vdirsyncer.vobject import index_collection
 from vdirsyncer.vobject import split_collection
 
 from .base import Storage
 
 logger = logging.getLogger(__name__)
 
+# The size of the chunks in which responses and the output of the
+# filter_hook are read.
+CHUNK_SIZE = 64 * 1024
+
+FILTER_HOOK_MODES = ("item", "stream")
+
+
+def _decode_hook_output(data):
+    # Like the text mode of `subprocess`, which filter hooks used to be run
+    # with.
+    return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _split_file(f):
+    """Split the collection in the file ``f`` like :py:func:`split_collection`,
+    but without reading all of it into memory."""
+    if not f.seek(0, os.SEEK_END):
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        index = index_collection(data, read_items=False)
+        if index is None:
+            yield from split_collection(data[:].decode("utf-8"))
+            return
+        for _, spans in index.items:
+            yield index.read_item(data, spans)
+
 
 class HttpStorage(Storage):
     storage_name = "http"
     read_only = True
     _repr_attributes = ("username", "url")
+    # {href: (item, etag)}, where item is None if the collection didn't
+    # change since it was listed last time and wasn't downloaded.
     _items = None
+    # See `set_list_cache`.
+    _list_cache_path = None
+
+    # How many seconds to wait for output of the filter_hook.
+    filter_hook_timeout = 60
 
     # Required for tests.
     _ignore_uids = True
@@ -40,6 +81,8 @@ class HttpStorage(Storage):
         verify_fingerprint=None,
         auth_cert=None,
         filter_hook=None,
+        filter_hook_mode="item",
+        filter_hook_timeout=None,
         *,
         connector,
         **kwargs,
@@ -63,6 +106,23 @@ class HttpStorage(Storage):
         assert connector is not None
         self.connector = connector
         self._filter_hook = filter_hook
+        if filter_hook_mode not in FILTER_HOOK_MODES:
+            raise exceptions.UserError(
+                f"filter_hook_mode must be one of {', '.join(FILTER_HOOK_MODES)}, "
+                f"got {filter_hook_mode!r}."
+            )
+        self.filter_hook_mode = filter_hook_mode
+        if filter_hook_timeout is not None:
+            if (
+                not isinstance(filter_hook_timeout, (int, float))
+                or isinstance(filter_hook_timeout, bool)
+                or filter_hook_timeout <= 0
+            ):
+                raise exceptions.UserError(
+                    "filter_hook_timeout must be a positive number, got "
+                    f"{filter_hook_timeout!r}."
+                )
+            self.filter_hook_timeout = filter_hook_timeout
 
         collection = kwargs.get("collection")
         if collection is not None:
@@ -73,20 +133,234 @@ class HttpStorage(Storage):
     def _default_headers(self):
         return {"User-Agent": self.useragent}
 
-    def _run_filter_hook(self, raw_item):
+    def _filter_hook_timed_out(self):
+        return exceptions.UserError(
+            f"filter_hook {self._filter_hook} didn't respond within "
+            f"{self.filter_hook_timeout} seconds."
+        )
+
+    async def _run_filter_hook(self, raw_item):
+        """Run the filter_hook for a single item."""
         try:
-            result = subprocess.run(
-                [self._filter_hook],
-                input=raw_item,
-                capture_output=True,
-                encoding="utf-8",
+            process = await asyncio.create_subprocess_exec(
+                self._filter_hook,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
             )
-            return result.stdout
         except OSError as e:
             logger.warning(f"Error executing external command: {e!s}")
             return raw_item
 
-    async def list(self):
+        try:
+            stdout, _ = await asyncio.wait_for(
+                process.communicate(raw_item.encode("utf-8")),
+                self.filter_hook_timeout,
+            )
+        except asyncio.TimeoutError:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
+            raise self._filter_hook_timed_out()
+        return _decode_hook_output(stdout)
+
+    async def _run_filter_process(self, raw_items):
+        """Run the filter_hook once for all items.
+
+        Every item is written to its stdin followed by a NUL byte, and the
+        hook writes each filtered item followed by a NUL byte to its stdout,
+        in the same order. An empty item is skipped.
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(
+                self._filter_hook,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            logger.warning(f"Error executing external command: {e!s}")
+            for raw_item in raw_items:
+                yield raw_item
+            return
+
+        sent = 0
+
+        async def feed():
+            nonlocal sent
+            try:
+                for raw_item in raw_items:
+                    sent += 1
+                    process.stdin.write(raw_item.encode("utf-8") + b"\0")
+                    await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # The hook exited, which is noticed when reading its output.
+                pass
+            finally:
+                process.stdin.close()
+
+        writer = asyncio.ensure_future(feed())
+        received = 0
+        try:
+            async for record in self._read_records(process.stdout):
+                received += 1
+                yield _decode_hook_output(record)
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(writer, process.wait()), self.filter_hook_timeout
+                )
+            except asyncio.TimeoutError:
+                raise self._filter_hook_timed_out()
+            if received != sent:
+                raise exceptions.UserError(
+                    f"filter_hook {self._filter_hook} returned {received} items "
+                    f"instead of {sent}."
+                )
+        finally:
+            writer.cancel()
+            if process.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+
+    async def _read_records(self, stream):
+        """Read the NUL-terminated records from ``stream``."""
+        buf = bytearray()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(
+                    stream.read(CHUNK_SIZE), self.filter_hook_timeout
+                )
+            except asyncio.TimeoutError:
+                raise self._filter_hook_timed_out()
+            if not chunk:
+                if buf:
+                    raise exceptions.UserError(
+                        f"The output of filter_hook {self._filter_hook} doesn't "
+                        "end with a NUL byte."
+                    )
+                return
+            buf += chunk
+            if b"\0" in chunk:
+                *records, rest = bytes(buf).split(b"\0")
+                buf = bytearray(rest)
+                for record in records:
+                    yield record
+
+    async def _filter_items(self, raw_items):
+        if not self._filter_hook:
+            for raw_item in raw_items:
+                yield raw_item
+        elif self.filter_hook_mode == "stream":
+            async for raw_item in self._run_filter_process(raw_items):
+                yield raw_item
+        else:
+            for raw_item in raw_items:
+                yield await self._run_filter_hook(raw_item)
+
+    def set_list_cache(self, path):
+        """Keep the listing of the collection and the ``ETag`` and
+        ``Last-Modified`` headers of the response in the file ``path``.
+
+        The collection is then only downloaded again if the server says it
+        changed.
+        """
+        self._list_cache_path = path
+
+    def _get_filter_hook_mtime(self):
+        """Return the modification time of the filter_hook's executable, so
+        that the cached listing isn't used after the hook was changed."""
+        if not self._filter_hook:
+            return None
+        path = shutil.which(self._filter_hook)
+        if path is None:
+            return None
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_list_cache(self):
+        if self._list_cache_path is None:
+            return None
+        try:
+            with open(self._list_cache_path) as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring {self._list_cache_path}: {e}")
+            return None
+
+        if not isinstance(cache, dict) or (
+            cache.get("url"),
+            cache.get("filter_hook"),
+            cache.get("filter_hook_mode", "item"),
+            cache.get("filter_hook_mtime"),
+        ) != (
+            self.url,
+            self._filter_hook,
+            self.filter_hook_mode,
+            self._get_filter_hook_mtime(),
+        ):
+            return None
+        try:
+            cache["items"] = [(str(href), str(etag)) for href, etag in cache["items"]]
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring {self._list_cache_path}: {e}")
+            return None
+        return cache
+
+    def _write_list_cache(self, headers):
+        if self._list_cache_path is None:
+            return
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            # The old validators would refer to an older version of the
+            # collection.
+            try:
+                os.remove(self._list_cache_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Can't remove {self._list_cache_path}: {e}")
+            return
+
+        cache = {
+            "url": self.url,
+            "filter_hook": self._filter_hook,
+            "filter_hook_mode": self.filter_hook_mode,
+            "filter_hook_mtime": self._get_filter_hook_mtime(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "items": [
+                [href, item_etag] for href, (_, item_etag) in self._items.items()
+            ],
+        }
+        try:
+            with atomic_write(self._list_cache_path, mode="wb", overwrite=True) as f:
+                f.write(json.dumps(cache).encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"Can't write {self._list_cache_path}: {e}")
+
+    async def _download(self, cache=None):
+        """Download and split the collection.
+
+        The response is written to a temporary file first, so that only the
+        item that is being processed has to be kept in memory next to the
+        items that were found.
+
+        :param cache: What :py:meth:`_read_list_cache` returned. If given,
+            the collection is only downloaded if it changed since then, and
+            its items are taken from there otherwise.
+        """
+        headers = self._default_headers()
+        if cache is not None:
+            if cache.get("etag"):
+                headers["If-None-Match"] = cache["etag"]
+            if cache.get("last_modified"):
+                headers["If-Modified-Since"] = cache["last_modified"]
+
         async with aiohttp.ClientSession(
             connector=self.connector,
             connector_owner=False,
@@ -96,15 +370,27 @@ class HttpStorage(Storage):
             r = await request(
                 "GET",
                 self.url,
-                headers=self._default_headers(),
+                headers=headers,
                 session=session,
                 **self._settings,
             )
-        self._items = {}
 
-        for raw_item in split_collection((await r.read()).decode("utf-8")):
-            if self._filter_hook:
-                raw_item = self._run_filter_hook(raw_item)
+            if cache is not None and r.status == 304:
+                logger.debug(f"{self.url} didn't change since the last sync.")
+                self._items = {href: (None, etag) for href, etag in cache["items"]}
+                return
+
+            with tempfile.TemporaryFile() as f:
+                async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                    f.write(chunk)
+                f.flush()
+                self._items = await self._split_items(_split_file(f))
+
+        self._write_list_cache(r.headers)
+
+    async def _split_items(self, raw_items):
+        rv = {}
+        async for raw_item in self._filter_items(raw_items):
             if not raw_item:
                 continue
 
@@ -112,8 +398,11 @@ class HttpStorage(Storage):
             if self._ignore_uids:
                 item = item.with_uid(item.hash)
 
-            self._items[item.ident] = item, item.hash
+            rv[item.ident] = item, item.hash
+        return rv
 
+    async def list(self):
+        await self._download(self._read_list_cache())
         for href, (_, etag) in self._items.items():
             yield href, etag
 
@@ -123,6 +412,10 @@ class HttpStorage(Storage):
                 pass
 
         assert self._items is not None  # type assertion
+        if href in self._items and self._items[href][0] is None:
+            # The items weren't downloaded since they didn't change, but now
+            # one of them is needed.
+            await self._download()
         try:
             return self._items[href]
         except KeyError:
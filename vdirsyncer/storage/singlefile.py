@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import bisect
 import collections
 import contextlib
+import errno
 import functools
 import glob
+import itertools
+import json
 import logging
+import mmap
 import os
 from collections.abc import Iterable
 
@@ -13,8 +18,11 @@ from vdirsyncer.utils import atomic_write
 from vdirsyncer.utils import checkfile
 from vdirsyncer.utils import expand_path
 from vdirsyncer.utils import get_etag_from_file
+from vdirsyncer.utils import get_etag_from_stat
 from vdirsyncer.utils import uniq
+from vdirsyncer.vobject import CollectionIndex
 from vdirsyncer.vobject import Item
+from vdirsyncer.vobject import index_collection
 from vdirsyncer.vobject import join_collection
 from vdirsyncer.vobject import split_collection
 
@@ -22,6 +30,9 @@ from .base import Storage
 
 logger = logging.getLogger(__name__)
 
+# Bumped whenever the format of the persisted index changes.
+_INDEX_VERSION = 1
+
 
 def _writing_op(f):
     """Implement at_once for write operations.
@@ -33,9 +44,7 @@ def _writing_op(f):
 
     @functools.wraps(f)
     async def inner(self, *args, **kwargs):
-        if self._items is None or not self._at_once:
-            async for _ in self.list():
-                pass
+        await self._load()
         assert self._items is not None
         rv = await f(self, *args, **kwargs)
         if not self._at_once:
@@ -53,17 +62,28 @@ class SingleFileStorage(Storage):
     _append_mode = "ab"
     _read_mode = "rb"
 
+    # {href: (item, etag)}, where item is None if it wasn't read yet.
     _items = None
     _last_etag = None
+    # Where the components of each item are in the file, {href: [(start,
+    # end)]}, or None if the file can only be rewritten as a whole.
+    _spans = None
+    # The layout of the file, see `vdirsyncer.vobject.CollectionIndex`.
+    _index = None
 
-    def __init__(self, path, encoding="utf-8", **kwargs):
+    def __init__(self, path, encoding="utf-8", persistent_index=False, **kwargs):
         super().__init__(**kwargs)
         path = os.path.abspath(expand_path(path))
         checkfile(path, create=False)
 
         self.path = path
         self.encoding = encoding
+        self.persistent_index = persistent_index
+        dirname, basename = os.path.split(path)
+        self._index_path = os.path.join(dirname, f".{basename}.vdirsyncer-index")
         self._at_once = False
+        # The hrefs that were changed since the file was written.
+        self._dirty = {}
 
     @classmethod
     async def discover(cls, path, **kwargs):
@@ -112,41 +132,168 @@ class SingleFileStorage(Storage):
 
     async def list(self):
         self._items = collections.OrderedDict()
+        self._spans = None
+        self._index = None
+        self._dirty = {}
 
         try:
-            self._last_etag = get_etag_from_file(self.path)
-            with open(self.path, self._read_mode) as f:
-                text = f.read().decode(self.encoding)
+            st = os.stat(self.path)
         except OSError as e:
-            import errno
-
             if e.errno != errno.ENOENT:  # file not found
                 raise OSError(e)
-            text = None
+            self._last_etag = None
+            return
+        self._last_etag = get_etag_from_stat(st)
+
+        if not self.persistent_index or not self._read_index(st):
+            self._read_file(st)
+
+        for href, (_, etag) in self._items.items():
+            yield href, etag
+
+    def _read_file(self, st):
+        with open(self.path, self._read_mode) as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                index = index_collection(data, self.encoding)
+                if index is None:
+                    items = [
+                        (raw, None)
+                        for raw in split_collection(data[:].decode(self.encoding))
+                    ]
+                else:
+                    items = index.items
+                    index.items = []
+                    self._index = index
+                    self._spans = {}
+
+        for raw, spans in items:
+            item = Item(raw)
+            href = item.ident
+            if href in self._items:
+                # Only the last of them would be written back.
+                self._spans = self._index = None
+            elif self._spans is not None:
+                self._spans[href] = spans
+            self._items[href] = item, item.hash
+
+        if self.persistent_index and self._index is not None:
+            self._write_index(st)
+
+    def _read_index(self, st):
+        """Load the index written by :py:meth:`_write_index`, if it was
+        written for the current version of the file.
+
+        The items aren't read, :py:meth:`_read_items` does that when they're
+        needed.
+
+        :returns: Whether the index could be used.
+        """
+        try:
+            with open(self._index_path, "rb") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring the index {self._index_path}: {e}")
+            return False
+
+        if not isinstance(data, dict) or (
+            data.get("version"),
+            data.get("etag"),
+            data.get("size"),
+            data.get("encoding"),
+        ) != (_INDEX_VERSION, self._last_etag, st.st_size, self.encoding):
+            return False
 
-        if text:
-            for item in split_collection(text):
-                item = Item(item)
-                etag = item.hash
-                href = item.ident
-                self._items[href] = item, etag
+        try:
+            index = CollectionIndex.from_dict(data["index"])
+            spans = {}
+            for href, etag, item_spans in data["items"]:
+                spans[href] = [(int(start), int(end)) for start, end in item_spans]
+                self._items[href] = None, etag
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring the index {self._index_path}: {e}")
+            self._items.clear()
+            return False
+
+        self._index = index
+        self._spans = spans
+        return True
+
+    def _write_index(self, st):
+        """Store where the items are in the file ``st`` belongs to, so that
+        it doesn't have to be parsed again while it stays the same."""
+        data = {
+            "version": _INDEX_VERSION,
+            "etag": get_etag_from_stat(st),
+            "size": st.st_size,
+            "encoding": self.encoding,
+            "index": self._index.to_dict(),
+            "items": [
+                [href, etag, self._spans[href]]
+                for href, (_, etag) in self._items.items()
+            ],
+        }
+        try:
+            with atomic_write(self._index_path, mode="wb", overwrite=True) as f:
+                f.write(json.dumps(data).encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"Can't write the index {self._index_path}: {e}")
+
+    def _remove_index(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._index_path)
+
+    def _read_items(self, hrefs):
+        """Read the items of ``hrefs`` that weren't read yet from the file."""
+        hrefs = [
+            href
+            for href in hrefs
+            if href in self._items and self._items[href][0] is None
+        ]
+        if not hrefs:
+            return
+
+        with (
+            open(self.path, self._read_mode) as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+        ):
+            for href in hrefs:
+                _, etag = self._items[href]
+                raw = self._index.read_item(data, self._spans[href], self.encoding)
+                self._items[href] = Item(raw), etag
+
+    async def _load(self):
+        """Read the file, unless it is already loaded and didn't change."""
+        if self._items is not None:
+            if self._at_once:
+                return
+            try:
+                etag = get_etag_from_file(self.path)
+            except FileNotFoundError:
+                etag = None
+            if etag == self._last_etag:
+                return
 
-                yield href, etag
+        async for _ in self.list():
+            pass
 
     async def get(self, href) -> tuple[Item, str]:
-        if self._items is None or not self._at_once:
-            async for _ in self.list():
-                pass
+        await self._load()
 
         assert self._items is not None  # type assertion
-        try:
-            return self._items[href]
-        except KeyError:
+        if href not in self._items:
             raise exceptions.NotFoundError(href)
+        self._read_items([href])
+        return self._items[href]
 
     async def get_multi(self, hrefs: Iterable[str]):
         async with self.at_once():
-            for href in uniq(hrefs):
+            hrefs = list(uniq(hrefs))
+            self._read_items(hrefs)
+            for href in hrefs:
                 item, etag = await self.get(href)
                 yield href, item, etag
 
@@ -157,6 +304,7 @@ class SingleFileStorage(Storage):
             raise exceptions.AlreadyExistingError(existing_href=href)
 
         self._items[href] = item, item.hash
+        self._dirty[href] = None
         return href, item.hash
 
     @_writing_op
@@ -169,6 +317,7 @@ class SingleFileStorage(Storage):
             raise exceptions.WrongEtagError(etag, actual_etag)
 
         self._items[href] = item, item.hash
+        self._dirty[href] = None
         return item.hash
 
     @_writing_op
@@ -181,31 +330,148 @@ class SingleFileStorage(Storage):
             raise exceptions.WrongEtagError(etag, actual_etag)
 
         del self._items[href]
+        self._dirty[href] = None
 
     def _write(self):
+        if not self._dirty:
+            return
         if self._last_etag is not None and self._last_etag != get_etag_from_file(
             self.path
         ):
+            self._items = None
             raise exceptions.PreconditionFailed(
                 f"Some other program modified the file {self.path!r}. Re-run the "
                 "synchronization and make sure absolutely no other program is "
                 "writing into the same file."
             )
-        text = join_collection(item.raw for item, etag in self._items.values())
+
         try:
-            with atomic_write(self.path, mode="wb", overwrite=True) as f:
-                f.write(text.encode(self.encoding))
-        finally:
+            if self._spans is None or not self._write_changes():
+                self._write_all()
+        except BaseException:
             self._items = None
-            self._last_etag = None
+            raise
+        self._dirty = {}
+
+    def _write_all(self):
+        self._read_items(self._items)
+        text = join_collection(item.raw for item, etag in self._items.values())
+        if self.persistent_index:
+            self._remove_index()
+        with atomic_write(self.path, mode="wb", overwrite=True) as f:
+            f.write(text.encode(self.encoding))
+        # Read the file again when it's needed next, to index it.
+        self._items = None
+        self._last_etag = None
+
+    def _write_changes(self):
+        """Only serialize the components of the items that changed.
+
+        New and updated items are added before the end of the file, and the
+        rest of it is copied from the unchanged parts of the old one. The new
+        file replaces the old one atomically, so that it is never seen
+        half-written.
+
+        :returns: Whether that was possible, otherwise the whole file has to
+            be written.
+        """
+        index = self._index
+        if not self._items:
+            return False
+
+        timezones = {tuple(tz.dump_lines()) for tz in index.timezones}
+        new_timezones = []
+        new_data = []
+        new_spans = {}
+        offset = 0
+        for href in self._dirty:
+            if href not in self._items:
+                continue
+            item, _ = self._items[href]
+            components = index.get_components(item)
+            if components is None:
+                return False
+
+            new_spans[href] = []
+            for component in components:
+                lines = tuple(component.dump_lines())
+                if component.name == "VTIMEZONE":
+                    if lines in timezones:
+                        continue
+                    timezones.add(lines)
+                    new_timezones.append(component)
+                data = "".join(line + "\r\n" for line in lines).encode(self.encoding)
+                if component.name != "VTIMEZONE":
+                    new_spans[href].append((offset, offset + len(data)))
+                new_data.append(data)
+                offset += len(data)
+
+        removed = sorted(
+            span for href in self._dirty for span in self._spans.get(href, ())
+        )
+        new_data = b"".join(new_data)
+        self._splice(removed, new_data)
+
+        # Kept components moved back by the size of the ones removed before
+        # them, and the new ones are at the old end of the file.
+        removed_ends = [end for _, end in removed]
+        removed_sizes = list(
+            itertools.accumulate((end - start for start, end in removed), initial=0)
+        )
+
+        def move(offset):
+            return offset - removed_sizes[bisect.bisect_right(removed_ends, offset)]
+
+        footer_start = move(index.footer_start)
+        for href in self._dirty:
+            self._spans.pop(href, None)
+        for href, spans in self._spans.items():
+            self._spans[href] = [(move(start), move(end)) for start, end in spans]
+        for href, spans in new_spans.items():
+            self._spans[href] = [
+                (footer_start + start, footer_start + end) for start, end in spans
+            ]
+        index.footer_start = footer_start + len(new_data)
+        index.timezones.extend(new_timezones)
+        st = os.stat(self.path)
+        self._last_etag = get_etag_from_stat(st)
+        if self.persistent_index:
+            self._write_index(st)
+        return True
+
+    def _splice(self, removed, new_data):
+        """Write a copy of the file without the ``removed`` spans, and with
+        ``new_data`` before the end of the wrapper."""
+        footer_start = self._index.footer_start
+        with (
+            open(self.path, self._read_mode) as old,
+            atomic_write(self.path, mode="wb", overwrite=True) as f,
+        ):
+            pos = 0
+            for start, end in removed:
+                _copy_range(old, f, pos, start)
+                pos = end
+            _copy_range(old, f, pos, footer_start)
+            f.write(new_data)
+            old.seek(footer_start)
+            f.write(old.read())
 
     @contextlib.asynccontextmanager
     async def at_once(self):
-        async for _ in self.list():
-            pass
+        await self._load()
         self._at_once = True
         try:
             yield self
             self._write()
         finally:
             self._at_once = False
+
+
+def _copy_range(src, dest, start, end, chunk_size=1024 * 1024):
+    src.seek(start)
+    while start < end:
+        chunk = src.read(min(chunk_size, end - start))
+        if not chunk:
+            break
+        dest.write(chunk)
+        start += len(chunk)
@@ -12,15 +12,18 @@ https://unterwaditzer.net/2016/sync-algorithm.html
 
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import itertools
 import logging
 
+from vdirsyncer.exceptions import InvalidSyncToken
 from vdirsyncer.exceptions import UserError
 from vdirsyncer.storage.base import Storage
 from vdirsyncer.utils import uniq
 from vdirsyncer.vobject import Item
 
+from .cache import ItemCache
 from .exceptions import BothReadOnly
 from .exceptions import IdentAlreadyExists
 from .exceptions import PartialSync
@@ -37,56 +40,284 @@ class _StorageInfo:
     """A wrapper class that holds prefetched items, the status and other
     things."""
 
-    def __init__(self, storage: Storage, status: SubStatus):
+    # How many new or updated items to fetch with a single call to
+    # `get_multi` while the storage is still being listed, and how many of
+    # those calls may run at the same time.
+    prefetch_batch_size = 100
+    prefetch_concurrency = 4
+
+    def __init__(
+        self, storage: Storage, status: SubStatus, item_cache: ItemCache | None = None
+    ):
         self.storage = storage
         self.status = status
         self._item_cache = {}  # type: ignore[var-annotated]
+        # The persistent cache can only tell storages apart by their name.
+        self.persistent_cache = item_cache if storage.instance_name else None
+        # Items that were found in the persistent cache without their content,
+        # {ident: href}.
+        self._missing_items = {}  # type: ignore[var-annotated]
+        # Items written to the storage, to be added to the persistent cache
+        # at once after all actions ran.
+        self._written_items = []  # type: ignore[var-annotated]
+        # The idents of the items written to the storage, {href: ident}.
+        self._written_idents = {}  # type: ignore[var-annotated]
+
+        # The sync token and ctag obtained before listing the storage.
+        self.sync_token = None
+        self.ctag = None
+        # Whether the status of any item had to be rolled back. In that case
+        # the status doesn't reflect the storage's contents anymore, and the
+        # old sync token has to be kept.
+        self.rolled_back = False
+
+    async def _list(self, sync_token):
+        """List the storage, incrementally if possible.
+
+        :param sync_token: The storage's current sync token.
+        """
+        old_token = self.status.get_sync_token()
+        self.sync_token = sync_token
+        if old_token is None or self.sync_token is None:
+            return self.storage.list()
+
+        try:
+            changes = {
+                href: etag async for href, etag in self.storage.list_changes(old_token)
+            }
+        except InvalidSyncToken as e:
+            sync_logger.debug(f"Listing all items of {self.storage}: {e}")
+            return self.storage.list()
+
+        sync_logger.debug(f"{len(changes)} items of {self.storage} changed.")
+        return self._list_from_changes(changes)
+
+    async def _list_from_changes(self, changes):
+        for href, etag in changes.items():
+            if etag is not None:
+                yield href, etag
+
+        # Everything else didn't change since the old sync token was obtained,
+        # so the status still describes it correctly.
+        for _ident, meta in self.status.iter_old():
+            if meta.href not in changes:
+                yield meta.href, meta.etag
+
+    def save_collection_state(self) -> None:
+        if not self.rolled_back:
+            self.status.set_sync_token(self.sync_token)
+            self.status.set_ctag(self.ctag)
 
     async def prepare_new_status(self) -> bool:
         storage_nonempty = False
         prefetch = []
+        unchanged = []
+        fetching = set()
 
-        def _store_props(ident: str, props: ItemMetadata) -> None:
+        def _store_many(items) -> None:
             try:
-                self.status.insert_ident(ident, props)
+                self.status.insert_many(items)
             except IdentAlreadyExists as e:
                 raise e.to_ident_conflict(self.storage)
 
-        async for href, etag in self.storage.list():  # type: ignore[attr-defined]
-            storage_nonempty = True
-            ident, meta = self.status.get_by_href(href)
-
-            if meta is None or meta.href != href or meta.etag != etag:
-                # Either the item is completely new, or updated
-                # In both cases we should prefetch
-                prefetch.append(href)
-            else:
-                # Metadata is completely identical
-                _store_props(ident, meta)
-
-        # Prefetch items
-        if prefetch:
-            async for href, item, etag in self.storage.get_multi(prefetch):
-                _store_props(
-                    item.ident,
-                    ItemMetadata(href=href, hash=item.hash, etag=etag),
+        def _use_cached(batch, cached):
+            """Add the items of ``batch`` that were found in the persistent
+            cache to the status, and return the others."""
+            hits = []
+            rest = []
+            for href, etag in batch:
+                if href not in cached:
+                    rest.append((href, etag))
+                    continue
+                ident, hash, item = cached[href]
+                hits.append((ident, ItemMetadata(href=href, hash=hash, etag=etag)))
+                if item is None:
+                    self._missing_items[ident] = href
+                else:
+                    self._item_cache[ident] = item
+            _store_many(hits)
+            return rest
+
+        async def _prefetch(batch):
+            cache = self.persistent_cache
+            name = self.storage.instance_name
+            fingerprints = {}
+            if cache is not None:
+                batch = _use_cached(
+                    batch, cache.get_many(name, ((h, e, None) for h, e in batch))
                 )
-                self.set_item_cache(item.ident, item)
+                # The etag of items may change although their content didn't,
+                # which the storage can possibly tell without sending them.
+                if batch:
+                    fingerprints = {
+                        href: fingerprint
+                        async for href, fingerprint in self.storage.get_fingerprints(
+                            [href for href, _etag in batch]
+                        )
+                    }
+                if fingerprints:
+                    batch = _use_cached(
+                        batch,
+                        cache.get_many(
+                            name, ((h, e, fingerprints.get(h)) for h, e in batch)
+                        ),
+                    )
 
-        return storage_nonempty
+            if not batch:
+                return
+            items = [
+                (href, item, etag)
+                async for href, item, etag in self.storage.get_multi(
+                    [href for href, _etag in batch]
+                )
+            ]
+            _store_many(
+                (item.ident, ItemMetadata(href=href, hash=item.hash, etag=etag))
+                for href, item, etag in items
+            )
+            for _href, item, _etag in items:
+                self._item_cache[item.ident] = item
+            if cache is not None:
+                cache.put_many(
+                    name,
+                    (
+                        (href, etag, fingerprints.get(href), item)
+                        for href, item, etag in items
+                    ),
+                    store_bodies=self.storage.cache_bodies,
+                )
 
-    def is_changed(self, ident: str) -> bool:
-        old_meta = self.status.get(ident)
-        if old_meta is None:  # new item
-            return True
+        async def _start_prefetch(batch):
+            nonlocal fetching
+            # Stop listing while too many batches are being fetched.
+            while len(fetching) >= self.prefetch_concurrency:
+                done, fetching = await asyncio.wait(
+                    fetching, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    task.result()
+            fetching.add(asyncio.ensure_future(_prefetch(batch)))
+
+        old_ctag = self.status.get_ctag()
+        self.ctag, sync_token = await self.storage.get_collection_tokens()
+        if old_ctag is not None and self.ctag == old_ctag:
+            # Nothing changed since the last sync, so the old status still
+            # describes the storage's contents.
+            sync_logger.debug(f"{self.storage} is unchanged, not listing it.")
+            self.sync_token = self.status.get_sync_token()
+            old = list(self.status.iter_old())
+            _store_many(old)
+            return bool(old)
 
-        new_meta = self.status.get_new(ident)
+        try:
+            async for href, etag in await self._list(sync_token):
+                storage_nonempty = True
+                ident, meta = self.status.get_by_href(href)
+
+                if meta is None or meta.href != href or meta.etag != etag:
+                    # Either the item is completely new, or updated
+                    # In both cases we should prefetch, which already starts
+                    # while the storage is still being listed.
+                    prefetch.append((href, etag))
+                    if len(prefetch) >= self.prefetch_batch_size:
+                        await _start_prefetch(prefetch)
+                        prefetch = []
+                else:
+                    # Metadata is completely identical
+                    unchanged.append((ident, meta))
+
+            if prefetch:
+                await _start_prefetch(prefetch)
+            _store_many(unchanged)
+        except BaseException:
+            for task in fetching:
+                task.cancel()
+            await asyncio.gather(*fetching, return_exceptions=True)
+            raise
+
+        await _gather(*fetching)
+        return storage_nonempty
 
-        return (
-            new_meta.etag != old_meta.etag  # etag changed
-            # item actually changed
-            and (old_meta.hash is None or new_meta.hash != old_meta.hash)
-        )
+    def get_changes(self, old, new):
+        """Find the items of this side that changed since the last sync.
+
+        :param old: The old status, as returned by
+            :py:meth:`SqliteStatus.load_snapshot`.
+        :param new: The new status, in the same format.
+        :returns: A set of the idents that exist in this storage, and the
+            subset of those that are new or changed.
+        """
+        hash_col = 0 if self.status.side == "a" else 2
+        etag_col = hash_col + 1
+
+        present = set()
+        changed = set()
+        for ident, new_row in new.items():
+            if new_row[hash_col] is None:
+                continue
+            present.add(ident)
+
+            old_row = old.get(ident)
+            if (
+                old_row is None
+                or old_row[hash_col] is None  # new item
+                or (
+                    new_row[etag_col] != old_row[etag_col]  # etag changed
+                    # item actually changed
+                    and new_row[hash_col] != old_row[hash_col]
+                )
+            ):
+                changed.add(ident)
+
+        return present, changed
+
+    async def fetch_missing_items(self, idents) -> None:
+        """Fetch the content of items that was not in the persistent cache.
+
+        :param idents: Idents of the items whose content is needed. The
+            content of other items is not fetched.
+        """
+        hrefs = [href for ident, href in self._missing_items.items() if ident in idents]
+        self._missing_items.clear()
+        if hrefs:
+            async for _href, item, _etag in self.storage.get_multi(hrefs):
+                self._item_cache[item.ident] = item
+
+    def item_written(self, href, etag, item) -> None:
+        self._written_idents[href] = item.ident
+        if self.persistent_cache is not None and href and etag:
+            self._written_items.append((href, etag, None, item))
+
+    def drop_unpublished_items(self) -> bool:
+        """Roll back the status of the written items that the storage
+        couldn't publish at the end of ``at_once``.
+
+        Return whether there were any.
+        """
+        pop_conflicts = getattr(self.storage, "pop_publish_conflicts", None)
+        hrefs = set(pop_conflicts()) if pop_conflicts is not None else set()
+        for href in hrefs:
+            ident = self._written_idents.get(href)
+            if ident is None:
+                continue
+            sync_logger.warning(
+                f"Item {ident} couldn't be written to {self.storage}, "
+                f"because {href} was created by someone else in the meantime."
+            )
+            self.status.parent.rollback(ident)
+        self._written_idents.clear()
+        if hrefs:
+            self._written_items = [i for i in self._written_items if i[0] not in hrefs]
+        return bool(hrefs)
+
+    def flush_written_items(self) -> None:
+        if self._written_items:
+            self.persistent_cache.put_many(
+                self.storage.instance_name,
+                self._written_items,
+                store_bodies=self.storage.cache_bodies,
+            )
+            self._written_items = []
 
     def set_item_cache(self, ident, item) -> None:
         actual_hash = self.status.get_new(ident).hash
@@ -105,7 +336,10 @@ async def sync(
     force_delete=False,
     error_callback=None,
     partial_sync="revert",
-) -> None:
+    max_workers=1,
+    dry_run=False,
+    item_cache=None,
+) -> dict | None:
     """Synchronizes two storages.
 
     :param storage_a: The first storage
@@ -131,6 +365,19 @@ async def sync(
         - ``error``: Raise an error.
         - ``ignore``: Those actions are simply skipped.
         - ``revert`` (default): Revert changes on other side.
+    :param max_workers: How many actions may run concurrently. Every action
+        only touches a single item, so running them in parallel is safe. The
+        default of ``1`` runs them one after another.
+    :param dry_run: Only list the storages and determine which actions would
+        be necessary, without changing the storages or the status.
+    :param item_cache: A :py:class:`vdirsyncer.sync.cache.ItemCache` to look
+        up items in before fetching them, and to add fetched items to. Only
+        used for storages with an ``instance_name``.
+    :returns: If ``dry_run`` is set, a dict summarizing the planned actions.
+        Its keys ``upload``, ``update``, ``delete`` and ``bytes`` each map
+        ``"a"`` and ``"b"`` to the number of items (or bytes) that would be
+        written to that side. ``conflict`` is the number of items that need
+        conflict resolution.
     """
     if storage_a.read_only and storage_b.read_only:
         raise BothReadOnly
@@ -146,12 +393,14 @@ async def sync(
 
     status_nonempty = bool(next(status.iter_old(), None))
 
-    with status.transaction():
-        a_info = _StorageInfo(storage_a, SubStatus(status, "a"))
-        b_info = _StorageInfo(storage_b, SubStatus(status, "b"))
+    with status.transaction(commit=not dry_run):
+        a_info = _StorageInfo(storage_a, SubStatus(status, "a"), item_cache)
+        b_info = _StorageInfo(storage_b, SubStatus(status, "b"), item_cache)
 
-        a_nonempty = await a_info.prepare_new_status()
-        b_nonempty = await b_info.prepare_new_status()
+        a_nonempty, b_nonempty = await _gather(
+            a_info.prepare_new_status(),
+            b_info.prepare_new_status(),
+        )
 
         if status_nonempty and not force_delete:
             if a_nonempty and not b_nonempty:
@@ -159,17 +408,133 @@ async def sync(
             elif not a_nonempty and b_nonempty:
                 raise StorageEmpty(empty_storage=storage_a)
 
-        actions = list(_get_actions(a_info, b_info))
+        old, new = status.load_snapshot()
+        a_present, a_changed = a_info.get_changes(old, new)
+        b_present, b_changed = b_info.get_changes(old, new)
+
+        # Only the content of items that are copied to the other side, or
+        # passed to the conflict resolution, is needed. Items that changed on
+        # both sides, but are equal, aren't copied anywhere.
+        unresolved = {
+            ident
+            for ident in a_changed & b_changed
+            if conflict_resolution is None or new[ident][0] == new[ident][2]
+        }
+        await _gather(
+            a_info.fetch_missing_items(a_changed - unresolved),
+            b_info.fetch_missing_items(b_changed - unresolved),
+        )
+
+        actions = list(
+            _get_actions(
+                a_info, b_info, old, new, (a_present, a_changed), (b_present, b_changed)
+            )
+        )
+        if dry_run:
+            return _summarize_actions(actions, a_info)
 
-        async with storage_a.at_once(), storage_b.at_once():
-            for action in actions:
-                try:
-                    await action.run(a_info, b_info, conflict_resolution, partial_sync)
-                except Exception as e:
-                    if error_callback:
-                        error_callback(e)
-                    else:
-                        raise
+        try:
+            async with storage_a.at_once(), storage_b.at_once():
+                await _run_actions(
+                    actions,
+                    a_info,
+                    b_info,
+                    conflict_resolution=conflict_resolution,
+                    partial_sync=partial_sync,
+                    error_callback=error_callback,
+                    max_workers=max_workers,
+                )
+        finally:
+            if a_info.drop_unpublished_items() | b_info.drop_unpublished_items():
+                a_info.rolled_back = b_info.rolled_back = True
+            a_info.flush_written_items()
+            b_info.flush_written_items()
+
+        a_info.save_collection_state()
+        b_info.save_collection_state()
+
+
+def _summarize_actions(actions, a_info):
+    """Count the planned actions and estimate how much data they upload.
+
+    The bytes that conflict resolution writes are not included, since they
+    depend on the resolution.
+    """
+    rv = {
+        "upload": {"a": 0, "b": 0},
+        "update": {"a": 0, "b": 0},
+        "delete": {"a": 0, "b": 0},
+        "conflict": 0,
+        "bytes": {"a": 0, "b": 0},
+    }
+    for action in actions:
+        if isinstance(action, ResolveConflict):
+            rv["conflict"] += 1
+            continue
+
+        side = "a" if action.dest is a_info else "b"
+        if isinstance(action, Delete):
+            rv["delete"][side] += 1
+        else:
+            kind = "upload" if isinstance(action, Upload) else "update"
+            rv[kind][side] += 1
+            rv["bytes"][side] += len(action.item.raw.encode("utf-8"))
+    return rv
+
+
+async def _run_actions(
+    actions,
+    a_info,
+    b_info,
+    conflict_resolution,
+    partial_sync,
+    error_callback,
+    max_workers,
+):
+    """Run actions with at most ``max_workers`` of them in flight.
+
+    Without an ``error_callback``, the first failure stops new actions from
+    being started. Actions that are already running are allowed to finish (and
+    to roll back their status) before the error is re-raised.
+    """
+    if max_workers < 1:
+        raise UserError(f"max_workers must be at least 1, got {max_workers!r}.")
+
+    # Workers share this iterator, which is fine since `next` doesn't yield to
+    # the event loop.
+    pending = iter(actions)
+    errors = []
+
+    async def worker():
+        for action in pending:
+            if errors:
+                return
+            try:
+                await action.run(a_info, b_info, conflict_resolution, partial_sync)
+            except Exception as e:
+                if error_callback:
+                    error_callback(e)
+                else:
+                    errors.append(e)
+                    return
+
+    await _gather(*(worker() for _ in range(max_workers)))
+    if errors:
+        raise errors[0]
+
+
+async def _gather(*aws):
+    """Like ``asyncio.gather``, but cancel and await the remaining awaitables
+    if one of them fails, so that none of them keeps running in the
+    background."""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 
 class Action:
@@ -199,6 +564,7 @@ class Action:
 
     def rollback(self, a, b):
         a.status.parent.rollback(self.ident)
+        a.rolled_back = b.rolled_back = True
 
 
 class Upload(Action):
@@ -216,6 +582,7 @@ class Upload(Action):
             )
             href, etag = await self.dest.storage.upload(self.item)
             assert href is not None
+            self.dest.item_written(href, etag, self.item)
 
         self.dest.status.insert_ident(
             self.ident, ItemMetadata(href=href, hash=self.item.hash, etag=etag)
@@ -237,6 +604,7 @@ class Update(Action):
             )
             meta = self.dest.status.get_new(self.ident)
             meta.etag = await self.dest.storage.update(meta.href, self.item, meta.etag)
+            self.dest.item_written(meta.href, meta.etag, self.item)
 
         self.dest.status.update_ident(self.ident, meta)
 
@@ -300,38 +668,40 @@ class ResolveConflict(Action):
                 )
 
 
-def _get_actions(a_info: _StorageInfo, b_info: _StorageInfo):
-    for ident in uniq(
-        itertools.chain(
-            a_info.status.parent.iter_new(), a_info.status.parent.iter_old()
-        )
-    ):
-        a = a_info.status.get_new(ident)
-        b = b_info.status.get_new(ident)
-
-        if a and b:
-            a_changed = a_info.is_changed(ident)
-            b_changed = b_info.is_changed(ident)
-            if a_changed and b_changed:
-                # item was modified on both sides
-                # OR: missing status
-                yield ResolveConflict(ident)
-            elif a_changed and not b_changed:
-                # item was only modified in a
-                yield Update(a_info.get_item_cache(ident), b_info)
-            elif not a_changed and b_changed:
-                # item was only modified in b
-                yield Update(b_info.get_item_cache(ident), a_info)
-        elif a and not b:
-            if a_info.is_changed(ident):
+def _get_actions(
+    a_info: _StorageInfo, b_info: _StorageInfo, old, new, a_changes, b_changes
+):
+    a_present, a_changed = a_changes
+    b_present, b_changed = b_changes
+
+    both = a_present & b_present
+    # item was modified on both sides
+    # OR: missing status
+    conflicts = both & a_changed & b_changed
+    # item was only modified in a
+    a_updates = both & a_changed - b_changed
+    # item was only modified in b
+    b_updates = both & b_changed - a_changed
+    only_a = a_present - b_present
+    only_b = b_present - a_present
+
+    for ident in uniq(itertools.chain(new, old)):
+        if ident in conflicts:
+            yield ResolveConflict(ident)
+        elif ident in a_updates:
+            yield Update(a_info.get_item_cache(ident), b_info)
+        elif ident in b_updates:
+            yield Update(b_info.get_item_cache(ident), a_info)
+        elif ident in only_a:
+            if ident in a_changed:
                 # was deleted from b but modified on a
                 # OR: new item was created in a
                 yield Upload(a_info.get_item_cache(ident), b_info)
             else:
                 # was deleted from b and not modified on a
                 yield Delete(ident, a_info)
-        elif not a and b:
-            if b_info.is_changed(ident):
+        elif ident in only_b:
+            if ident in b_changed:
                 # was deleted from a but modified on b
                 # OR: new item was created in b
                 yield Upload(b_info.get_item_cache(ident), a_info)
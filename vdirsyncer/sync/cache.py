@@ -0,0 +1,194 @@
+"""
+A persistent cache of items that were fetched during earlier syncs.
+
+The cache holds the last known version of every item, which is only used as
+long as the item's etag or content fingerprint (see
+:py:meth:`vdirsyncer.storage.base.Storage.get_fingerprints`) is still the
+same. This allows the sync to avoid downloading items again after the status
+got lost or reset, or when only their etag changed.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import sqlite3
+import zlib
+
+from vdirsyncer.vobject import Item
+
+
+class ItemCache:
+    """An item cache backed by a SQLite database.
+
+    :param path: The path of the database file.
+    :param max_size: The approximate maximal size of all entries in bytes.
+        The least recently used entries are removed when it is exceeded.
+    :param store_bodies: Whether to store the (compressed) content of items.
+        Otherwise only their ident and hash are stored, which is enough to
+        tell that two items are equal, but the item has to be fetched anyway
+        when it needs to be copied to the other side.
+    """
+
+    # Bumped whenever the schema changes. The cache is simply discarded if it
+    # was written with another version.
+    SCHEMA_VERSION = 1
+
+    # When the cache is full, evict entries until it only takes up this
+    # fraction of `max_size`, so that not every insertion has to evict.
+    _EVICT_TO = 0.9
+
+    def __init__(self, path: str, max_size: int, store_bodies: bool = True):
+        self.max_size = max_size
+        self.store_bodies = store_bodies
+
+        self._c = sqlite3.connect(path)
+        self._c.isolation_level = None  # turn off idiocy of DB-API
+        (version,) = self._c.execute("PRAGMA user_version").fetchone()
+        if version != self.SCHEMA_VERSION:
+            self._c.execute("DROP TABLE IF EXISTS items")
+            self._c.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self._c.execute(
+            """CREATE TABLE IF NOT EXISTS items (
+                "storage" TEXT NOT NULL,
+                "href" TEXT NOT NULL,
+                "etag" TEXT,
+                "fingerprint" TEXT,
+                "ident" TEXT NOT NULL,
+                "hash" TEXT NOT NULL,
+                "body" BLOB,
+                "size" INTEGER NOT NULL,
+                "last_used" INTEGER NOT NULL,
+                PRIMARY KEY ("storage", "href")
+            )"""
+        )
+        self._c.execute(
+            'CREATE INDEX IF NOT EXISTS items_last_used ON items ("last_used")'
+        )
+
+        size, clock = self._c.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM items"
+        ).fetchone()
+        self._size = size
+        # A counter instead of timestamps, so that the order of accesses is
+        # preserved even if they happen within the resolution of the clock.
+        self._clock = clock
+
+    def close(self) -> None:
+        self._c.close()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get_many(self, storage: str, items) -> dict:
+        """Look up items.
+
+        An entry matches if either its etag or its fingerprint is the same.
+        If only the fingerprint matches, the entry's etag is updated.
+
+        :param items: An iterable of ``(href, etag, fingerprint)``, where
+            ``etag`` or ``fingerprint`` may be ``None``.
+        :returns: A dict from the href of every cached item to a tuple of the
+            item's ident, its hash and the :py:class:`Item` itself, which is
+            ``None`` if its content wasn't stored.
+        """
+        rv = {}
+        with self._transaction():
+            for href, etag, fingerprint in items:
+                row = self._c.execute(
+                    "SELECT etag, fingerprint, ident, hash, body FROM items "
+                    "WHERE storage=? AND href=?",
+                    (storage, href),
+                ).fetchone()
+                if row is None:
+                    continue
+
+                cached_etag, cached_fingerprint, ident, hash, body = row
+                if etag is not None and etag == cached_etag:
+                    pass
+                elif fingerprint is not None and fingerprint == cached_fingerprint:
+                    cached_etag = etag or cached_etag
+                else:
+                    continue
+
+                self._c.execute(
+                    "UPDATE items SET etag=?, last_used=? WHERE storage=? AND href=?",
+                    (cached_etag, self._tick(), storage, href),
+                )
+                item = None
+                if body is not None:
+                    item = Item(zlib.decompress(body).decode("utf-8"))
+                rv[href] = ident, hash, item
+        return rv
+
+    def put_many(self, storage: str, items, store_bodies: bool = True) -> None:
+        """Add items to the cache, replacing older versions of them.
+
+        :param items: An iterable of ``(href, etag, fingerprint, item)``,
+            where ``etag`` or ``fingerprint`` may be ``None``.
+        :param store_bodies: Set to ``False`` to only store the hash of the
+            items, for storages that can read them cheaply.
+        """
+        rows = []
+        for href, etag, fingerprint, item in items:
+            body = None
+            if self.store_bodies and store_bodies:
+                body = zlib.compress(item.raw.encode("utf-8"))
+            size = sum(len(x or "") for x in (href, etag, fingerprint))
+            size += len(item.ident) + len(item.hash) + len(body or b"")
+            rows.append(
+                (
+                    storage,
+                    href,
+                    etag,
+                    fingerprint,
+                    item.ident,
+                    item.hash,
+                    body,
+                    size,
+                    self._tick(),
+                )
+            )
+
+        if not rows:
+            return
+
+        with self._transaction():
+            self._c.executemany(
+                "INSERT OR REPLACE INTO items (storage, href, etag, fingerprint, "
+                "ident, hash, body, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            # Replaced entries aren't subtracted, so this is an upper bound
+            # that is corrected when evicting.
+            self._size += sum(row[7] for row in rows)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries."""
+        self._c.execute(
+            "DELETE FROM items WHERE rowid IN ("
+            "  SELECT rowid FROM ("
+            "    SELECT rowid, SUM(size) OVER ("
+            "      ORDER BY last_used DESC, rowid DESC"
+            "    ) AS total FROM items"
+            "  ) WHERE total > ?"
+            ")",
+            (int(self.max_size * self._EVICT_TO),),
+        )
+        (self._size,) = self._c.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM items"
+        ).fetchone()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._c.execute("BEGIN IMMEDIATE TRANSACTION")
+        try:
+            yield
+        except BaseException:
+            self._c.execute("ROLLBACK")
+            raise
+        else:
+            self._c.execute("COMMIT")
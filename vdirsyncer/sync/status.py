@@ -2,19 +2,26 @@ from __future__ import annotations
 
 import abc
 import contextlib
+import pathlib
 import sqlite3
 import sys
 
+from vdirsyncer.exceptions import UserError
+
 from .exceptions import IdentAlreadyExists
 
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER, which is 999 for old versions of
+# SQLite.
+_MAX_VARIABLES = 500
+
 
 @contextlib.contextmanager
-def _exclusive_transaction(conn):
+def _exclusive_transaction(conn, commit=True):
     c = None
     try:
         c = conn.execute("BEGIN EXCLUSIVE TRANSACTION")
         yield c
-        c.execute("COMMIT")
+        c.execute("COMMIT" if commit else "ROLLBACK")
     except BaseException:
         if c is None:
             raise
@@ -48,7 +55,7 @@ class _StatusBase(metaclass=abc.ABCMeta):
             yield ident, (a.to_status(), b.to_status())
 
     @abc.abstractmethod
-    def transaction(self):
+    def transaction(self, commit=True):
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -59,6 +66,14 @@ class _StatusBase(metaclass=abc.ABCMeta):
     def insert_ident_b(self, ident, props):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def insert_many_a(self, items):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_many_b(self, items):
+        raise NotImplementedError
+
     @abc.abstractmethod
     def update_ident_a(self, ident, props):
         raise NotImplementedError
@@ -95,6 +110,10 @@ class _StatusBase(metaclass=abc.ABCMeta):
     def iter_new(self):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def load_snapshot(self):
+        raise NotImplementedError
+
     @abc.abstractmethod
     def get_by_href_a(self, href, default=(None, None)):
         raise NotImplementedError
@@ -107,23 +126,100 @@ class _StatusBase(metaclass=abc.ABCMeta):
     def rollback(self, ident):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def iter_old_a(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_old_b(self):
+        raise NotImplementedError
 
-class SqliteStatus(_StatusBase):
-    SCHEMA_VERSION = 1
+    @abc.abstractmethod
+    def get_sync_token_a(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_sync_token_b(self):
+        raise NotImplementedError
 
-    def __init__(self, path=":memory:"):
-        self._path = path
+    @abc.abstractmethod
+    def set_sync_token_a(self, token):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_sync_token_b(self, token):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_ctag_a(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_ctag_b(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_ctag_a(self, ctag):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_ctag_b(self, ctag):
+        raise NotImplementedError
+
+
+class SqliteStatus(_StatusBase):
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path=":memory:", *, copy_from=None):
+        """
+        :param copy_from: Load the status at this path into the new one. The
+            file is only read, and doesn't get migrated.
+        """
+        self._path = path if copy_from is None else copy_from
         self._c = sqlite3.connect(path)
+        if copy_from is not None:
+            uri = pathlib.Path(copy_from).resolve().as_uri() + "?mode=ro"
+            with contextlib.closing(sqlite3.connect(uri, uri=True)) as source:
+                source.backup(self._c)
         self._c.isolation_level = None  # turn off idiocy of DB-API
         self._c.row_factory = sqlite3.Row
         self._update_schema()
 
     def _update_schema(self):
-        if self._is_latest_version():
-            return
+        version = self._get_version()
+        if version is None:
+            self._create_schema()
+        elif version == 1:
+            self._migrate_from_v1()
+        elif version != self.SCHEMA_VERSION:
+            raise UserError(
+                f"The status database at {self._path} was written by a newer "
+                f"version of vdirsyncer (schema version {version})."
+            )
+
+        # We cannot add NOT NULL here because data is first fetched for the
+        # storage a, then storage b. Inbetween the `_b`-columns are filled
+        # with NULL.
+        #
+        # Unfortunately sqlite enforces NOT NULL constraints immediately, not
+        # just at commit. Since there is also no way to alter constraints on a
+        # table (disable constraints on start of transaction and reenable on
+        # end), it's a separate table that gets compared against the status
+        # before we commit. It is a temporary table, so it never touches the
+        # status file on disk.
+        self._c.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS new_status (
+            "ident" TEXT PRIMARY KEY NOT NULL,
+            "href_a" TEXT,
+            "href_b" TEXT,
+            "hash_a" TEXT,
+            "hash_b" TEXT,
+            "etag_a" TEXT,
+            "etag_b" TEXT
+        ); """
+        )
 
-        # If we ever bump the schema version, we will need a way to migrate
-        # data.
+    def _create_schema(self):
         with _exclusive_transaction(self._c) as c:
             c.execute('CREATE TABLE meta ( "version" INTEGER PRIMARY KEY )')
             c.execute("INSERT INTO meta (version) VALUES (?)", (self.SCHEMA_VERSION,))
@@ -143,98 +239,119 @@ class SqliteStatus(_StatusBase):
             )
             c.execute("CREATE UNIQUE INDEX by_href_a ON status(href_a)")
             c.execute("CREATE UNIQUE INDEX by_href_b ON status(href_b)")
+            self._create_collection_state(c)
+
+    def _create_collection_state(self, c):
+        c.execute(
+            """CREATE TABLE IF NOT EXISTS collection_state (
+            "side" TEXT NOT NULL,
+            "key" TEXT NOT NULL,
+            "value" TEXT NOT NULL,
+            PRIMARY KEY (side, key)
+        ); """
+        )
 
-            # We cannot add NOT NULL here because data is first fetched for the
-            # storage a, then storage b. Inbetween the `_b`-columns are filled
-            # with NULL.
-            #
-            # In an ideal world we would be able to start a transaction with
-            # one cursor, write our new data into status and simultaneously
-            # query the old status data using a different cursor.
-            # Unfortunately sqlite enforces NOT NULL constraints immediately,
-            # not just at commit. Since there is also no way to alter
-            # constraints on a table (disable constraints on start of
-            # transaction and reenable on end), it's a separate table now that
-            # just gets copied over before we commit.  That's a lot of copying,
-            # sadly.
-            c.execute(
-                """CREATE TABLE new_status (
-                "ident" TEXT PRIMARY KEY NOT NULL,
-                "href_a" TEXT,
-                "href_b" TEXT,
-                "hash_a" TEXT,
-                "hash_b" TEXT,
-                "etag_a" TEXT,
-                "etag_b" TEXT
-            ); """
-            )
+    def _migrate_from_v1(self):
+        # Version 1 kept new_status in the database file, and copied all of it
+        # over to status at the end of every sync. Everything else is the
+        # same.
+        with _exclusive_transaction(self._c) as c:
+            c.execute("DROP TABLE IF EXISTS main.new_status")
+            self._create_collection_state(c)
+            c.execute("UPDATE meta SET version = ?", (self.SCHEMA_VERSION,))
 
     def close(self):
         if self._c:
             self._c.close()
             self._c = None
 
-    def _is_latest_version(self):
+    def _get_version(self):
         try:
-            return bool(
-                self._c.execute(
-                    "SELECT version FROM meta WHERE version = ?", (self.SCHEMA_VERSION,)
-                ).fetchone()
-            )
+            res = self._c.execute("SELECT MAX(version) AS version FROM meta").fetchone()
         except sqlite3.OperationalError:
-            return False
+            return None
+        return res["version"]
 
     @contextlib.contextmanager
-    def transaction(self):
+    def transaction(self, commit=True):
+        """Start a transaction. At its end, the new status replaces the old one,
+        unless ``commit`` is false, in which case all changes are discarded."""
         old_c = self._c
         try:
-            with _exclusive_transaction(self._c) as new_c:
+            with _exclusive_transaction(self._c, commit=commit) as new_c:
                 self._c = new_c
                 yield
-                self._c.execute("DELETE FROM status")
-                self._c.execute("INSERT INTO status SELECT * FROM new_status")
-                self._c.execute("DELETE FROM new_status")
+                if commit:
+                    self._commit_new_status()
         finally:
             self._c = old_c
 
-    def insert_ident_a(self, ident, a_props):
-        # FIXME: Super inefficient
-        old_props = self.get_new_a(ident)
-        if old_props is not None:
-            raise IdentAlreadyExists(old_href=old_props.href, new_href=a_props.href)
-        b_props = self.get_new_b(ident) or ItemMetadata()
+    def _commit_new_status(self):
+        """Make new_status the status, only writing the rows that changed."""
         self._c.execute(
-            "INSERT OR REPLACE INTO new_status VALUES(?, ?, ?, ?, ?, ?, ?)",
-            (
-                ident,
-                a_props.href,
-                b_props.href,
-                a_props.hash,
-                b_props.hash,
-                a_props.etag,
-                b_props.etag,
-            ),
+            "DELETE FROM status WHERE ident NOT IN (SELECT ident FROM new_status)"
         )
-
-    def insert_ident_b(self, ident, b_props):
-        # FIXME: Super inefficient
-        old_props = self.get_new_b(ident)
-        if old_props is not None:
-            raise IdentAlreadyExists(old_href=old_props.href, new_href=b_props.href)
-        a_props = self.get_new_a(ident) or ItemMetadata()
+        # Changed rows are deleted before inserting their new versions, so
+        # that hrefs can move between idents without violating the unique
+        # indexes.
         self._c.execute(
-            "INSERT OR REPLACE INTO new_status VALUES(?, ?, ?, ?, ?, ?, ?)",
-            (
-                ident,
-                a_props.href,
-                b_props.href,
-                a_props.hash,
-                b_props.hash,
-                a_props.etag,
-                b_props.etag,
-            ),
+            """DELETE FROM status WHERE ident IN (
+            SELECT n.ident FROM new_status AS n JOIN status AS s USING (ident)
+            WHERE n.href_a IS NOT s.href_a OR n.href_b IS NOT s.href_b
+               OR n.hash_a IS NOT s.hash_a OR n.hash_b IS NOT s.hash_b
+               OR n.etag_a IS NOT s.etag_a OR n.etag_b IS NOT s.etag_b
+        )"""
+        )
+        self._c.execute(
+            "INSERT INTO status SELECT * FROM new_status "
+            "WHERE ident NOT IN (SELECT ident FROM status)"
+        )
+        self._c.execute("DELETE FROM new_status")
+
+    def _insert_many_impl(self, side, items):
+        items = list(items)
+        new_hrefs = {}
+        for ident, props in items:
+            if ident in new_hrefs:
+                raise IdentAlreadyExists(old_href=new_hrefs[ident], new_href=props.href)
+            new_hrefs[ident] = props.href
+
+        idents = list(new_hrefs)
+        for i in range(0, len(idents), _MAX_VARIABLES):
+            chunk = idents[i : i + _MAX_VARIABLES]
+            res = self._c.execute(
+                f"SELECT ident, href_{side} AS href FROM new_status "
+                f"WHERE hash_{side} IS NOT NULL "
+                f"AND ident IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchone()
+            if res is not None:
+                raise IdentAlreadyExists(
+                    old_href=res["href"], new_href=new_hrefs[res["ident"]]
+                )
+
+        self._c.executemany(
+            f"INSERT INTO new_status (ident, href_{side}, hash_{side}, etag_{side}) "
+            "VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (ident) DO UPDATE SET "
+            f"href_{side}=excluded.href_{side}, "
+            f"hash_{side}=excluded.hash_{side}, "
+            f"etag_{side}=excluded.etag_{side}",
+            ((ident, props.href, props.hash, props.etag) for ident, props in items),
         )
 
+    def insert_many_a(self, items):
+        self._insert_many_impl("a", items)
+
+    def insert_many_b(self, items):
+        self._insert_many_impl("b", items)
+
+    def insert_ident_a(self, ident, a_props):
+        self._insert_many_impl("a", [(ident, a_props)])
+
+    def insert_ident_b(self, ident, b_props):
+        self._insert_many_impl("b", [(ident, b_props)])
+
     def update_ident_a(self, ident, props):
         self._c.execute(
             "UPDATE new_status SET href_a=?, hash_a=?, etag_a=? WHERE ident=?",
@@ -295,6 +412,22 @@ class SqliteStatus(_StatusBase):
             for res in self._c.execute("SELECT ident FROM new_status").fetchall()
         )
 
+    def load_snapshot(self):
+        """Load the old and the new status with one query each.
+
+        :returns: Two dicts ``(old, new)`` mapping each ident to a tuple of
+            ``(hash_a, etag_a, hash_b, etag_b)``.
+        """
+        return tuple(
+            {
+                row[0]: row[1:]
+                for row in self._c.execute(
+                    f"SELECT ident, hash_a, etag_a, hash_b, etag_b FROM {table}"
+                )
+            }
+            for table in ("status", "new_status")
+        )
+
     def rollback(self, ident):
         a = self.get_a(ident)
         b = self.get_b(ident)
@@ -323,6 +456,64 @@ class SqliteStatus(_StatusBase):
             etag=res["etag"],
         )
 
+    def _iter_old_impl(self, side):
+        for res in self._c.execute(
+            f"SELECT ident, href_{side} AS href, hash_{side} AS hash,"
+            f"       etag_{side} AS etag "
+            f"FROM status WHERE href_{side} IS NOT NULL"
+        ).fetchall():
+            yield (
+                res["ident"],
+                ItemMetadata(href=res["href"], hash=res["hash"], etag=res["etag"]),
+            )
+
+    def iter_old_a(self):
+        return self._iter_old_impl("a")
+
+    def iter_old_b(self):
+        return self._iter_old_impl("b")
+
+    def _get_state_impl(self, side, key):
+        res = self._c.execute(
+            "SELECT value FROM collection_state WHERE side=? AND key=?", (side, key)
+        ).fetchone()
+        return res["value"] if res else None
+
+    def _set_state_impl(self, side, key, value):
+        if value is None:
+            self._c.execute(
+                "DELETE FROM collection_state WHERE side=? AND key=?", (side, key)
+            )
+        else:
+            self._c.execute(
+                "INSERT OR REPLACE INTO collection_state VALUES (?, ?, ?)",
+                (side, key, value),
+            )
+
+    def get_sync_token_a(self):
+        return self._get_state_impl("a", "sync_token")
+
+    def get_sync_token_b(self):
+        return self._get_state_impl("b", "sync_token")
+
+    def set_sync_token_a(self, token):
+        self._set_state_impl("a", "sync_token", token)
+
+    def set_sync_token_b(self, token):
+        self._set_state_impl("b", "sync_token", token)
+
+    def get_ctag_a(self):
+        return self._get_state_impl("a", "ctag")
+
+    def get_ctag_b(self):
+        return self._get_state_impl("b", "ctag")
+
+    def set_ctag_a(self, ctag):
+        self._set_state_impl("a", "ctag", ctag)
+
+    def set_ctag_b(self, ctag):
+        self._set_state_impl("b", "ctag", ctag)
+
     def get_by_href_a(self, *a, **kw):
         kw["side"] = "a"
         return self._get_by_href_impl(*a, **kw)
@@ -336,21 +527,34 @@ class SubStatus:
     def __init__(self, parent: SqliteStatus, side: str):
         self.parent = parent
         assert side in "ab"
+        self.side = side
 
         self.remove_ident = parent.remove_ident
 
         if side == "a":
             self.insert_ident = parent.insert_ident_a
+            self.insert_many = parent.insert_many_a
             self.update_ident = parent.update_ident_a
             self.get = parent.get_a
             self.get_new = parent.get_new_a
             self.get_by_href = parent.get_by_href_a
+            self.iter_old = parent.iter_old_a
+            self.get_sync_token = parent.get_sync_token_a
+            self.set_sync_token = parent.set_sync_token_a
+            self.get_ctag = parent.get_ctag_a
+            self.set_ctag = parent.set_ctag_a
         else:
             self.insert_ident = parent.insert_ident_b
+            self.insert_many = parent.insert_many_b
             self.update_ident = parent.update_ident_b
             self.get = parent.get_b
             self.get_new = parent.get_new_b
             self.get_by_href = parent.get_by_href_b
+            self.iter_old = parent.iter_old_b
+            self.get_sync_token = parent.get_sync_token_b
+            self.set_sync_token = parent.set_sync_token_b
+            self.get_ctag = parent.get_ctag_b
+            self.set_ctag = parent.set_ctag_b
 
 
 class ItemMetadata:
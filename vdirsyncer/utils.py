@@ -63,7 +63,12 @@ def get_etag_from_file(f):
         stat = os.fstat(f.fileno())
     else:
         stat = os.stat(f)
+    return get_etag_from_stat(stat)
 
+
+def get_etag_from_stat(stat: os.stat_result) -> str:
+    """Get etag from the result of :py:func:`os.stat`, for callers that
+    already have it."""
     mtime = getattr(stat, "st_mtime_ns", None)
     if mtime is None:
         mtime = stat.st_mtime
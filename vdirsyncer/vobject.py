@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import hashlib
+import re
 from functools import cached_property
 from itertools import chain
 from itertools import tee
@@ -172,6 +173,198 @@ def _split_collection_impl(item, main, inline, items, ungrouped_items):
         raise ValueError(f"Unknown component: {item.name}")
 
 
+_COMPONENT_LINE_RE = re.compile(rb"^(BEGIN|END):([^\r\n]*)", re.MULTILINE)
+
+
+class CollectionIndex:
+    """Where the items of a collection are, see :py:func:`index_collection`.
+
+    :ivar wrapper: The ``VCALENDAR`` or ``VADDRESSBOOK`` around all items,
+        with its properties but without subcomponents.
+    :ivar footer_start: The offset of the wrapper's ``END`` line.
+    :ivar items: A list of ``(raw, spans)`` for every item, in the order of
+        :py:func:`split_collection`. ``spans`` is a list of ``(start, end)``
+        offsets of the item's own components, which doesn't include the
+        timezones shared by all items.
+    :ivar timezones: All ``VTIMEZONE`` components.
+    """
+
+    def __init__(self, wrapper, footer_start, items, timezones):
+        self.wrapper = wrapper
+        self.footer_start = footer_start
+        self.items = items
+        self.timezones = timezones
+
+    def to_dict(self):
+        """Return the layout of the collection, without its items, in a form
+        that can be stored as JSON."""
+        return {
+            "wrapper": [self.wrapper.name, self.wrapper.props],
+            "footer_start": self.footer_start,
+            "timezones": [list(tz.dump_lines()) for tz in self.timezones],
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """The reverse of :py:meth:`to_dict`.
+
+        :raises ValueError: If ``d`` isn't valid.
+        """
+        try:
+            name, props = d["wrapper"]
+            return cls(
+                wrapper=_Component(name, list(props), []),
+                footer_start=int(d["footer_start"]),
+                items=[],
+                timezones=[_Component.parse(lines) for lines in d["timezones"]],
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid collection index: {e}")
+
+    def get_components(self, item):
+        """Return the components :py:func:`join_collection` would write for
+        ``item``, or ``None`` if adding it would also change the wrapper."""
+        parsed = item.parsed
+        if (
+            parsed is None
+            or _default_join_wrappers.get(parsed.name) != self.wrapper.name
+        ):
+            return None
+        if parsed.name != self.wrapper.name:
+            return [parsed]
+        if not set(self.wrapper.props).issuperset(parsed.props):
+            return None
+        return parsed.subcomponents
+
+    def read_item(self, data, spans, encoding="utf-8"):
+        """Return the raw item whose components are at ``spans`` of
+        ``data``, as :py:func:`split_collection` would.
+
+        :raises ValueError: If the components can't be parsed.
+        """
+        return self._join_item(
+            [_Component.parse(data[start:end].decode(encoding)) for start, end in spans]
+        )
+
+    def _join_item(self, components):
+        if components[0].name == "VCARD":
+            (item,) = components
+        else:
+            item = _Component(self.wrapper.name, self.wrapper.props[:], components)
+            if item.name == "VCALENDAR":
+                del item["METHOD"]
+        item.subcomponents.extend(self.timezones)
+        return "\r\n".join(item.dump_lines())
+
+
+def index_collection(data, encoding="utf-8", read_items=True):
+    """Split a collection like :py:func:`split_collection`, and find the byte
+    offsets of the components of each item.
+
+    Only collections that consist of a single ``VCALENDAR`` or
+    ``VADDRESSBOOK`` can be indexed, which is what :py:func:`join_collection`
+    creates.
+
+    :param data: The collection as bytes, or a buffer like
+        :py:class:`mmap.mmap`.
+    :param read_items: If false, the items aren't kept in memory, and their
+        ``raw`` in :py:attr:`CollectionIndex.items` is ``None``. Use
+        :py:meth:`CollectionIndex.read_item` to read them one by one.
+    :returns: A :py:class:`CollectionIndex`, or ``None`` if the collection
+        can't be indexed.
+    """
+    depth = 0
+    wrapper_name = None
+    wrapper_end = None
+    footer_start = None
+    # The parts of the wrapper outside of its subcomponents, which contain its
+    # properties.
+    wrapper_ranges = []
+    # (name, start, end) of the wrapper's subcomponents
+    spans = []
+    last = 0
+    for match in _COMPONENT_LINE_RE.finditer(data):
+        line_start = match.start()
+        line_end = data.find(b"\n", match.end())
+        line_end = len(data) if line_end == -1 else line_end + 1
+        name = match.group(2).strip().upper().decode("ascii", "replace")
+
+        if match.group(1) == b"BEGIN":
+            if depth == 0:
+                if wrapper_name is not None or data[:line_start].strip():
+                    return None
+                if name not in ("VCALENDAR", "VADDRESSBOOK"):
+                    return None
+                wrapper_name = name
+                last = line_start
+            elif depth == 1:
+                wrapper_ranges.append((last, line_start))
+                spans.append((name, line_start))
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                component_name, start = spans.pop()
+                spans.append((component_name, start, line_end))
+                last = line_end
+            elif depth == 0:
+                wrapper_ranges.append((last, line_end))
+                footer_start = line_start
+                wrapper_end = line_end
+            elif depth < 0:
+                return None
+
+    if wrapper_end is None or depth != 0 or data[wrapper_end:].strip():
+        return None
+
+    try:
+        wrapper = _Component.parse(
+            b"".join(data[start:end] for start, end in wrapper_ranges).decode(encoding)
+        )
+    except ValueError:
+        return None
+
+    timezones = []
+    grouped = {}  # uid => [components, spans]
+    ungrouped = []
+    for component_name, start, end in spans:
+        try:
+            component = _Component.parse(data[start:end].decode(encoding))
+        except ValueError:
+            return None
+        if component.name != component_name:
+            return None
+
+        if component.name == "VTIMEZONE":
+            timezones.append(component)
+        elif component.name == "VCARD":
+            ungrouped.append(([component] if read_items else [], [(start, end)]))
+        elif component.name in ("VTODO", "VEVENT", "VJOURNAL"):
+            uid = component.get("UID", "")
+            item = ([], [])
+            if uid.strip():
+                item = grouped.setdefault(uid, item)
+            else:
+                ungrouped.append(item)
+            if read_items:
+                item[0].append(component)
+            item[1].append((start, end))
+        else:
+            return None
+
+    index = CollectionIndex(
+        wrapper=wrapper,
+        footer_start=footer_start,
+        items=[],
+        timezones=timezones,
+    )
+    index.items = [
+        (index._join_item(components) if read_items else None, item_spans)
+        for components, item_spans in chain(grouped.values(), ungrouped)
+    ]
+    return index
+
+
 _default_join_wrappers = {
     "VCALENDAR": "VCALENDAR",
     "VEVENT": "VCALENDAR",
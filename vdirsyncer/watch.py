@@ -0,0 +1,262 @@
+"""
+Watch directories for changed files, so that filesystem storages don't have to
+be listed completely on every sync.
+
+On Linux, inotify is used through ctypes. Elsewhere, or if a directory can't
+be watched with inotify, the directory is polled instead.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+_WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1  # noqa: B018
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class _Directory:
+    def __init__(self, seq: int):
+        # Changes before this sequence number weren't recorded.
+        self.valid_since = seq
+        # {filename: sequence number of the last change}
+        self.changed: dict[str, int] = {}
+        # For polling: {filename: (mtime, inode, size)}
+        self.snapshot: dict[str, tuple] | None = None
+
+
+class DirectoryWatcher:
+    """Record which files of the watched directories changed.
+
+    Every change gets a sequence number, and :py:meth:`get_token` returns a
+    token for the current one. :py:meth:`changes_since` then returns the
+    files that changed after a token was obtained.
+
+    Must be used from within the event loop.
+
+    :param on_change: Called with the path of a directory whenever a file in
+        it changed.
+    :param poll_interval: How many seconds to wait between two scans of
+        directories that are polled.
+    :param use_inotify: Set to ``False`` to always poll.
+    """
+
+    def __init__(self, on_change=None, poll_interval=2.0, use_inotify=True):
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+
+        # Tokens of other watchers (or processes) are never valid.
+        self._id = uuid.uuid4().hex
+        self._seq = 0
+        self._dirs: dict[str, _Directory] = {}
+        self._wds: dict[int, str] = {}
+        self._poll_task = None
+
+        self._libc = _load_inotify() if use_inotify else None
+        self._fd = None
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                e = ctypes.get_errno()
+                logger.warning(f"Can't use inotify, polling: {os.strerror(e)}")
+            else:
+                self._fd = fd
+                asyncio.get_running_loop().add_reader(fd, self._read_events)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        self._dirs.clear()
+        self._wds.clear()
+
+    def watch(self, path: str) -> None:
+        """Start recording the changes in the directory ``path``."""
+        path = os.path.abspath(path)
+        if path in self._dirs:
+            return
+
+        self._dirs[path] = d = _Directory(self._seq)
+        if self._fd is not None:
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+            if wd >= 0:
+                self._wds[wd] = path
+                return
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                logger.warning(
+                    f"Too many inotify watches, polling {path}. Consider raising "
+                    "fs.inotify.max_user_watches."
+                )
+            else:
+                logger.warning(f"Can't watch {path} with inotify: {os.strerror(e)}")
+
+        d.snapshot = self._scan(path)
+        if self._poll_task is None:
+            self._poll_task = asyncio.ensure_future(self._poll())
+
+    def flush(self) -> None:
+        """Record the events that already happened, without waiting for the
+        event loop to get to them."""
+        self._read_events()
+
+    def get_token(self, path: str) -> str | None:
+        """Return a token describing the current state of ``path``, or
+        ``None`` if it's not watched."""
+        path = os.path.abspath(path)
+        if path not in self._dirs:
+            return None
+        # Changes that already happened must not be reported for this token.
+        self.flush()
+        return f"{self._id}:{self._seq}"
+
+    def changes_since(self, path: str, token: str) -> set[str] | None:
+        """Return the names of the files in ``path`` that changed after
+        ``token`` was obtained, or ``None`` if that isn't known."""
+        path = os.path.abspath(path)
+        d = self._dirs.get(path)
+        watcher_id, _, seq = token.partition(":")
+        if d is None or watcher_id != self._id:
+            return None
+        try:
+            seq = int(seq)
+        except ValueError:
+            return None
+        if seq < d.valid_since:
+            return None
+
+        self.flush()
+        return {name for name, changed in d.changed.items() if changed > seq}
+
+    def _record(self, path: str, name: str) -> None:
+        self._seq += 1
+        self._dirs[path].changed[name] = self._seq
+
+    def _invalidate(self, path: str) -> None:
+        """Forget what was recorded for ``path``, all tokens become invalid."""
+        self._seq += 1
+        d = self._dirs[path]
+        d.valid_since = self._seq
+        d.changed.clear()
+
+    def _notify(self, paths) -> None:
+        if self.on_change is not None:
+            for path in paths:
+                self.on_change(path)
+
+    def _read_events(self) -> None:
+        if self._fd is None:
+            return
+
+        changed_paths = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    logger.debug("inotify queue overflowed.")
+                    for path in self._dirs:
+                        self._invalidate(path)
+                    changed_paths.update(self._dirs)
+                    continue
+
+                path = self._wds.get(wd)
+                if path is None:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # The directory itself is gone, nothing is recorded
+                    # anymore.
+                    self._wds.pop(wd, None)
+                    self._invalidate(path)
+                    self._dirs[path].valid_since = sys.maxsize
+                elif name:
+                    self._record(path, os.fsdecode(name))
+                changed_paths.add(path)
+
+        self._notify(changed_paths)
+
+    @staticmethod
+    def _scan(path: str) -> dict[str, tuple]:
+        rv = {}
+        with contextlib.suppress(OSError), os.scandir(path) as entries:
+            for entry in entries:
+                with contextlib.suppress(OSError):
+                    st = entry.stat(follow_symlinks=False)
+                    rv[entry.name] = (st.st_mtime_ns, st.st_ino, st.st_size)
+        return rv
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            changed_paths = set()
+            for path, d in list(self._dirs.items()):
+                if d.snapshot is None:
+                    continue
+                new = self._scan(path)
+                for name in d.snapshot.keys() | new.keys():
+                    if d.snapshot.get(name) != new.get(name):
+                        self._record(path, name)
+                        changed_paths.add(path)
+                d.snapshot = new
+            self._notify(changed_paths)